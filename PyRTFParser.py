@@ -31,11 +31,13 @@ IN_TRANSANA = False
 import wx
 import wx.richtext as richtext
 
-# import Python's cStringIO, os, and string modules
-import cStringIO, os, string
+# import Python's cStringIO, os, re, and string modules
+import cStringIO, os, re, string
 # import Python's XML Sax handler
 import xml.sax.handler
+import xml.sax.saxutils
 import struct
+import binascii
 
 
 class PyRichTextRTFHandler(richtext.RichTextFileHandler):
@@ -129,15 +131,9 @@ class PyRichTextRTFHandler(richtext.RichTextFileHandler):
         stream = cStringIO.StringIO()
         # Extract the wxRichTextBuffer data to the stream object
         if xmlHandler.SaveStream(buf, stream):
-            # Convert the stream to a string
-            contents = stream.getvalue()
-            # Get the XML to RTF File Handler
-            fileHandler = XMLToRTFHandler()
-            # Use xml.sax, with the XML to RTF File Handler, to parse the XML and create
-            # an RTF Output string.
-            xml.sax.parseString(contents, fileHandler)
-            # Use the XML to RTF File Handler to save the RTF Output String to a file
-            fileHandler.saveFile(filename)
+            # Rewind the stream, and convert the XML in it to RTF saved to a file
+            stream.seek(0)
+            XMLToRTFFile(stream, filename)
             # Assume success
             return True
         # If we couldn't extract the XML from the buffer ...
@@ -176,16 +172,53 @@ def utf8_to_enc(str):
     return outstr
 
 
+class XMLTablesHandler(xml.sax.handler.ContentHandler):
+    """ An xml.sax handler that makes a first pass over wxRichTextCtrl XML data to collect the font and color
+        tables that XMLToRTFHandler will need, so that the RTF header can be written before the document body. """
+
+    # The font and color tables every RTF document starts with
+    initialFontTable = [u'Courier New']
+    initialColorTable = ['#000000', '#FF0000', '#00FF00', '#0000FF', '#FFFFFF']
+
+    def __init__(self):
+        """ Initialize the XMLTablesHandler """
+        self.fontTable = list(self.initialFontTable)
+        self.colorTable = list(self.initialColorTable)
+
+    def startElement(self, name, attributes):
+        """ xml.sax required method for handling the starting XML element """
+        # Only these elements carry the font and color attributes XMLToRTFHandler uses
+        if name in [u'paragraphlayout', u'paragraph', u'symbol', u'text']:
+            # Add any new font name to the font table
+            if attributes.has_key(u'fontface') and not (attributes[u'fontface'] in self.fontTable):
+                self.fontTable.append(attributes[u'fontface'])
+            # Add any new text or background color to the color table.  (This may list a color the
+            # output never uses, which is harmless.)
+            for x in [u'textcolor', u'bgcolor']:
+                if attributes.has_key(x) and not (attributes[x] in self.colorTable):
+                    self.colorTable.append(attributes[x])
+            # Bullets may use the Symbol font
+            if attributes.has_key(u'bulletstyle') and not ('Symbol' in self.fontTable):
+                self.fontTable.append('Symbol')
+
+
 class XMLToRTFHandler(xml.sax.handler.ContentHandler):
     """ An xml.sax handler designed to convert wxRichTextCtrl's internal XML format data into
         Rich Text Format data that can be saved to *.rtf files, at least to the extent that
         Transana (htp://www.transana.org) needs Rich Text Format features supported.
         by David K. Woods (dwoods@wcer.wisc.edu) """
 
-    def __init__(self, encoding='utf8'):
+    def __init__(self, encoding='utf8', stream=None, fontTable=None, colorTable=None):
         """ Initialize the XMLToRTFHandler
             Parameters:  encoding='utf8'  Character Encoding to use (only utf8 has been tested, and I don't
-                                          think the RTF Parser decodes yet. """
+                                          think the RTF Parser decodes yet.
+                         stream=None      a file-like object to write the RTF document to as the XML is parsed.
+                                          The font and color tables come first in RTF, so they must be known up
+                                          front and passed in (see XMLTablesHandler and XMLToRTFStream).
+                                          Without a stream, the RTF output is collected in memory and written
+                                          by saveFile(), saveStream() or getRTFString() after parsing.
+                         fontTable=None   the font table, a list of font names
+                         colorTable=None  the color table, a list of '#RRGGBB' strings """
         # Remember the encoding to use
         self.encoding = encoding
 
@@ -254,13 +287,23 @@ class XMLToRTFHandler(xml.sax.handler.ContentHandler):
                                                       u'tabs' : None}
 
         # Define an initial font table
-        self.fontTable = [u'Courier New']
+        if fontTable is None:
+            fontTable = XMLTablesHandler.initialFontTable
+        self.fontTable = list(fontTable)
 
         # define an initial color table
-        self.colorTable = ['#000000', '#FF0000', '#00FF00', '#0000FF', '#FFFFFF']
-
-        # Define the parsed text output  (cStringIO used for the speed improvements it provides!)
-        self.outputString = cStringIO.StringIO()
+        if colorTable is None:
+            colorTable = XMLTablesHandler.initialColorTable
+        self.colorTable = list(colorTable)
+
+        # Remember the stream to write to, if any
+        self.stream = stream
+        # Define the parsed text output.  When streaming, it goes straight to the stream.  Otherwise
+        # it is collected in memory  (cStringIO used for the speed improvements it provides!)
+        if stream is not None:
+            self.outputString = stream
+        else:
+            self.outputString = cStringIO.StringIO()
 
         # Define a variable for tracking what element we are changing
         self.element = ''
@@ -272,6 +315,18 @@ class XMLToRTFHandler(xml.sax.handler.ContentHandler):
         # Handling a URL
         self.url = ''
 
+    def startDocument(self):
+        """ xml.sax method called before any XML element """
+        # If we're streaming, the RTF header has to go out before the first element's output
+        if self.stream is not None:
+            self.writeHeader(self.stream)
+
+    def endDocument(self):
+        """ xml.sax method called after the last XML element """
+        # If we're streaming, close the RTF document
+        if self.stream is not None:
+            self.stream.write('}')
+
     def startElement(self, name, attributes):
         """ xml.sax required method for handling the starting XML element """
 
@@ -763,14 +818,37 @@ class XMLToRTFHandler(xml.sax.handler.ContentHandler):
 
         # NOTE:  We could call "saveFile()" here with the richtext end tag (if we'd already gotten a file name.)
         # I decided not to do that, as there may be times when we want to get the RTF output string or a data
-        # stream containing the RTF output stream rather than saving to a file.  I haven't written
-        # getRTFString() or getStream() methods yet, but it wouldn't be hard.
+        # stream containing the RTF output stream rather than saving to a file.  Use getRTFString() or
+        # saveStream() for those.
 
     def saveFile(self, filename):
         """ Save the RTF Output String to a file """
         # Open the file for writing
         f = open(filename, 'w')
+        # Write the RTF document to the file
+        self.saveStream(f)
+        # Close the output file
+        f.close()
+
+    def getRTFString(self):
+        """ Return the RTF document as a string """
+        stream = cStringIO.StringIO()
+        self.saveStream(stream)
+        return stream.getvalue()
+
+    def saveStream(self, f):
+        """ Write the RTF document to a file-like object """
+        # Write the header, with the font and color tables
+        self.writeHeader(f)
+
+        # now add the RTF output string from the XML parser
+        f.write(self.outputString.getvalue())
 
+        # Close the RTF document string
+        f.write('}')
+
+    def writeHeader(self, f):
+        """ Write the RTF header, font table, color table and page definition to a file-like object """
         # Add the appropriate RTF header information to the file.  This is VERY generic RTF information here.
         f.write('{\\rtf1\\ansi\\ansicpg1252\\deff0\n')
 
@@ -808,51 +886,149 @@ class XMLToRTFHandler(xml.sax.handler.ContentHandler):
         # Specify widow/orphan control
         f.write('\\widowctrl\n')
 
-        # now add the RTF output string from the XML parser
-        f.write(self.outputString.getvalue())
-
-        # Close the RTF document string
-        f.write('}')
-        # Close the output file
-        f.close()
-
     def twips(self, cm):
         """ Convert centimeters to twips.  Twips are 1/72th of an inch, and are the official measurement unit of
             the RTF specification """
         return int(((cm/2.54)*72)+0.5)*20
 
 
-class RTFTowxRichTextCtrlParser:
-    """ An RTF Parser designed to convert Rich Text Format data from *.rtf files to
-        wxRichTextCtrl's internal format, at least to the extent that
-        Transana (htp://www.transana.org) needs Rich Text Format features supported.
+# The RTF tokenizer.  Each match is exactly one token, and the name of the group that matched tells us which kind.
+RTF_TOKEN = re.compile(r"""
+      (?P<text>[^\\{}\r\n]+)            # a run of plain text
+    | \\(?P<escaped>[{}\\])             # an escaped brace or backslash
+    | \\'(?P<hex>[0-9a-fA-F]{2})        # a \'hh hex character
+    | (?P<control>\\)                   # the start of any other control word or control symbol
+    | (?P<group>[{}])                   # the start or end of an RTF block
+    | (?P<newline>[\r\n]+)              # newlines, which RTF ignores
+    """, re.VERBOSE)
+
+# A control word following its backslash:  letters, an optional numeric parameter, and an optional space delimiter
+RTF_CONTROL = re.compile(r"([a-zA-Z]*)(-?[0-9]*) ?")
+
+# Image data:  hex digits, usually broken into lines
+RTF_HEX_DATA = re.compile(r"[0-9a-fA-F][0-9a-fA-F\s]*")
+
+
+class RTFDocument:
+    """ A document read from Rich Text Format, independent of wxPython.  RTFDocumentParser builds it.
+        ApplyDocument() writes it to a wxRichTextCtrl, and DocumentToXML() converts it to the wxRichTextCtrl's
+        XML format.
+
+        The document is a list of paragraphs, each a [style, runs] pair.  Each run is a (style, content, url)
+        tuple, where content is a text string or an RTFImage, and url is '' outside of hyperlinks.  Styles are
+        dictionaries of the attributes wxRichTextXMLHandler uses, keyed by their XML names, with colors as
+        (red, green, blue) tuples.  A paragraph's style gives its paragraph attributes.  Every paragraph but
+        the last is followed by a paragraph break.
+
+        Consecutive text in the same style is merged into one run, so the paragraphs are only complete once
+        Finish() has been called. """
+
+    def __init__(self):
+        """ Initialize an empty document """
+        # The basic (buffer-wide) style, if one is set
+        self.basicStyle = None
+        # The paragraphs, starting with one empty paragraph
+        self.paragraphs = [[{}, []]]
+        # The text waiting to be added to the current paragraph as one run, with its style and URL
+        self.text = []
+        self.textStyle = None
+        self.textURL = ''
+
+    def SetBasicStyle(self, style):
+        """ Set the basic (buffer-wide) style """
+        self.basicStyle = style
+
+    def AddText(self, txt, style, url=''):
+        """ Add text in a style to the current paragraph.  Newlines in the text end paragraphs. """
+        lines = txt.split('\n')
+        for x in range(len(lines)):
+            if x > 0:
+                self.EndParagraph(style)
+            if lines[x] != '':
+                # Text in a different style or hyperlink from the text before it starts a new run
+                if (url != self.textURL) or not ((style is self.textStyle) or (style == self.textStyle)):
+                    self.FlushText()
+                    self.textStyle = style
+                    self.textURL = url
+                self.text.append(lines[x])
+
+    def FlushText(self):
+        """ Add the text waiting to be added to the current paragraph as one run """
+        if len(self.text) > 0:
+            try:
+                txt = ''.join(self.text)
+            # If we have byte strings outside of ASCII as well as unicode strings ...
+            except UnicodeDecodeError:
+                # ... the byte strings are from the document's (Windows) code page
+                txt = u''
+                for piece in self.text:
+                    if isinstance(piece, str):
+                        piece = piece.decode('cp1252', 'replace')
+                    txt += piece
+            self.paragraphs[-1][1].append((self.textStyle, txt, self.textURL))
+            self.text = []
+
+    def AddImage(self, data, imagetype, style):
+        """ Add an image to the current paragraph, from its encoded data of a wx.BITMAP_TYPE_* type """
+        self.FlushText()
+        self.paragraphs[-1][1].append((style, RTFImage(data, imagetype), ''))
+
+    def EndParagraph(self, style):
+        """ End the current paragraph, with the paragraph attributes of style, and start a new one """
+        self.FlushText()
+        self.paragraphs[-1][0] = style
+        self.paragraphs.append([style, []])
+
+    def Finish(self, style):
+        """ Set the paragraph attributes of the last paragraph, once the whole document has been read """
+        self.FlushText()
+        self.paragraphs[-1][0] = style
+
+
+class RTFImage:
+    """ An image in an RTFDocument, kept in its original encoded format until it is needed """
+
+    def __init__(self, data, imagetype):
+        """ Initialize the image from its encoded data, of a wx.BITMAP_TYPE_* type """
+        self.data = data
+        self.imagetype = imagetype
+
+    def GetImage(self):
+        """ Decode the image to a wx.Image """
+        return wx.ImageFromStream(cStringIO.StringIO(self.data), self.imagetype)
+
+
+class RTFDocumentParser:
+    """ An RTF Parser designed to convert Rich Text Format data from *.rtf files to an RTFDocument, which
+        holds the text, styles and images in the form the wxRichTextCtrl needs, at least to the extent that
+        Transana (htp://www.transana.org) needs Rich Text Format features supported.  The parser doesn't
+        use the wxRichTextCtrl, or any other wxPython object, so it can run in any thread or process.
         by David K. Woods (dwoods@wcer.wisc.edu) """
 
-    def __init__(self, txtCtrl, filename=None, buf=None, encoding='utf8'):
-        """ Initialize the RTFToRichTextCtrlParser.
+    def __init__(self, filename=None, buf=None, encoding='utf8'):
+        """ Initialize the RTFDocumentParser and parse the document into self.document.
 
-            Parameters:  txtCtrl          a wx.RichTextCtrl, NOT a wx.RichTextBuffer.  The buffer doesn't provide an easy way to add text!
-                         filename=None    a Rich Text Format (*.rtf) file name
+            Parameters:  filename=None    a Rich Text Format (*.rtf) file name
                          buf=None         a string with RTF-encoded data
                          encoding='utf8'  Character Encoding to use (only utf8 has been tested, and I don't
                                           think the RTF Parser decodes yet.
 
             You can pass in either a filename or a buffer string.  If both are passed, only the file will be imported.  """
 
-        # Remember the wxRichTextCtrl to populate
-        self.txtCtrl = txtCtrl
+        # Create the document to populate
+        self.document = RTFDocument()
         # At present, encoding is not used!
         self.encoding = encoding
 
         # Create a default font specification.  I've chosen Courier New, 12 point, black on white,
         self.font = {'fontfacename'  :  'Courier New',
                      'fontsize'      :  12,
-                     'fontcolor'     :  wx.Colour(0, 0, 0),
-                     'fontbgcolor'   :  wx.Colour(255, 255, 255)}
+                     'fontcolor'     :  (0, 0, 0),
+                     'fontbgcolor'   :  (255, 255, 255)}
 
-        # Create an object to hold font specifications for the current font
-        self.txtAttr = richtext.RichTextAttr()
-        # Apply the default font specifications to the current font object
+        # Create a dictionary to hold font specifications for the current font
+        self.style = {}
+        # Apply the default font specifications to the current font
         self.SetTxtStyle(fontFace = self.font['fontfacename'], fontSize = self.font['fontsize'],
                           fontColor = self.font['fontcolor'], fontBgColor = self.font['fontbgcolor'],
                           fontBold = False, fontItalic = False, fontUnderline = False)
@@ -919,8 +1095,15 @@ class RTFTowxRichTextCtrlParser:
         # Initialize RTF block nesting counter
         self.nest = 0
 
+        # Initialize the number of fallback characters that follow a \u Unicode character, and the values
+        # to restore when each of the enclosing RTF blocks ends
+        self.uc = 1
+        self.ucStack = []
+
         # Process the RTF document
         self.process_doc()
+        # The paragraph style in effect at the end of the document applies to its last paragraph
+        self.document.Finish(self.style)
 
     def SetTxtStyle(self, fontColor = None, fontBgColor = None, fontFace = None, fontSize = None,
                           fontBold = None, fontItalic = None, fontUnderline = None,
@@ -934,80 +1117,183 @@ class RTFTowxRichTextCtrlParser:
 
             According to Julian, this functions "as expected" because of the way the RichTextCtrl is written.
 
-            The SetTxtStyle() method handles overlapping styles in a way that avoids this problem.  """
+            The SetTxtStyle() method handles overlapping styles in a way that avoids this problem.
 
+            The current style is kept in self.style, a dictionary of the attributes wxRichTextXMLHandler uses, keyed
+            by their XML names.  Text already in the document keeps a reference to the style it was written in, so
+            rather than changing self.style, we replace it with a modified copy.  If nothing actually changes, as
+            with most of the style resets at the start of each RTF block, self.style is left alone.  """
+
+        # Collect the attributes to set
+        style = {}
         # If the font face (font name) is specified, set the font face
         if fontFace:
-            self.txtAttr.SetFontFaceName(fontFace)
+            style['fontface'] = fontFace
             self.font['fontfacename'] = fontFace
         # If the font size is specified, set the font size
         if fontSize:
-            self.txtAttr.SetFontSize(fontSize)
+            style['fontsize'] = fontSize
             self.font['fontsize'] = fontSize
         # If a color is specified, set text color
         if fontColor:
-            self.txtAttr.SetTextColour(fontColor)
+            style['textcolor'] = fontColor
         # If a background color is specified, set the background color
         if fontBgColor:
-            self.txtAttr.SetBackgroundColour(fontBgColor)
+            style['bgcolor'] = fontBgColor
         # If bold is specified, set or remove bold as requested
         if fontBold != None:
             if fontBold:
-                self.txtAttr.SetFontWeight(wx.FONTWEIGHT_BOLD)
+                style['fontweight'] = wx.FONTWEIGHT_BOLD
             else:
-                self.txtAttr.SetFontWeight(wx.FONTWEIGHT_NORMAL)
+                style['fontweight'] = wx.FONTWEIGHT_NORMAL
         # If italics is specified, set or remove bold as requested
         if fontItalic != None:
             if fontItalic:
-                self.txtAttr.SetFontStyle(wx.FONTSTYLE_ITALIC)
+                style['fontstyle'] = wx.FONTSTYLE_ITALIC
             else:
-                self.txtAttr.SetFontStyle(wx.FONTSTYLE_NORMAL)
+                style['fontstyle'] = wx.FONTSTYLE_NORMAL
         # If underline is specified, set or remove bold as requested
         if fontUnderline != None:
             if fontUnderline:
-                self.txtAttr.SetFontUnderlined(True)
+                style['fontunderlined'] = 1
             else:
-                self.txtAttr.SetFontUnderlined(False)
+                style['fontunderlined'] = 0
         # If Paragraph Alignment is specified, set the alignment
         if parAlign != None:
-            self.txtAttr.SetAlignment(parAlign)
+            style['alignment'] = parAlign
         # If Left Indent is specified, set the left indent
         if parLeftIndent != None:
             # Left Indent can be an integer for left margin only, or a 2-element tuple for left indent and left subindent.
             if type(parLeftIndent) == int:
-                self.txtAttr.SetLeftIndent(parLeftIndent)
+                style['leftindent'] = parLeftIndent
+                style['leftsubindent'] = 0
             elif (type(parLeftIndent) == tuple) and (len(parLeftIndent) > 1):
-                self.txtAttr.SetLeftIndent(parLeftIndent[0], parLeftIndent[1])
+                style['leftindent'] = parLeftIndent[0]
+                style['leftsubindent'] = parLeftIndent[1]
         # If Right Indent is specified, set the right indent
         if parRightIndent != None:
-            self.txtAttr.SetRightIndent(parRightIndent)
+            style['rightindent'] = parRightIndent
         # If Tabs are specified, set the tabs
         if parTabs != None:
-            self.txtAttr.SetTabs(parTabs)
+            style['tabs'] = tuple(parTabs)
         # If Line Spacing is specified, set Line Spacing
         if parLineSpacing != None:
-            self.txtAttr.SetLineSpacing(parLineSpacing)
+            style['linespacing'] = parLineSpacing
         # If Paragraph Spacing Before is set, set spacing before
         if parSpacingBefore != None:
-            self.txtAttr.SetParagraphSpacingBefore(parSpacingBefore)
+            style['parspacingbefore'] = parSpacingBefore
         # If Paragraph Spacing After is set, set spacing after
         if parSpacingAfter != None:
-            self.txtAttr.SetParagraphSpacingAfter(parSpacingAfter)
-        # Apply the modified font to the document
-        self.txtCtrl.SetDefaultStyle(self.txtAttr)
+            style['parspacingafter'] = parSpacingAfter
+        # If any of the attributes differ from the current style ...
+        for key in style.keys():
+            if (not self.style.has_key(key)) or (self.style[key] != style[key]):
+                # ... use a modified copy of the current style for the text that follows
+                newStyle = dict(self.style)
+                newStyle.update(style)
+                self.style = newStyle
+                break
 
     def process_doc(self):
         """ Process and parse a document in Rich Text Format """
-        # Initialize a text variable
-        txt = ""
+        # Text is gathered as a list of pieces, and only joined when something needs to use it
+        pieces = []
 
-        # We need to go through the file buffer one character at a time
+        # We go through the file buffer one token at a time.  A token is a run of text, an escaped character,
+        # a \'hh hex character, a control word, or a block start or end.
         while self.index < len(self.buffer):
-            # Get one character
-            c = self.buffer[self.index]
-
-            # Handle curly brackets and backslash characters
-            if "{}\\".count(c) > 0:
+            # In an image, the image data can be megabytes of hex digits, so we take all of it at once
+            if self.in_image:
+                m = RTF_HEX_DATA.match(self.buffer, self.index)
+                # If we have image data ...
+                if m != None:
+                    # ... add it to the local text ...
+                    pieces.append(m.group())
+                    # ... and move past it.
+                    self.index = m.end()
+                    continue
+
+            # Get the next token.  Every character starts some token, so there is always a match.
+            m = RTF_TOKEN.match(self.buffer, self.index)
+            kind = m.lastgroup
+
+            # A run of plain text ...
+            if kind == 'text':
+                txt = m.group('text')
+                # If we're in the color table, each semicolon moves to the next color
+                if self.in_color_table and (';' in txt):
+                    # ... so increment the color index once for each of them ...
+                    self.colorIndex += txt.count(';')
+                    # ... and leave them out of the text
+                    txt = txt.replace(';', '')
+                # ... is added to the local text ...
+                pieces.append(txt)
+                # ... and we move past it.
+                self.index = m.end()
+
+            # If the characters are preceded by a backslash, skip that backslash character
+            elif kind == 'escaped':
+                # Add only the second character to the local text
+                pieces.append(m.group('escaped'))
+                # Move the index past both characters
+                self.index = m.end()
+
+            # Newlines and \r characters are not text, so we just move past them
+            elif kind == 'newline':
+                self.index = m.end()
+
+            # See if we have a WORD-style Unicode character specifier, (backslash)(apostrophe) ...
+            elif kind == 'hex':
+                # The WORD style is \'hh, where hh is a hex representation of the character.
+                # Get the hex part and convert it to an integer value.
+                val = int(m.group('hex'), 16)
+
+                # Word Smart Quotes cause problems.  These come across as "\'93" and "\'94"
+                #(hex for 147 and 148) and need to be replaced with a normal quote character.
+                if (val in [147, 148]):
+                    # 22 is the HEX value for chr(34), the quotation mark character.
+                    val = 34
+
+                # Get the text gathered so far
+                txt = ''.join(pieces)
+                # If there's text in the buffer when we do this ...   (There never should be text here, but no harm done.)
+                if txt != '':
+                    # ... we need to process that text before going any further
+                    self.process_text(txt)
+                    # and now that the text is processed, we need to clear it from the local text variable.
+                    txt = ''
+
+                # If we encounter Unicode characters while naming a font ...
+                if self.in_font_block:
+                    # If our character value is 161 or larger ...
+                    if val >= 161:
+                        # ... we can add the appropriate unicode character to the font name
+                        txt += unichr(val)
+                    # If our value is less than 161 ...
+                    elif val > 138:
+                        # ... then unichr() and chr() disagree, and we need the chr() character instead.
+                        txt += chr(val)
+                else:
+                    # If our character value is 161 or larger ...
+                    if val >= 161:
+                        # ... we can insert the appropriate unicode character
+                        self.process_text(unichr(val))
+                    # If our value is less than 161 ...
+                    elif val > 138:
+                        # ... then unichr() and chr() disagree, and we need the chr() character instead.
+                        self.process_text(chr(val))
+
+                # Keep whatever text is left over
+                pieces = txt and [txt] or []
+                # We are now done inserting the character, so can move past it.
+                self.index = m.end()
+
+            # If we're dealing with a block start or end or a control word, continue normal processing
+            else:
+                # Get the character to process
+                c = self.buffer[self.index]
+                # Get the text gathered so far
+                txt = ''.join(pieces)
 
                 # Open curly bracket starts an RTF text block
                 if (c == '{'):
@@ -1015,236 +1301,169 @@ class RTFTowxRichTextCtrlParser:
                     self.SetTxtStyle(fontFace = self.font['fontfacename'], fontSize = self.font['fontsize'],
                                       fontColor = self.font['fontcolor'], fontBgColor = self.font['fontbgcolor'],
                                       fontBold = False, fontItalic = False, fontUnderline = False)
+                # If we're in a Font block within the Font Table ...
+                if self.in_font_block and len(txt) > 0:
+                    # If the txt is not blank ...
+                    if txt[:-1] != '':
+                        # ... it must be the font name!  Grab it!
+                        self.fontName = txt[:-1]
+                    # Clear the txt, since we've used it
+                    txt = ""
+                    # Add the font number / name combination to the Font Table
+                    self.fontTable[self.fontNumber] = self.fontName
+
+                # If we're in a list and txt has been captured ...
+                elif self.in_list and len(txt) > 0:
+                    # ... we need to store it for later, after more formatting is determined ...
+                    self.list_txt += txt
+                    # ... and we need to blank out txt.
+                    txt = ''
+
+                # If we are NOT in an image or in a URL field ...
+                elif (not self.in_image) and (not self.in_field):
+                    # ... then we should process the text
+                    self.process_text(txt)
+                    # Clear the txt, since we've used it
+                    txt = ""
+
+                # If our character opens an RTF block ...
+                if c == '{':
+                    # ... note one level deeper in block nesting
+                    self.nest += 1
+                    # Remember the number of Unicode fallback characters of the enclosing block
+                    self.ucStack.append(self.uc)
+                    # If we're in the font table ...
+                    if (self.in_font_table):
+                        # ... then we are entering a font block ...
+                        self.in_font_block = True
+                    # ... and we can move on to the next character
+                    self.index += 1
 
-                # If the characters are preceded by a backslash, skip that backslash character
-                if self.buffer[self.index : self.index + 2] in ['\{', '\}', '\\\\']:
-                    # Add only the second character to the local text variable
-                    txt += self.buffer[self.index + 1]
-                    # Move the index past both characters
-                    self.index += 2
-
-                # See if we have a WORD-style Unicode character specifier, (backslash)(apostrophe) ...
-                elif (self.buffer[self.index : self.index+2] in ["\\'", "\\\'"]):
-                    # The WORD style is \'hh, where hh is a hex representation of the character.
-                    # Get the hex part and convert it to an integer value.
-                    val = int(self.buffer[self.index+2:self.index+4], 16)
-
-                    # Word Smart Quotes cause problems.  These come across as "\'93" and "\'94"
-                    #(hex for 147 and 148) and need to be replaced with a normal quote character.
-                    if (val in [147, 148]):
-                        # 22 is the HEX value for chr(34), the quotation mark character.
-                        val = 34
-                        # Replace smart quote with regular quotes in the self.buffer text.
-                        self.buffer = self.buffer[:self.index+2] + '22' + self.buffer[self.index+4:]
-
-                    # If there's text in the buffer when we do this ...   (There never should be text here, but no harm done.)
-                    if txt != '':
-                        # ... we need to process that text before going any further
-                        self.process_text(txt)
-                        # and now that the text is processed, we need to clear it from the local text variable.
-                        txt = ''
-
-                    # If we encounter Unicode characters while naming a font ...
-                    if self.in_font_block:
-                        # If our character value is 161 or larger ...
-                        if val >= 161:
-                            # ... we can add the appropriate unicode character to the font name
-                            txt += unichr(val)
-                        # If our value is less than 161 ...
-                        elif val > 138:
-                            # ... then unichr() and chr() disagree, and we need the chr() character instead.
-                            txt += chr(val)
-                    else:
-                        # If our character value is 161 or larger ...
-                        if val >= 161:
-                            # ... we can insert the appropriate unicode character
-                            self.process_text(unichr(val))
-                        # If our value is less than 161 ...
-                        elif val > 138:
-                            # ... then unichr() and chr() disagree, and we need the chr() character instead.
-                            self.process_text(chr(val))
-
-                    # We are now done inserting the character, so can move 4 positions in the buffer to get past it.
-                    self.index += 4
-
-                # If we're not dealing with an escaped character, continue normal processing
-                else:
-                    # If we're in a Font block within the Font Table ...
-                    if self.in_font_block and len(txt) > 0:
-                        # If the txt is not blank ...
-                        if txt[:-1] != '':
-                            # ... it must be the font name!  Grab it!
-                            self.fontName = txt[:-1]
-                        # Clear the txt, since we've used it
-                        txt = ""
-                        # Add the font number / name combination to the Font Table
-                        self.fontTable[self.fontNumber] = self.fontName
-
-                    # If we're in a list and txt has been captured ...
-                    elif self.in_list and len(txt) > 0:
-                        # ... we need to store it for later, after more formatting is determined ...
-                        self.list_txt += txt
-                        # ... and we need to blank out txt.
-                        txt = ''
-
-                    # If we are NOT in an image or in a URL field ...
-                    elif (not self.in_image) and (not self.in_field):
-                        # ... then we should process the text
-                        self.process_text(txt)
-                        # Clear the txt, since we've used it
-                        txt = ""
-
-                    # If our character opens an RTF block ...
-                    if c == '{':
-                        # ... note one level deeper in block nesting
-                        self.nest += 1
-                        # If we're in the font table ...
-                        if (self.in_font_table):
-                            # ... then we are entering a font block ...
-                            self.in_font_block = True
+                # If our character closes an RTF block ...
+                elif c == '}':
+                    # ... note one less deep in the block nesting
+                    self.nest -= 1
+                    # The block's number of Unicode fallback characters ends with it
+                    self.restore_uc()
+
+                    # If we're in a font block ...
+                    if (self.in_font_block):
+                        # ... this signals we're leaving the font block
+                        self.in_font_block = False
                         # ... and we can move on to the next character
                         self.index += 1
 
-                    # If our character closes an RTF block ...
-                    elif c == '}':
-                        # ... note one less deep in the block nesting
-                        self.nest -= 1
-
-                        # If we're in a font block ...
-                        if (self.in_font_block):
-                            # ... this signals we're leaving the font block
-                            self.in_font_block = False
-                            # ... and we can move on to the next character
-                            self.index += 1
-
-                        # If we're in the font table but NOT in a font block ...
-                        elif (self.in_font_table) or (self.in_list):
-                            # ... we can end the font table block
-                            self.process_end_block()
-
-                        # If we're in an image ...
-                        elif self.in_image:
-                            # If there's data in the local text variable ...
-                            if txt != '':
-                                # ... and that data STARTS with an asterisk ...
-                                if txt[0] != '*':
-                                    # ... if we have a PNG (implemented, tested) or a JPEG (not implemented not tested, theoretically possible) ...
-                                    if self.image_type in [wx.BITMAP_TYPE_PNG, wx.BITMAP_TYPE_JPEG]:
-                                        # Create a StringIO stream from the HEX-converted image data
-                                        stream = cStringIO.StringIO(self.hex2int(txt))
-                                        # Now convert that stream to an image
-                                        img = wx.ImageFromStream(stream, self.image_type)
-                                        # If we were successful in creating a valid image ...
-                                        if img.IsOk():
-                                            # ... add that image to the wxRichTextEdit control
-                                            self.txtCtrl.WriteImage(img)
-                                        # Whether successful or not, signal that our load attempt is completed.
-                                        self.image_loaded = True
-                                    # ... if we have a Windows Metafile image ...
-                                    elif self.image_type == 'WMETAFILE':
-                                        # ... if the image isn't already loaded through the PNG alternate method ...
-                                        if not self.image_loaded:
-                                            # ... then indicate our inability to convert this type of image using text in the wxRichTextCtrl
-                                            self.txtCtrl.WriteText(' (Unable to convert Windows Metafile image data.) ')
-                                    # ... if we have a MacPict (QuickDraw?) image ...
-                                    elif self.image_type == 'MACPICT':
-                                        # ... if the image isn't already loaded through the PNG alternate method ...
-                                        if not self.image_loaded:
-                                            # ... then indicate our inability to convert this type of image using text in the wxRichTextCtrl
-                                            self.txtCtrl.WriteText(' (Unable to convert Macintosh image data.) ')
-                                    # ... if we have an unknown image type ...
-                                    else:
-                                        # ... if the image isn't already loaded through the PNG alternate method ...
-                                        if not self.image_loaded:
-                                            # ... then indicate our inability to convert this type of image using text in the wxRichTextCtrl
-                                            self.txtCtrl.WriteText(' (Unable to convert image data.) ')
-                            # Now that we've used the image data, we can clear the local text variable ...
-                            txt = ""
-                            # ... and we need to process the end of the block
-                            self.process_end_block()
-
-                        # ... if we're in a URL / Hyperlink field ...
-                        elif self.in_field > 0:
-                            # If we're expecting the URL to come next ...
-                            if self.in_url:
-                                # ... check for the HYPERLINK keyword ...
-                                if txt[:10] == 'HYPERLINK ':
-                                    # ... and capture the data (without the keyword) as the URL
-                                    self.url = txt[11:]
-                                # If we were expecting a URL, we no longer are, even if we didn't get one.
-                                self.in_url = False
-                                # Move on to the next character, but don't close the block yet.
-                                self.index += 1
-                            # If we're expecting the LINK text ...
-                            elif self.in_link:
-                                # ... and we have a URL ...
-                                if self.url != '':
-                                    # ... then create a URL style for the text
-                                    urlStyle = richtext.RichTextAttr()
-                                    urlStyle.SetFontFaceName(self.font['fontfacename'])
-                                    urlStyle.SetFontSize(self.font['fontsize'])
-                                    urlStyle.SetTextColour(wx.BLUE)
-                                    urlStyle.SetFontUnderlined(True)
-                                    # Apply the URL style
-                                    self.txtCtrl.BeginStyle(urlStyle)
-                                    # Add the URL value itself
-                                    self.txtCtrl.BeginURL(self.url)
-                                    # Add the link text
-                                    self.txtCtrl.WriteText(txt)
-                                    # End the URL
-                                    self.txtCtrl.EndURL()
-                                    # End the URL style
-                                    self.txtCtrl.EndStyle()
-                                # If we don't have a URL ...
+                    # If we're in the font table but NOT in a font block ...
+                    elif (self.in_font_table) or (self.in_list):
+                        # ... we can end the font table block
+                        self.process_end_block()
+
+                    # If we're in an image ...
+                    elif self.in_image:
+                        # If there's data in the local text variable ...
+                        if txt != '':
+                            # ... and that data STARTS with an asterisk ...
+                            if txt[0] != '*':
+                                # ... if we have a PNG (implemented, tested) or a JPEG (not implemented not tested, theoretically possible) ...
+                                if self.image_type in [wx.BITMAP_TYPE_PNG, wx.BITMAP_TYPE_JPEG]:
+                                    # Add the HEX-converted image data to the document
+                                    self.process_image(self.hex2int(txt))
+                                    # Whether successful or not, signal that our load attempt is completed.
+                                    self.image_loaded = True
+                                # ... if we have a Windows Metafile image ...
+                                elif self.image_type == 'WMETAFILE':
+                                    # ... if the image isn't already loaded through the PNG alternate method ...
+                                    if not self.image_loaded:
+                                        # ... then indicate our inability to convert this type of image using text in the wxRichTextCtrl
+                                        self.document.AddText(' (Unable to convert Windows Metafile image data.) ', self.style)
+                                # ... if we have a MacPict (QuickDraw?) image ...
+                                elif self.image_type == 'MACPICT':
+                                    # ... if the image isn't already loaded through the PNG alternate method ...
+                                    if not self.image_loaded:
+                                        # ... then indicate our inability to convert this type of image using text in the wxRichTextCtrl
+                                        self.document.AddText(' (Unable to convert Macintosh image data.) ', self.style)
+                                # ... if we have an unknown image type ...
                                 else:
-                                    # ... something's wrong, but put the link text here anyway, with no actual hyperlink
-                                    self.txtCtrl.WriteText(txt)
-                                # Now we can process the end of the URL field block
-                                self.process_end_block()
-                            # If we're expecting neither a URL or the LINK text ...
+                                    # ... if the image isn't already loaded through the PNG alternate method ...
+                                    if not self.image_loaded:
+                                        # ... then indicate our inability to convert this type of image using text in the wxRichTextCtrl
+                                        self.document.AddText(' (Unable to convert image data.) ', self.style)
+                        # Now that we've used the image data, we can clear the local text variable ...
+                        txt = ""
+                        # ... and we need to process the end of the block
+                        self.process_end_block()
+
+                    # ... if we're in a URL / Hyperlink field ...
+                    elif self.in_field > 0:
+                        # If we're expecting the URL to come next ...
+                        if self.in_url:
+                            # ... check for the HYPERLINK keyword ...
+                            if txt[:10] == 'HYPERLINK ':
+                                # ... and capture the data (without the keyword) as the URL
+                                self.url = txt[11:]
+                            # If we were expecting a URL, we no longer are, even if we didn't get one.
+                            self.in_url = False
+                            # Move on to the next character, but don't close the block yet.
+                            self.index += 1
+                        # If we're expecting the LINK text ...
+                        elif self.in_link:
+                            # ... and we have a URL ...
+                            if self.url != '':
+                                # ... then create a URL style for the text, based on the current style
+                                urlStyle = dict(self.style)
+                                urlStyle['fontface'] = self.font['fontfacename']
+                                urlStyle['fontsize'] = self.font['fontsize']
+                                urlStyle['textcolor'] = (0, 0, 255)
+                                urlStyle['fontunderlined'] = 1
+                                # Add the link text, with the URL value itself
+                                self.document.AddText(txt, urlStyle, self.url)
+                            # If we don't have a URL ...
                             else:
-                                # ... we can just move on to the next character
-                                self.index += 1
-                            # Clear the local text variable
-                            txt = ""
-                        # If we're closing a block but don't need to do any of the specific processing above ...
-                        else:
-                            # Just close the block.  (This probably does little more than move to the next character
+                                # ... something's wrong, but put the link text here anyway, with no actual hyperlink
+                                self.document.AddText(txt, self.style)
+                            # Now we can process the end of the URL field block
                             self.process_end_block()
-
-                    # If we have a backslash character ...
-                    elif c == '\\':
-                        # ... that signals the START of a control word we should process
-                        self.process_control_word()
-
-                    # If we don't have any of those special characters ... (SHOULD NEVER BE FIRED!)
+                        # If we're expecting neither a URL or the LINK text ...
+                        else:
+                            # ... we can just move on to the next character
+                            self.index += 1
+                        # Clear the local text variable
+                        txt = ""
+                    # If we're closing a block but don't need to do any of the specific processing above ...
                     else:
-                        # ... just move on to the next character
-                        self.index += 1
+                        # Just close the block.  (This probably does little more than move to the next character
+                        self.process_end_block()
 
-            # If we don't have a special character (\\, { or }) to process ...
-            else:
-                # If we're in the color table and have a semicolon character ...
-                if (self.in_color_table) and (c == ";"):
-                    # ... then increment the color index to the next color
-                    self.colorIndex += 1
-                # For any other character other than a newline or \r ...
-                elif (c != '\r' and c != '\n'):
-                    # ... add the character to the local text variable ...
-                    txt = txt + c
-                # ... and move on to the next character
-                self.index += 1
+                # If we have a backslash character ...
+                elif c == '\\':
+                    # ... that signals the START of a control word we should process
+                    self.process_control_word()
+
+                # Keep whatever text hasn't been used yet
+                pieces = txt and [txt] or []
 
     def hex2int(self, data):
         """ Image data is stored in a file-friendly Hex format.  We need to convert it to an image-friendly binary format. """
-        # Initialize the conversion result variable
-        result = ''
-        # For each PAIR of characters in the hex data string ...
-        for x in range(0, len(data), 2):
-            # ... convert the hex pair into a integer, find that character, and add it to the result variable
-            result += chr(int(data[x : x + 2], 16))
-        # Return the converted data
-        return result
+        # Remove the line breaks and any other white space from the hex data
+        data = ''.join(data.split())
+        # A trailing half byte can't be converted, so drop it
+        if len(data) % 2 != 0:
+            data = data[:-1]
+        # Start exception handling
+        try:
+            # Convert the whole hex data string at once
+            return binascii.unhexlify(data)
+        # If the data isn't valid hex ...
+        except (TypeError, binascii.Error):
+            # ... we don't have an image
+            return ''
+
+    def process_image(self, data):
+        """ Process binary image data of type self.image_type """
+        # If we have image data ...
+        if data != '':
+            # ... add the image to the document.  It is kept in its original format, and only decoded when it is needed.
+            self.document.AddImage(data, self.image_type, self.style)
 
     def process_text(self, txt):
 	""" Process a text string """
@@ -1335,15 +1554,15 @@ class RTFTowxRichTextCtrlParser:
             if (len(self.list_txt) > 0):
                 # ... then it's now time to insert the list text in front of the new text.
                 # That is, we finally have all the list formatting in place.
-                self.txtCtrl.WriteText(self.list_txt + txt)
+                self.document.AddText(self.list_txt + txt, self.style)
                 # Clear the list text
                 self.list_txt = ''
             else:
-                # ... then add that text to the wxRichTextCtrl.
+                # ... then add that text to the document.
                 # NOTE:  I don't appear to need to decode things here.  I think RTF takes care of that in the way it
                 #        encodes Unicode characters.  If you run into encoding problems, try determing self.encoding from
                 #        the RTF file (maybe the ansicpg in the rtf header) and use txt.decode(self.encoding).
-                self.txtCtrl.WriteText(txt)
+                self.document.AddText(txt, self.style)
 
     def process_control_word(self):
         """ Process a Rich Text Format control word """
@@ -1354,61 +1573,32 @@ class RTFTowxRichTextCtrlParser:
 
         # Start exception handling
         try:
-            # Initialize the ControlWord variable
-            cw = ""
-            # Move to the first character following the backslash
-            self.index += 1
-            # Get the character to process
-            c = self.buffer[self.index]
-            # As long as we are processing LETTERS ...
-            while string.ascii_letters.count(c) > 0:
-                # ... add the character to the control word ...
-                cw = cw + c
-                # ... increment the index ...
-                self.index += 1
-                # ... and look at the next character
-                c = self.buffer[self.index]
-
-            # Now index is at the first character after the control word, which might be a number that modifies the control word.
-            # As long as we are processing NUMBERS or the minus sign ...
-            if (string.digits.count(c) > 0 or (c == '-')):
-                # Start collecting digits.  (This structure means only the first character can be the minus sign.)
-                numstr = c
-                # Increment the index ...
-                self.index += 1
-                # ... and look for the next digit
-                c = self.buffer[self.index]
-                # From now on, we only want digits ...
-                while string.digits.count(c) > 0:
-                    # ... add the next digit to the number string ...
-                    numstr += c
-                    # ... increment the index ...
-                    self.index += 1
-                    # ... and look for the next digit
-                    c = self.buffer[self.index]
+            # Get the control word, which is the letters following the backslash, and the number that might modify it.
+            m = RTF_CONTROL.match(self.buffer, self.index + 1)
+            cw, numstr = m.group(1, 2)
+            # If we have a number ...
+            if numstr:
                 # Start exception handling
                 try:
                     # Convert the number string to an integer
                     num = int(numstr)
                 # If the conversion raises an exception ...
                 except:
-                    # ... then we don't really have a number.
+                    # ... then we don't really have a number.  (This happens with a lone minus sign.)
                     num = 0
             # If the next character was not a number ...
             else:
                 # ... we need to at least initialize the num variable
                 num = None
+            # Get the first character after the control word and its number
+            c = self.buffer[m.end(2) : m.end(2) + 1]
+            # Move past the control word.  If the next character is a space, the regular expression has already skipped it.
+            # Spaces here are considered to be the control word's terminator and are not real text that should be processed.
+            self.index = m.end()
 
             if DEBUG:
                 print "Processing control word '%s' with numeric parameter %s" % (cw, num)
 
-            # Now index points to the first non-digit character after the control word.
-            # If the next character is a space ...
-            if (c == ' '):
-                # skip the space.  Spaces here are considered to be the control word's terminator
-                # and are not real text that should be processed.
-                self.index += 1
-
             # If c is an asterisk and we have a blank control word, we're pointing at a "\*", which is a special
             # case in Rich Text Format.  This is often data that can be ignored as redundant, but there are a few
             # special cases where we need that data.
@@ -1483,543 +1673,17 @@ class RTFTowxRichTextCtrlParser:
 ##                    self.index += 2
 ##                return
 
-            # ANSI Code Page specification.  If non-English encoding is an issue, this may be where we can determine
-            # what encoding we need to use.
-            if cw == "ansicpg":
-                # Right now, all we do is print a message for programmers who want it if we're dealing with
-                # something other than the English Code Page
-                if (num != 1252) and DEBUG:
-                    print "ansicpg is NOT 1252, US English."
-
-            # Bold
-            elif cw == "b":
-                # Determine the proper setting in Boolean
-                if num:
-                    val = (num != 0)
-                else:
-                    # If no parameter passed, assume to turn it on
-                    val = True
-                # Set the current font
-                self.SetTxtStyle(fontBold = val)
+            # Look up the method that handles this control word
+            handler = self.controlWords.get(cw)
+            # If there is one ...
+            if handler != None:
+                # ... let it process the control word
+                handler(self, cw, num)
 
-            # Color Blue specification
-            elif cw == "blue":
-                # Add the blue value to the appropriate color table entry
-                self.colorTable[self.colorIndex] |= num
-
-##            # Again, we have a block of code I might still need for Transana, so don't want to remove just yet.  Please ignore it.
-##            # Sometimes, the closed dot is encodes as a "bullet" in RTF.
-##            elif cw.lower() == 'bullet':
-##                # We're using Unicode Character 183
-##                tempChar = unichr(183)
-##                # And we need to process it at Text
-##                self.process_text(tempChar.encode(TransanaGlobal.encoding))
-
-            # Color Table specification
-            elif cw == "colortbl":
-                # Initialize the Color Table
-                self.colorTable = [0x00000]
-                # Signal that we are building the Color Table
-                self.in_color_table = True
-
-            # Text Background Color or Highlight Color
-            elif cw in ["cb", 'highlight']:
-                # Get the Color definition from the Color Table
-                colorDef = "%06x" % self.colorTable[num]
-                # Set the Font Color based on the Color Definition by converting from Hex to Integers
-                self.SetTxtStyle(fontBgColor = wx.Color(int(colorDef[:2], 16), int(colorDef[2:4], 16), int(colorDef[4:6], 16)))
-
-            # Foreground (text) color
-            elif cw == "cf":
-                # Get the Color definition from the Color Table
-                colorDef = "%06x" % self.colorTable[num]
-                # Set the Font Color based on the Color Definition by converting from Hex to Integers
-                self.SetTxtStyle(fontColor = wx.Color(int(colorDef[:2], 16), int(colorDef[2:4], 16), int(colorDef[4:6], 16)))
-
-            # Default font
-            elif cw == "deff":
-                # Problem:  The Font Table hasn't been defined when this spec arises.
-                # Solution:  Remember the default font number and assign it once the Font Table is comp
-                self.defaultFontNumber = num
-
-            # Encapsulated Metafile and Windows Metafile format for image processing (not handled)
-            elif cw in ['emfblip', 'wmetafile']:
-                # Note that we have a Windows Metafile format image that we will not be handling
-                self.image_type = 'WMETAFILE'
-
-            # Font number specification
-            elif cw == "f":
-                # If the font number is NOT already in the Font Table dictionary ...
-                if not self.fontTable.has_key(num):
-                    # ... we need to add it.  (This should only occur when the Font Table is being read.)
-                    # But we don't have all the data we need yet, such as the font name.  So let's just remember
-                    # the font number that we just found out for now.
-                    self.fontNumber = num
-                # If the font number IS in the Font Table ...
-                else:
-                    # ... set the current Font Face to the appropriate font
-                    self.SetTxtStyle(fontFace = self.fontTable[num])
-
-            # First line paragraph indent
-            elif cw == 'fi':
-                # Update the paragraph first line indent
-                self.paragraph['firstlineindent'] = num
-
-            # Field specifier used in URL processing.  Used in many other unsupported ways in RTF as well.
-            elif cw == 'field':
-                # Indicate that we are in a field
-                self.in_field = self.nest
-
-            # Field Instructions, used in URL processing to indicate the URL value
-            elif cw == 'fldinst':
-                # Signal that we are about to receive a URL
-                self.in_url = True
-
-            # Field Result, used in URL processing to indicate the Link Text
-            elif cw == 'fldrslt':
-                # Signal that we are about to receive the Link Text
-                self.in_link = True
-
-            # Font Table declaration
-            elif cw == "fonttbl":
-                # Signal that we've entered the Font Table
-                self.in_font_table = True
-
-            # Font Size
-            elif cw == "fs":
-                # Set current font size to half the parameter
-                self.SetTxtStyle(fontSize = (num / 2))
-
-            # Color Green specification
-            elif cw == "green":
-                # Add the color to the appropriate color table entry
-                self.colorTable[self.colorIndex] |= (num << 8)
-
-            # Italics
-            elif cw == "i":
-                # Determine the proper setting
-                if num:
-                    val = (num != 0)
-                else:
-                    # If no parameter passed, assume to turn it on
-                    val = True
-                # Set the current font
-                self.SetTxtStyle(fontItalic = val)
-
-            # Info block
-            elif cw == "info":
-                # This block contains metadata such as author/title, ignore it by skipping to the end of the RTF block
-                self.seek_eob()
-
-            # JPEG image (untested)
-            elif cw == 'jpegblip':
-                # Signal that we're dealing with a JPEG image
-                self.image_type = wx.BITMAP_TYPE_JPEG
-                # Are we in a nested/hidden picture situation?  If so, CAPTURE THE DATA!!!!
-                # (This shouldn't be necessary, but can't hurt.)
-                if not self.in_image:
-                    self.in_image = True
-
-            # Left and right double quote
-            elif cw == "ldblquote" or cw == "rdblquote":
-                # Add the straight double-quote character
-                self.process_text('"')
-
-            # Left paragraph indent
-            elif cw == 'li':
-                # Update the paragraph left indent
-                self.paragraph['leftindent'] = num
-
-            # New Line specifier
-            elif cw == 'line':
-                # Insert a Newline, but don't change any settings
-                self.txtCtrl.Newline()
-
-            # List Text specified (bulleted lists with characters as the bullet text)
-            elif cw == 'listtext':
-                # Remember that we are in a list
-                self.in_list = True
-                # Initialize the List Text (probably redundantly)
-                self.list_txt = ''
-
-            # Left single quote
-            elif cw == "lquote":
-                # Add the correct character
-                self.process_text("`")
-
-            # Mac Picture (DrawGraph?) format? for image processing (not handled)
-            elif cw == 'macpict':
-                # Note that we are in an image (Necessary for Word for the Mac support?)
-                self.in_image = True
-                # Note that we have a Windows Metafile format image that we will not be handling
-                self.image_type = 'MACPICT'
-
-            # Paragraph End specifier
-            elif cw in ["par"]:
-                # The wxRichTextCtrl sets paragraph formatting by specifying it before a Newline() and cancelling it after.
-                # It doesn't matter if the paragraph text is already in place.
-
-                # Set the wxRichTextCtrl's tab information
-                if len(self.paragraph['tabs']) > 0:
-                    self.SetTxtStyle(parTabs = self.paragraph['tabs'])
-
-                # Set the wxRichTextCtrl's paragraph spacing
-                self.SetTxtStyle(parSpacingBefore = self.antitwips(self.paragraph['spacingbefore']), parSpacingAfter = self.antitwips(self.paragraph['spacingafter']))
-                # Set the wxRichTextCtrl's paragraph alignment
-                if self.paragraph['alignment'] == 'center':
-                    self.SetTxtStyle(parAlign = wx.TEXT_ALIGNMENT_CENTER)
-                elif self.paragraph['alignment'] == 'right':
-                    self.SetTxtStyle(parAlign = wx.TEXT_ALIGNMENT_RIGHT)
-                # Set the wxRichTextCtrl's line spacing
-                self.SetTxtStyle(parLineSpacing = self.paragraph['linespacing'])
-                # Set the wxRichTextCtrl's paragraph left, first line, and right indents
-                self.SetTxtStyle(parLeftIndent = (self.antitwips(self.paragraph['leftindent'] + self.paragraph['firstlineindent']), self.antitwips(0 - self.paragraph['firstlineindent'])),
-                                 parRightIndent = self.antitwips(self.paragraph['rightindent']))
-                # Specify the Newline() placement
-                self.txtCtrl.Newline()
-
-            # Paragraph Definition
-            elif cw == 'pard':
-                # If we are NOT in a list ...  (Lists need to preserve formatting!)
-                if not self.in_list:
-                    # ... reset all paragraph formatting.
-                    self.paragraph = {'alignment'       : 'left',
-                                      'linespacing'     : richtext.TEXT_ATTR_LINE_SPACING_NORMAL,
-                                      'leftindent'      : 0,
-                                      'rightindent'     : 0,
-                                      'firstlineindent' : 0,
-                                      'spacingbefore'   : 0,
-                                      'spacingafter'    : 0,
-                                      'tabs'            : []}
-                    # (We need to reset the paragraph formatting in self.txtAttr as well.)
-                    self.SetTxtStyle(parAlign = wx.TEXT_ALIGNMENT_LEFT, parLineSpacing = richtext.TEXT_ATTR_LINE_SPACING_NORMAL,
-                                     parTabs = [], parLeftIndent = (0, 0), parRightIndent = 0, parSpacingBefore = 0, parSpacingAfter = 0)
-
-            # Picture (image) processing
-            elif cw == 'pict':
-                # Signal that we are processing an image
-                self.in_image = True
-
-            # Plain Font formatting
-            elif cw == "plain":
-                self.SetTxtStyle(fontUnderline = False, fontBold = False, fontItalic = False)
-
-            # PNG graphic format image processing
-            elif cw == 'pngblip':
-                # Signal that our image type is PNG
-                self.image_type = wx.BITMAP_TYPE_PNG
-                # Are we in a nested/hidden picture situation?  If so, CAPTURE THE DATA!!!!
-                # (This shouldn't be necessary, but can't hurt!)
-                if not self.in_image:
-                    self.in_image = True
-
-            # Center paragraph alignment
-            elif cw == 'qc':
-                # Update the paragraph alignment
-                self.paragraph['alignment'] = 'center'
-
-            # Left paragraph alignment
-            elif cw == 'ql':
-                # Update the paragraph alignment
-                self.paragraph['alignment'] = 'left'
-
-            # Right paragraph alignment
-            elif cw == 'qr':
-                # Update the paragraph alignment
-                self.paragraph['alignment'] = 'right'
-
-            # Color Red specification
-            elif cw == "red":
-                # Check to see if entry needs to be added
-                if self.colorIndex == len(self.colorTable):
-                    # If so, add the new entry
-                    self.colorTable.append(num << 16)
-                # If not,
-                else:
-                    # update the appropriate entry
-                    self.colorTable[self.colorIndex] = num << 16
-
-            # Right paragraph indent
-            elif cw == 'ri':
-                # Update the paragraph right indent
-                self.paragraph['rightindent'] = num
-
-            # Right single quote
-            elif cw == "rquote":
-                # Add the correct character
-                self.process_text("'")
-
-            # rtf version specifier
-            elif cw == "rtf":
-                # Report if desired
-                if DEBUG:
-                    print "Document uses RTF version %d" % num
-                # There's nothing to do.
-                pass
-
-            # Paragraph line spacing after
-            elif cw == 'sa':
-                # Update the paragraph line spacing after
-                self.paragraph['spacingafter'] = num
-
-            # Paragraph line spacing before
-            elif cw == 'sb':
-                # Update the paragraph line spacing before
-                self.paragraph['spacingbefore'] = num
-
-            # Line Spacing
-            elif cw == 'sl':
-                # NOTE:  The wxRichTextCtrl has limited line spacing options.
-                # Double Spacing is 3 lines per inch, or 480 twips
-                if num >= 480:
-                    # Update the paragraph linespacing
-                    self.paragraph['linespacing'] = richtext.TEXT_ATTR_LINE_SPACING_TWICE
-                # Line and a half spacing is 4 lines per inch, or 360 twips
-                elif num >= 360:
-                    # Update the paragraph linespacing
-                    self.paragraph['linespacing'] = richtext.TEXT_ATTR_LINE_SPACING_HALF
-                # Single spacing is 6 lines per inch, or 240 twips, but that is the default for RTF.
-                else:
-                    # Update the paragraph linespacing
-                    self.paragraph['linespacing'] = richtext.TEXT_ATTR_LINE_SPACING_NORMAL
-
-            # Shape Name and Shape Value
-            elif cw in ["sn", "sv"]:
-                # We can skip this data while processing images by skipping to the end of the RTF block
-                self.seek_eob()
-
-            # Style sheets, and styles in general, are not currently supported.
-            elif cw == "stylesheet":
-                # Ignore stylesheet data as it messes things up if not properly supported by skipping to the end of the RTF block
-                self.seek_eob()
-
-            # Tab
-            elif cw == "tab":
-                # If we're in a list ...
-                if self.in_list:
-                    # ... add the tab to the list text.  (We're not ready to add it to the control yet.)
-                    self.list_txt += '\t'
-                # If we're not in a list ...
-                else:
-                    # ... send the Tab character to the text processor
-                    self.process_text("\t")
-
-            # Tab Stop specification
-            elif cw == 'tx':
-                # Append the tab stop data to the paragraph's tab stop definition
-                self.paragraph['tabs'].append(self.antitwips(num))
-
-            # Unicode Character Processing
-            elif cw == 'u':
-
-                if DEBUG and (num not in [164, 8232]):
-                    print "Processing Unicode Character Code %d" % num
-
-                # Start exception handling
-                try:
-                    # Unicode character 8232 is a line separator!
-                    if num == 8232:
-                        self.txtCtrl.Newline()
-                    # Otherwise ...
-                    else:
-                        # ... convert the number to a unicode character ...
-                        tempChar = unichr(num)
-                        # ... and process the character as text
-                        self.process_text(tempChar)
-
-                        # Sometimes, especially in RTF from Word on the Mac, there are redundant specifiers of the RTF character.
-                        # This code detects that and skips over it!
-                        if (self.buffer[self.index : self.index + 2] == "\\'") and \
-                           (self.buffer[self.index + 2] in '0123456789ABCDEFabcdef') and \
-                           (self.buffer[self.index + 3] in '0123456789ABCDEFabcdef') and \
-                           (self.buffer[self.index + 4] != '\\'):
-                            # Skip past the unicode character digits
-                            self.index += 4
-                        # If we don't have this condition, se can just look for the next space and set the index after that
-                        else:
-                            self.index = self.buffer.find(' ', self.index) + 1
-                # If a ValueError is raised ...
-                except ValueError:
-                    # Report to the programmer if desired
-                    if DEBUG:
-                        print "ValueError in RTF Processing for Unicode.  Control Word 'u', num =", num
-                    # ... and just move on.
-                    pass
-
-            elif cw == "ul":
-                # Determine the proper setting
-                if num:
-                    val = (num != 0)
-                else:
-                    # If no parameter passed, assume to turn it on
-                    val = True
-                # Set the current font
-                self.SetTxtStyle(fontUnderline = val)
-
-
-
-
-
-
-
-            # Control Words I have chosen to IGNORE for now  (in groups, but kind of alphabetical beyond that!)
-
-            # ab, ai                      Associated Font characteristics (bold, italic)
-            # adeflang, adeff             Default southeast asian language, font
-            # aendnotes, aenddoc          End Notes
-            # af, afs                     associated font & font size
-            # alang                       associated language
-            # ansi, mac, pc               Default Character Sets (I don't know what to DO about this!)
-            # bliptag
-            # charrsid
-            # cgrid                       character grid (??)
-            # deflang, deflangfe          Default language definition, Default East Asian language
-            # dghspace, dgvspace, dghorigin, dgvorigin  Grid drawing information
-            # dghshow, dgvshow            Grid drawing information
-            # dntblnsbdb                  Something about balancing Japanese characters
-            # donotembedlingdata
-            # donotembedsysfont
-            # expshrtn                    Expand characters spaces on line-ending
-            # faauto                      Font Alignment - Auto
-            # fbidi, fmodern, fnil, froman, fscript, fswiss  Font family specifications.  At this time, I'm only dealing with specific fonts, not families.
-            # fcharset                    Character Set spec.
-            # fcs                         something about complex script
-            # fet                         Footnote type
-            # flomajor, fdbmajor, fhimajor, fbimajor, flominor, fdbminor, fhiminor, fbiminor     ... ummmmm.
-            # fprq                        Specifies whether a font uses the default pitch (0), a fixed pitch (1), or a variable pitch (2)  (I don' know the implications for this setting.)
-            # ftntj, ftntbj               Footnote justification
-            # grfdocevents
-            # gutter                      Gutter Width in twips
-            # horzdoc, vertdoc            Horizontal or vertical rendering
-            # ignoremixedcontent
-            # ilfomacatclnup
-            # insrsid
-            # itap                        paragraph nesting level
-            # jclisttab
-            # jcompress                   Justification compression
-            # kerning                     Point size for kerning (0 is off)
-            # lang, langfe                Language settings
-            # langnp, langfenp            Language for a text run
-            # lin, rin                    left, right paragraph indent
-            # linex                       Distance from line number to left margin
-            # loch, hich, dbch            Text is single-byte low ansi, hi ansi, double-byte
-            # ls                          List Override index
-            # margl, margr, margt, margb  Page Margins in "twips".  Not a concept Transana has.  Exports at 1440, 1 inch
-            # mmathPr, mmathFont, mbrkBin, mbrkBinSub,
-            # msmallFrac, mdispDef, mlMargin, mrMargin,
-            # mwrapRight, mintLim, mnaryLim
-            # nolnhtadjtbl                No line height adjustment in table
-            # nonshppict                  "Specifies a picture destination that it will not read on input" whatever that means.
-            # noqfpromote
-            # nospaceforul                No space for underlining
-            # noultrlspc                  Don't underline trailing spaces
-            # noxlattoyen                 Yen Backslash option
-            # paperw, paperh              Paper Size in "twips".  Not a concept Transana has.  Exports at 12240 x 15840, 8.5 x 11 inches
-            # pararsid
-            # picprop, picscalex, picscaley, piccropl, piccropr, piccropt, piccropb,
-            # picw, pich, picwgoal, pichgoal
-            # relyonvml
-            # rsidroot                    Start of Document History (first save)
-            # rtlch, ltrch, ltrpar, lrtsect    right-to-left and left-to-right segment directionality
-            # saveinvalidxml
-            # sectd, sectdefaultcl        default section properties
-            # sftntj, sftnbj              Footnote Justification
-            # showplaceholdtext
-            # showxmlerrors
-            # shppict, shplid
-            # slmult                      Line Spacing is a multiple of normal
-            # sp
-            # stshfloch                   Default ASCII font for style sheets.  At this time, I'm not supporting style sheets.
-            # stshfhich                   Default High-ANSI font for style sheets
-            # stshfdbch                   Default East Asian font for style sheets
-            # stshfbi                     Default Complex Script for style sheets
-            # themelang, themelangfe, themelangcs  Theme languages
-            # trackformatting
-            # trackmoves,
-            # uc                          Unicode byte length
-            # upr                         keyword representation (??)
-            # validatexml
-            # viewkind                    The "view mode"  (None, page layout, outline view, etc.)
-            # viewscale
-            # widowctl, widowctrl, widctlpar, nowidctlpar   Widow/orphan control
-            # wrapdefault                 use default line wrapping
-
-            elif (cw in ['ab', 'ai',
-                        'adeflang', 'adeff',
-                        'aendnotes', 'aenddoc',
-                        'af', 'afs',
-                        'alang',
-                        'ansi', 'mac', 'pc',
-                        'cgrid',
-                        'deflang', 'deflangfe',
-                        'dghspace', 'dgvspace', 'dghorigin', 'dgvorigin', 'dghshow', 'dgvshow',
-                        'dntblnsbdb',
-                        'donotembedlingdata',
-                        'donotembedsysfont',
-                        'expshrtn',
-                        'faauto',
-                        'fbidi', 'fmodern', 'fnil', 'froman', 'fscript', 'fswiss',
-                        'fcharset',
-                        'fcs',
-                        'fet',
-                        'flomajor', 'fdbmajor', 'fhimajor', 'fbimajor', 'flominor', 'fdbminor', 'fhiminor', 'fbiminor',
-                        'fprq',
-                        'ftntj', 'ftnbj',
-                        'grfdocevents',
-                        'gutter',
-                        'horzdoc', 'vertdoc',
-                        'ignoremixedcontent',
-                        'ilfomacatclnup',
-                        'insrsid',
-                        'itap',
-                        'jclisttab',
-                        'jcompress',
-                        'kerning',
-                        'lang', 'langfe', 'langnp', 'langfenp',
-                        'lin', 'rin',
-                        'linex',
-                        'loch', 'hich', 'dbch',
-                        'ls',
-                        'margl', 'margr', 'margt', 'margb',
-                        'mmathPr', 'mmathFont', 'mbrkBin', 'mbrkBinSub', 'msmallFrac', 'mdispDef', 'mlMargin', 'mrMargin', 'mwrapRight',
-                        'mintLim', 'mnaryLim',
-                        'nolnhtadjtbl',
-                        'nonshppict',
-                        'noqfpromote',
-                        'nospaceforul',
-                        'noultrlspc',
-                        'noxlattoyen',
-                        'paperw', 'paperh',
-                        'pararsid',
-                        'picprop', 'picscalex', 'picscaley', 'piccropl', 'piccropr', 'piccropt', 'piccropb',
-                        'picw', 'pich', 'picwgoal', 'pichgoal',
-                        'relyonvml',
-                        'rsidroot',
-                        'rtlch', 'ltrch', 'ltrpar', 'ltrsect',
-                        'saveinvalidxml',
-                        'sectd', 'sectdefaultcl',
-                        'sftntj', 'sftnbj',
-                        'showplaceholdtext',
-                        'showxmlerrors',
-                        'shppict', 'shplid',
-                        'slmult',
-                        'sp',
-                        'stshfloch', 'stshfhich', 'stshfdbch', 'stshfbi',
-                        'themelang', 'themelangfe', 'themelangcs',
-                        'trackmoves',
-                        'trackformatting',
-                        'uc',
-                        'upr',
-                        'validatexml',
-                        'viewkind', 'viewscale',
-                        'widowctl', 'widowctrl', 'widctlpar', 'nowidctlpar',
-                        'wrapdefault']) or \
-                ('bliptag' in cw.lower()) or \
-                ('charrsid' in cw.lower())   :
+            # Control Words that contain these strings are ignored too
+            elif ('bliptag' in cw.lower()) or ('charrsid' in cw.lower()):
                 if DEBUG:
                     print "Ignoring Control Word '%s'" % cw
-                else:
-                    pass
 
             else:
                 if DEBUG or DEBUG2:
@@ -2038,6 +1702,600 @@ class RTFTowxRichTextCtrlParser:
                 traceback.print_exc(file=sys.stdout)
             return
 
+    def cw_ansicpg(self, cw, num):
+        """ ANSI Code Page specification.  If non-English encoding is an issue, this may be where we can determine
+            what encoding we need to use. """
+        # Right now, all we do is print a message for programmers who want it if we're dealing with
+        # something other than the English Code Page
+        if (num != 1252) and DEBUG:
+            print "ansicpg is NOT 1252, US English."
+
+    def cw_b(self, cw, num):
+        """ Bold """
+        # Determine the proper setting in Boolean
+        if num:
+            val = (num != 0)
+        else:
+            # If no parameter passed, assume to turn it on
+            val = True
+        # Set the current font
+        self.SetTxtStyle(fontBold = val)
+
+    def cw_blue(self, cw, num):
+        """ Color Blue specification """
+        # Add the blue value to the appropriate color table entry
+        self.colorTable[self.colorIndex] |= num
+
+##            # Again, we have a block of code I might still need for Transana, so don't want to remove just yet.  Please ignore it.
+##            # Sometimes, the closed dot is encodes as a "bullet" in RTF.
+##            elif cw.lower() == 'bullet':
+##                # We're using Unicode Character 183
+##                tempChar = unichr(183)
+##                # And we need to process it at Text
+##                self.process_text(tempChar.encode(TransanaGlobal.encoding))
+
+    def cw_colortbl(self, cw, num):
+        """ Color Table specification """
+        # Initialize the Color Table
+        self.colorTable = [0x00000]
+        # Signal that we are building the Color Table
+        self.in_color_table = True
+
+    def cw_cb(self, cw, num):
+        """ Text Background Color or Highlight Color """
+        # Get the Color definition from the Color Table
+        colorDef = "%06x" % self.colorTable[num]
+        # Set the Font Color based on the Color Definition by converting from Hex to Integers
+        self.SetTxtStyle(fontBgColor = (int(colorDef[:2], 16), int(colorDef[2:4], 16), int(colorDef[4:6], 16)))
+
+    def cw_cf(self, cw, num):
+        """ Foreground (text) color """
+        # Get the Color definition from the Color Table
+        colorDef = "%06x" % self.colorTable[num]
+        # Set the Font Color based on the Color Definition by converting from Hex to Integers
+        self.SetTxtStyle(fontColor = (int(colorDef[:2], 16), int(colorDef[2:4], 16), int(colorDef[4:6], 16)))
+
+    def cw_deff(self, cw, num):
+        """ Default font """
+        # Problem:  The Font Table hasn't been defined when this spec arises.
+        # Solution:  Remember the default font number and assign it once the Font Table is comp
+        self.defaultFontNumber = num
+
+    def cw_emfblip(self, cw, num):
+        """ Encapsulated Metafile and Windows Metafile format for image processing (not handled) """
+        # Note that we have a Windows Metafile format image that we will not be handling
+        self.image_type = 'WMETAFILE'
+
+    def cw_f(self, cw, num):
+        """ Font number specification """
+        # If the font number is NOT already in the Font Table dictionary ...
+        if not self.fontTable.has_key(num):
+            # ... we need to add it.  (This should only occur when the Font Table is being read.)
+            # But we don't have all the data we need yet, such as the font name.  So let's just remember
+            # the font number that we just found out for now.
+            self.fontNumber = num
+        # If the font number IS in the Font Table ...
+        else:
+            # ... set the current Font Face to the appropriate font
+            self.SetTxtStyle(fontFace = self.fontTable[num])
+
+    def cw_fi(self, cw, num):
+        """ First line paragraph indent """
+        # Update the paragraph first line indent
+        self.paragraph['firstlineindent'] = num
+
+    def cw_field(self, cw, num):
+        """ Field specifier used in URL processing.  Used in many other unsupported ways in RTF as well. """
+        # Indicate that we are in a field
+        self.in_field = self.nest
+
+    def cw_fldinst(self, cw, num):
+        """ Field Instructions, used in URL processing to indicate the URL value """
+        # Signal that we are about to receive a URL
+        self.in_url = True
+
+    def cw_fldrslt(self, cw, num):
+        """ Field Result, used in URL processing to indicate the Link Text """
+        # Signal that we are about to receive the Link Text
+        self.in_link = True
+
+    def cw_fonttbl(self, cw, num):
+        """ Font Table declaration """
+        # Signal that we've entered the Font Table
+        self.in_font_table = True
+
+    def cw_fs(self, cw, num):
+        """ Font Size """
+        # Set current font size to half the parameter
+        self.SetTxtStyle(fontSize = (num / 2))
+
+    def cw_green(self, cw, num):
+        """ Color Green specification """
+        # Add the color to the appropriate color table entry
+        self.colorTable[self.colorIndex] |= (num << 8)
+
+    def cw_i(self, cw, num):
+        """ Italics """
+        # Determine the proper setting
+        if num:
+            val = (num != 0)
+        else:
+            # If no parameter passed, assume to turn it on
+            val = True
+        # Set the current font
+        self.SetTxtStyle(fontItalic = val)
+
+    def cw_info(self, cw, num):
+        """ Info block """
+        # This block contains metadata such as author/title, ignore it by skipping to the end of the RTF block
+        self.seek_eob()
+
+    def cw_jpegblip(self, cw, num):
+        """ JPEG image (untested) """
+        # Signal that we're dealing with a JPEG image
+        self.image_type = wx.BITMAP_TYPE_JPEG
+        # Are we in a nested/hidden picture situation?  If so, CAPTURE THE DATA!!!!
+        # (This shouldn't be necessary, but can't hurt.)
+        if not self.in_image:
+            self.in_image = True
+
+    def cw_ldblquote(self, cw, num):
+        """ Left and right double quote """
+        # Add the straight double-quote character
+        self.process_text('"')
+
+    def cw_li(self, cw, num):
+        """ Left paragraph indent """
+        # Update the paragraph left indent
+        self.paragraph['leftindent'] = num
+
+    def cw_line(self, cw, num):
+        """ New Line specifier """
+        # Insert a Newline, but don't change any settings
+        self.document.EndParagraph(self.style)
+
+    def cw_listtext(self, cw, num):
+        """ List Text specified (bulleted lists with characters as the bullet text) """
+        # Remember that we are in a list
+        self.in_list = True
+        # Initialize the List Text (probably redundantly)
+        self.list_txt = ''
+
+    def cw_lquote(self, cw, num):
+        """ Left single quote """
+        # Add the correct character
+        self.process_text("`")
+
+    def cw_macpict(self, cw, num):
+        """ Mac Picture (DrawGraph?) format? for image processing (not handled) """
+        # Note that we are in an image (Necessary for Word for the Mac support?)
+        self.in_image = True
+        # Note that we have a Windows Metafile format image that we will not be handling
+        self.image_type = 'MACPICT'
+
+    def cw_par(self, cw, num):
+        """ Paragraph End specifier """
+        # The wxRichTextCtrl sets paragraph formatting by specifying it before a Newline() and cancelling it after.
+        # It doesn't matter if the paragraph text is already in place.
+
+        # Set the wxRichTextCtrl's tab information
+        if len(self.paragraph['tabs']) > 0:
+            self.SetTxtStyle(parTabs = self.paragraph['tabs'])
+
+        # Set the wxRichTextCtrl's paragraph spacing
+        self.SetTxtStyle(parSpacingBefore = self.antitwips(self.paragraph['spacingbefore']), parSpacingAfter = self.antitwips(self.paragraph['spacingafter']))
+        # Set the wxRichTextCtrl's paragraph alignment
+        if self.paragraph['alignment'] == 'center':
+            self.SetTxtStyle(parAlign = wx.TEXT_ALIGNMENT_CENTER)
+        elif self.paragraph['alignment'] == 'right':
+            self.SetTxtStyle(parAlign = wx.TEXT_ALIGNMENT_RIGHT)
+        # Set the wxRichTextCtrl's line spacing
+        self.SetTxtStyle(parLineSpacing = self.paragraph['linespacing'])
+        # Set the wxRichTextCtrl's paragraph left, first line, and right indents
+        self.SetTxtStyle(parLeftIndent = (self.antitwips(self.paragraph['leftindent'] + self.paragraph['firstlineindent']), self.antitwips(0 - self.paragraph['firstlineindent'])),
+                         parRightIndent = self.antitwips(self.paragraph['rightindent']))
+        # End the paragraph
+        self.document.EndParagraph(self.style)
+
+    def cw_pard(self, cw, num):
+        """ Paragraph Definition """
+        # If we are NOT in a list ...  (Lists need to preserve formatting!)
+        if not self.in_list:
+            # ... reset all paragraph formatting.
+            self.paragraph = {'alignment'       : 'left',
+                              'linespacing'     : richtext.TEXT_ATTR_LINE_SPACING_NORMAL,
+                              'leftindent'      : 0,
+                              'rightindent'     : 0,
+                              'firstlineindent' : 0,
+                              'spacingbefore'   : 0,
+                              'spacingafter'    : 0,
+                              'tabs'            : []}
+            # (We need to reset the paragraph formatting in self.style as well.)
+            self.SetTxtStyle(parAlign = wx.TEXT_ALIGNMENT_LEFT, parLineSpacing = richtext.TEXT_ATTR_LINE_SPACING_NORMAL,
+                             parTabs = [], parLeftIndent = (0, 0), parRightIndent = 0, parSpacingBefore = 0, parSpacingAfter = 0)
+
+    def cw_pict(self, cw, num):
+        """ Picture (image) processing """
+        # Signal that we are processing an image
+        self.in_image = True
+
+    def cw_plain(self, cw, num):
+        """ Plain Font formatting """
+        self.SetTxtStyle(fontUnderline = False, fontBold = False, fontItalic = False)
+
+    def cw_pngblip(self, cw, num):
+        """ PNG graphic format image processing """
+        # Signal that our image type is PNG
+        self.image_type = wx.BITMAP_TYPE_PNG
+        # Are we in a nested/hidden picture situation?  If so, CAPTURE THE DATA!!!!
+        # (This shouldn't be necessary, but can't hurt!)
+        if not self.in_image:
+            self.in_image = True
+
+    def cw_qc(self, cw, num):
+        """ Center paragraph alignment """
+        # Update the paragraph alignment
+        self.paragraph['alignment'] = 'center'
+
+    def cw_ql(self, cw, num):
+        """ Left paragraph alignment """
+        # Update the paragraph alignment
+        self.paragraph['alignment'] = 'left'
+
+    def cw_qr(self, cw, num):
+        """ Right paragraph alignment """
+        # Update the paragraph alignment
+        self.paragraph['alignment'] = 'right'
+
+    def cw_red(self, cw, num):
+        """ Color Red specification """
+        # Check to see if entry needs to be added
+        if self.colorIndex == len(self.colorTable):
+            # If so, add the new entry
+            self.colorTable.append(num << 16)
+        # If not,
+        else:
+            # update the appropriate entry
+            self.colorTable[self.colorIndex] = num << 16
+
+    def cw_ri(self, cw, num):
+        """ Right paragraph indent """
+        # Update the paragraph right indent
+        self.paragraph['rightindent'] = num
+
+    def cw_rquote(self, cw, num):
+        """ Right single quote """
+        # Add the correct character
+        self.process_text("'")
+
+    def cw_rtf(self, cw, num):
+        """ rtf version specifier """
+        # Report if desired
+        if DEBUG:
+            print "Document uses RTF version %d" % num
+        # There's nothing to do.
+        pass
+
+    def cw_sa(self, cw, num):
+        """ Paragraph line spacing after """
+        # Update the paragraph line spacing after
+        self.paragraph['spacingafter'] = num
+
+    def cw_sb(self, cw, num):
+        """ Paragraph line spacing before """
+        # Update the paragraph line spacing before
+        self.paragraph['spacingbefore'] = num
+
+    def cw_sl(self, cw, num):
+        """ Line Spacing """
+        # NOTE:  The wxRichTextCtrl has limited line spacing options.
+        # Double Spacing is 3 lines per inch, or 480 twips
+        if num >= 480:
+            # Update the paragraph linespacing
+            self.paragraph['linespacing'] = richtext.TEXT_ATTR_LINE_SPACING_TWICE
+        # Line and a half spacing is 4 lines per inch, or 360 twips
+        elif num >= 360:
+            # Update the paragraph linespacing
+            self.paragraph['linespacing'] = richtext.TEXT_ATTR_LINE_SPACING_HALF
+        # Single spacing is 6 lines per inch, or 240 twips, but that is the default for RTF.
+        else:
+            # Update the paragraph linespacing
+            self.paragraph['linespacing'] = richtext.TEXT_ATTR_LINE_SPACING_NORMAL
+
+    def cw_sn(self, cw, num):
+        """ Shape Name and Shape Value """
+        # We can skip this data while processing images by skipping to the end of the RTF block
+        self.seek_eob()
+
+    def cw_stylesheet(self, cw, num):
+        """ Style sheets, and styles in general, are not currently supported. """
+        # Ignore stylesheet data as it messes things up if not properly supported by skipping to the end of the RTF block
+        self.seek_eob()
+
+    def cw_tab(self, cw, num):
+        """ Tab """
+        # If we're in a list ...
+        if self.in_list:
+            # ... add the tab to the list text.  (We're not ready to add it to the control yet.)
+            self.list_txt += '\t'
+        # If we're not in a list ...
+        else:
+            # ... send the Tab character to the text processor
+            self.process_text("\t")
+
+    def cw_tx(self, cw, num):
+        """ Tab Stop specification """
+        # Append the tab stop data to the paragraph's tab stop definition
+        self.paragraph['tabs'].append(self.antitwips(num))
+
+    def cw_u(self, cw, num):
+        """ Unicode Character Processing """
+        # Without a character code there's nothing to do
+        if num == None:
+            return
+
+        if DEBUG and (num not in [164, 8232]):
+            print "Processing Unicode Character Code %d" % num
+
+        # RTF numbers are signed 16-bit values, so characters above 32767 are written as negative numbers
+        if num < 0:
+            num += 65536
+
+        # Start exception handling
+        try:
+            # Unicode character 8232 is a line separator!
+            if num == 8232:
+                self.document.EndParagraph(self.style)
+            # Otherwise ...
+            else:
+                # ... convert the number to a unicode character ...
+                tempChar = unichr(num)
+                # ... and process the character as text
+                self.process_text(tempChar)
+        # If a ValueError is raised ...
+        except ValueError:
+            # Report to the programmer if desired
+            if DEBUG:
+                print "ValueError in RTF Processing for Unicode.  Control Word 'u', num =", num
+            # ... and just move on.
+            pass
+
+        # The Unicode character is followed by a substitute for readers that don't understand \u, which we skip.
+        # (This is often a redundant \'hh specifier of the same character, especially in RTF from Word on the Mac.)
+        self.skip_unicode_fallback()
+
+    def skip_unicode_fallback(self):
+        """ Skip the self.uc fallback characters that follow a \\u Unicode character.  A \\'hh hex character or
+            a control word counts as one character, and the fallback never extends past the end of a block. """
+        # Note how many characters we need to skip
+        count = self.uc
+        # As long as there are characters to skip and we don't reach the end of the RTF text ...
+        while (count > 0) and (self.index < len(self.buffer)):
+            # Get one character
+            c = self.buffer[self.index]
+            # The start or end of an RTF block ends the fallback
+            if c in '{}':
+                break
+            # Newlines don't count as characters at all
+            elif c in '\r\n':
+                self.index += 1
+                continue
+            # A \'hh hex character is one character
+            elif self.buffer[self.index : self.index + 2] == "\\'":
+                self.index += 4
+            # So is any other control word or control symbol
+            elif c == '\\':
+                # Find the end of the control word
+                end = RTF_CONTROL.match(self.buffer, self.index + 1).end()
+                # If there are no letters, digits or space after the backslash, we have a control symbol like \~
+                if end == self.index + 1:
+                    end += 1
+                self.index = end
+            # Otherwise, we have a plain character
+            else:
+                self.index += 1
+            # One fewer character to skip
+            count -= 1
+
+    def cw_uc(self, cw, num):
+        """ Number of fallback characters following each \\u Unicode character """
+        if num != None:
+            self.uc = num
+
+    def cw_ul(self, cw, num):
+        """ Underline """
+        # Determine the proper setting
+        if num:
+            val = (num != 0)
+        else:
+            # If no parameter passed, assume to turn it on
+            val = True
+        # Set the current font
+        self.SetTxtStyle(fontUnderline = val)
+
+    def cw_ignore(self, cw, num):
+        """ Control Words I have chosen to IGNORE for now """
+        if DEBUG:
+            print "Ignoring Control Word '%s'" % cw
+
+    def cw_destination(self, cw, num):
+        """ Destinations we don't support.  Their contents are not document text, so skip to the end of the RTF block """
+        if DEBUG:
+            print "Skipping destination '%s'" % cw
+        self.seek_eob()
+
+    # The control word dispatch table.  Each control word maps to the function that handles it, which is called
+    # as handler(parser, cw, num).  Use register_control_word() to add control words or replace their handlers.
+    controlWords = {'ansicpg'    : cw_ansicpg,
+                    'b'          : cw_b,
+                    'blue'       : cw_blue,
+                    'cb'         : cw_cb,
+                    'cf'         : cw_cf,
+                    'colortbl'   : cw_colortbl,
+                    'deff'       : cw_deff,
+                    'emfblip'    : cw_emfblip,
+                    'f'          : cw_f,
+                    'fi'         : cw_fi,
+                    'field'      : cw_field,
+                    'fldinst'    : cw_fldinst,
+                    'fldrslt'    : cw_fldrslt,
+                    'fonttbl'    : cw_fonttbl,
+                    'fs'         : cw_fs,
+                    'green'      : cw_green,
+                    'highlight'  : cw_cb,
+                    'i'          : cw_i,
+                    'info'       : cw_info,
+                    'jpegblip'   : cw_jpegblip,
+                    'ldblquote'  : cw_ldblquote,
+                    'li'         : cw_li,
+                    'line'       : cw_line,
+                    'listtext'   : cw_listtext,
+                    'lquote'     : cw_lquote,
+                    'macpict'    : cw_macpict,
+                    'par'        : cw_par,
+                    'pard'       : cw_pard,
+                    'pict'       : cw_pict,
+                    'plain'      : cw_plain,
+                    'pngblip'    : cw_pngblip,
+                    'qc'         : cw_qc,
+                    'ql'         : cw_ql,
+                    'qr'         : cw_qr,
+                    'rdblquote'  : cw_ldblquote,
+                    'red'        : cw_red,
+                    'ri'         : cw_ri,
+                    'rquote'     : cw_rquote,
+                    'rtf'        : cw_rtf,
+                    'sa'         : cw_sa,
+                    'sb'         : cw_sb,
+                    'sl'         : cw_sl,
+                    'sn'         : cw_sn,
+                    'stylesheet' : cw_stylesheet,
+                    'sv'         : cw_sn,
+                    'tab'        : cw_tab,
+                    'tx'         : cw_tx,
+                    'u'          : cw_u,
+                    'uc'         : cw_uc,
+                    'ul'         : cw_ul,
+                    'wmetafile'  : cw_emfblip}
+
+    # Control Words I have chosen to IGNORE for now  (in groups, but kind of alphabetical beyond that!)
+
+    # ab, ai                      Associated Font characteristics (bold, italic)
+    # adeflang, adeff             Default southeast asian language, font
+    # aendnotes, aenddoc          End Notes
+    # af, afs                     associated font & font size
+    # alang                       associated language
+    # ansi, mac, pc               Default Character Sets (I don't know what to DO about this!)
+    # bliptag
+    # charrsid
+    # cgrid                       character grid (??)
+    # deflang, deflangfe          Default language definition, Default East Asian language
+    # dghspace, dgvspace, dghorigin, dgvorigin  Grid drawing information
+    # dghshow, dgvshow            Grid drawing information
+    # dntblnsbdb                  Something about balancing Japanese characters
+    # donotembedlingdata
+    # donotembedsysfont
+    # expshrtn                    Expand characters spaces on line-ending
+    # faauto                      Font Alignment - Auto
+    # fbidi, fmodern, fnil, froman, fscript, fswiss  Font family specifications.  At this time, I'm only dealing with specific fonts, not families.
+    # fcharset                    Character Set spec.
+    # fcs                         something about complex script
+    # fet                         Footnote type
+    # flomajor, fdbmajor, fhimajor, fbimajor, flominor, fdbminor, fhiminor, fbiminor     ... ummmmm.
+    # fprq                        Specifies whether a font uses the default pitch (0), a fixed pitch (1), or a variable pitch (2)  (I don' know the implications for this setting.)
+    # ftntj, ftntbj               Footnote justification
+    # grfdocevents
+    # gutter                      Gutter Width in twips
+    # horzdoc, vertdoc            Horizontal or vertical rendering
+    # ignoremixedcontent
+    # ilfomacatclnup
+    # insrsid
+    # itap                        paragraph nesting level
+    # jclisttab
+    # jcompress                   Justification compression
+    # kerning                     Point size for kerning (0 is off)
+    # lang, langfe                Language settings
+    # langnp, langfenp            Language for a text run
+    # lin, rin                    left, right paragraph indent
+    # linex                       Distance from line number to left margin
+    # loch, hich, dbch            Text is single-byte low ansi, hi ansi, double-byte
+    # ls                          List Override index
+    # margl, margr, margt, margb  Page Margins in "twips".  Not a concept Transana has.  Exports at 1440, 1 inch
+    # mmathPr, mmathFont, mbrkBin, mbrkBinSub,
+    # msmallFrac, mdispDef, mlMargin, mrMargin,
+    # mwrapRight, mintLim, mnaryLim
+    # nolnhtadjtbl                No line height adjustment in table
+    # nonshppict                  "Specifies a picture destination that it will not read on input" whatever that means.
+    # noqfpromote
+    # nospaceforul                No space for underlining
+    # noultrlspc                  Don't underline trailing spaces
+    # noxlattoyen                 Yen Backslash option
+    # paperw, paperh              Paper Size in "twips".  Not a concept Transana has.  Exports at 12240 x 15840, 8.5 x 11 inches
+    # pararsid
+    # picprop, picscalex, picscaley, piccropl, piccropr, piccropt, piccropb,
+    # picw, pich, picwgoal, pichgoal
+    # relyonvml
+    # rsidroot                    Start of Document History (first save)
+    # rtlch, ltrch, ltrpar, lrtsect    right-to-left and left-to-right segment directionality
+    # saveinvalidxml
+    # sectd, sectdefaultcl        default section properties
+    # sftntj, sftnbj              Footnote Justification
+    # showplaceholdtext
+    # showxmlerrors
+    # shppict, shplid
+    # slmult                      Line Spacing is a multiple of normal
+    # sp
+    # stshfloch                   Default ASCII font for style sheets.  At this time, I'm not supporting style sheets.
+    # stshfhich                   Default High-ANSI font for style sheets
+    # stshfdbch                   Default East Asian font for style sheets
+    # stshfbi                     Default Complex Script for style sheets
+    # themelang, themelangfe, themelangcs  Theme languages
+    # trackformatting
+    # trackmoves,
+    # upr                         keyword representation (??)
+    # validatexml
+    # viewkind                    The "view mode"  (None, page layout, outline view, etc.)
+    # viewscale
+    # widowctl, widowctrl, widctlpar, nowidctlpar   Widow/orphan control
+    # wrapdefault                 use default line wrapping
+    ignoredControlWords = ['ab', 'ai', 'adeflang', 'adeff', 'aendnotes', 'aenddoc', 'af', 'afs', 'alang', 'ansi',
+                           'mac', 'pc', 'cgrid', 'deflang', 'deflangfe', 'dghspace', 'dgvspace', 'dghorigin',
+                           'dgvorigin', 'dghshow', 'dgvshow', 'dntblnsbdb', 'donotembedlingdata',
+                           'donotembedsysfont', 'expshrtn', 'faauto', 'fbidi', 'fmodern', 'fnil', 'froman',
+                           'fscript', 'fswiss', 'fcharset', 'fcs', 'fet', 'flomajor', 'fdbmajor', 'fhimajor',
+                           'fbimajor', 'flominor', 'fdbminor', 'fhiminor', 'fbiminor', 'fprq', 'ftntj', 'ftnbj',
+                           'grfdocevents', 'gutter', 'horzdoc', 'vertdoc', 'ignoremixedcontent', 'ilfomacatclnup',
+                           'insrsid', 'itap', 'jclisttab', 'jcompress', 'kerning', 'lang', 'langfe', 'langnp',
+                           'langfenp', 'lin', 'rin', 'linex', 'loch', 'hich', 'dbch', 'ls', 'margl', 'margr',
+                           'margt', 'margb', 'mmathPr', 'mmathFont', 'mbrkBin', 'mbrkBinSub', 'msmallFrac',
+                           'mdispDef', 'mlMargin', 'mrMargin', 'mwrapRight', 'mintLim', 'mnaryLim', 'nolnhtadjtbl',
+                           'nonshppict', 'noqfpromote', 'nospaceforul', 'noultrlspc', 'noxlattoyen', 'paperw',
+                           'paperh', 'pararsid', 'picprop', 'picscalex', 'picscaley', 'piccropl', 'piccropr',
+                           'piccropt', 'piccropb', 'picw', 'pich', 'picwgoal', 'pichgoal', 'relyonvml', 'rsidroot',
+                           'rtlch', 'ltrch', 'ltrpar', 'ltrsect', 'saveinvalidxml', 'sectd', 'sectdefaultcl',
+                           'sftntj', 'sftnbj', 'showplaceholdtext', 'showxmlerrors', 'shppict', 'shplid', 'slmult',
+                           'sp', 'stshfloch', 'stshfhich', 'stshfdbch', 'stshfbi', 'themelang', 'themelangfe',
+                           'themelangcs', 'trackmoves', 'trackformatting', 'upr', 'validatexml', 'viewkind',
+                           'viewscale', 'widowctl', 'widowctrl', 'widctlpar', 'nowidctlpar', 'wrapdefault']
+    controlWords.update(dict.fromkeys(ignoredControlWords, cw_ignore))
+
+    # Destinations we don't support.  Word writes these tables into every document, and they contain no
+    # document text, so rather than reading them one control word at a time we skip straight past them.
+    skippedDestinations = ['colorschememapping', 'datastore', 'filetbl', 'latentstyles', 'listoverridetable',
+                           'listtable', 'pgdsctbl', 'revtbl', 'rsidtbl', 'themedata', 'xmlnstbl']
+    controlWords.update(dict.fromkeys(skippedDestinations, cw_destination))
+
+    @classmethod
+    def register_control_word(cls, cw, handler):
+        """ Register handler(parser, cw, num) as the handler for control word cw, replacing any existing handler.
+            Registering on a subclass does not change the handlers of the classes it is derived from. """
+        # If this class is still sharing its dispatch table with the class it is derived from ...
+        if 'controlWords' not in cls.__dict__:
+            # ... give it a copy of its own first
+            cls.controlWords = cls.controlWords.copy()
+        # Add the control word to the dispatch table
+        cls.controlWords[cw] = handler
+
     def process_end_block(self):
         """ Special Processing for the end of an RTF block """
         # Increment the pointer to the current position in the RTF string
@@ -2050,7 +2308,7 @@ class RTFTowxRichTextCtrlParser:
             # Set the current text attribute to the default font face
             self.SetTxtStyle(fontFace = self.fontTable[self.defaultFontNumber])
             # Setting the Basic Style sets the wxRichTextCtrl's default font
-            self.txtCtrl.SetBasicStyle(self.txtAttr)
+            self.document.SetBasicStyle(self.style)
 
         # If we're in the Color Table ...
         if self.in_color_table:
@@ -2109,11 +2367,286 @@ class RTFTowxRichTextCtrlParser:
             x = x + 1
         # We can now set the new position in the RTF text for processing after the end of the RTF block
         self.index = x + 1
+        # The block's number of Unicode fallback characters ends with it
+        self.restore_uc()
+
+    def restore_uc(self):
+        """ Restore the number of Unicode fallback characters of the enclosing RTF block, once a block has ended """
+        # If we know the value for our (new) nesting level ...
+        if 0 <= self.nest < len(self.ucStack):
+            # ... restore it, and forget the values for the blocks that have ended.
+            self.uc = self.ucStack[self.nest]
+            del self.ucStack[self.nest:]
 
     def antitwips(self, num):
         """ Convert from twips to 10ths of a millimeter, which is what the wxRichTextCtrl uses """
         return int((num * 254 / 72) /20)
 
+
+class RTFTowxRichTextCtrlParser(RTFDocumentParser):
+    """ Parses Rich Text Format data and writes it into a wxRichTextCtrl at the insertion point """
+
+    def __init__(self, txtCtrl, filename=None, buf=None, encoding='utf8'):
+        """ Initialize the RTFToRichTextCtrlParser.
+
+            Parameters:  txtCtrl          a wx.RichTextCtrl, NOT a wx.RichTextBuffer.  The buffer doesn't provide an easy way to add text!
+                         filename=None    a Rich Text Format (*.rtf) file name
+                         buf=None         a string with RTF-encoded data
+                         encoding='utf8'  Character Encoding to use, as for RTFDocumentParser """
+
+        # Remember the wxRichTextCtrl to populate
+        self.txtCtrl = txtCtrl
+        # Parse the RTF document ...
+        RTFDocumentParser.__init__(self, filename=filename, buf=buf, encoding=encoding)
+        # ... and write it into the wxRichTextCtrl
+        ApplyDocument(self.document, txtCtrl)
+
+
+def ApplyDocument(document, txtCtrl):
+    """ Write an RTFDocument into a wxRichTextCtrl at the insertion point.  This has to run on the GUI thread,
+        but all of the RTF parsing has already been done. """
+    # Setting the Basic Style sets the wxRichTextCtrl's default font
+    if document.basicStyle != None:
+        txtCtrl.SetBasicStyle(StyleToAttr(document.basicStyle))
+    # The style last applied to the control.  Setting the default style is expensive, so we only do it when it changes.
+    current = None
+    for x in range(len(document.paragraphs)):
+        (paraStyle, runs) = document.paragraphs[x]
+        for (style, content, url) in runs:
+            # Apply the style of the run, if it's not already in effect
+            if not ((style is current) or (style == current)):
+                txtCtrl.SetDefaultStyle(StyleToAttr(style))
+                current = style
+            # If we have an image ...
+            if isinstance(content, RTFImage):
+                # ... it is only decoded now
+                img = content.GetImage()
+                # If we were successful in creating a valid image ...
+                if img.IsOk():
+                    # ... add that image to the wxRichTextEdit control
+                    txtCtrl.WriteImage(img)
+            # If we have hyperlink text ...
+            elif url != '':
+                # ... add the link text, with the URL value itself
+                txtCtrl.BeginURL(url)
+                txtCtrl.WriteText(content)
+                txtCtrl.EndURL()
+            else:
+                txtCtrl.WriteText(content)
+        # The wxRichTextCtrl takes the paragraph formatting from the default style in effect at the Newline().
+        # This also leaves the control with the style in effect at the end of the document.
+        if not ((paraStyle is current) or (paraStyle == current)):
+            txtCtrl.SetDefaultStyle(StyleToAttr(paraStyle))
+            current = paraStyle
+        # Every paragraph but the last ends with a paragraph break
+        if x < len(document.paragraphs) - 1:
+            txtCtrl.Newline()
+
+
+def StyleToAttr(style):
+    """ Convert an RTFDocument style to a wx.richtext.RichTextAttr """
+    attr = richtext.RichTextAttr()
+    # Character attributes
+    if style.has_key('fontface'):
+        attr.SetFontFaceName(style['fontface'])
+    if style.has_key('fontsize'):
+        attr.SetFontSize(style['fontsize'])
+    if style.has_key('textcolor'):
+        attr.SetTextColour(wx.Colour(*style['textcolor']))
+    if style.has_key('bgcolor'):
+        attr.SetBackgroundColour(wx.Colour(*style['bgcolor']))
+    if style.has_key('fontweight'):
+        attr.SetFontWeight(style['fontweight'])
+    if style.has_key('fontstyle'):
+        attr.SetFontStyle(style['fontstyle'])
+    if style.has_key('fontunderlined'):
+        attr.SetFontUnderlined(style['fontunderlined'] != 0)
+    # Paragraph attributes
+    if style.has_key('alignment'):
+        attr.SetAlignment(style['alignment'])
+    if style.has_key('leftindent'):
+        attr.SetLeftIndent(style['leftindent'], style['leftsubindent'])
+    if style.has_key('rightindent'):
+        attr.SetRightIndent(style['rightindent'])
+    if style.has_key('tabs'):
+        attr.SetTabs(list(style['tabs']))
+    if style.has_key('linespacing'):
+        attr.SetLineSpacing(style['linespacing'])
+    if style.has_key('parspacingbefore'):
+        attr.SetParagraphSpacingBefore(style['parspacingbefore'])
+    if style.has_key('parspacingafter'):
+        attr.SetParagraphSpacingAfter(style['parspacingafter'])
+    return attr
+
+
+# The paragraph attributes of an RTFDocument style.  All the others are character attributes.
+RTF_PARAGRAPH_ATTRIBUTES = ['alignment', 'leftindent', 'leftsubindent', 'rightindent',
+                            'parspacingafter', 'parspacingbefore', 'linespacing', 'tabs']
+
+
+def DocumentToXML(document):
+    """ Convert an RTFDocument to the XML that wxRichTextXMLHandler.SaveStream() would write for the same content,
+        UTF-8 encoded.  Images are kept in their original format rather than being decoded.  This needs no
+        wx.App, wxRichTextCtrl or display. """
+    # Runs share their style dictionaries, so the XML attributes for each style are only built once
+    charStyles = {}
+    paragraphs = []
+    for x in range(len(document.paragraphs)):
+        (paraStyle, runs) = document.paragraphs[x]
+        # The buffer always ends with a paragraph, but an empty last paragraph is only written when it is the only one
+        if (x > 0) and (x == len(document.paragraphs) - 1) and (len(runs) == 0):
+            break
+        content = []
+        for (style, run, url) in runs:
+            if isinstance(run, RTFImage):
+                content.append(u'<image imagetype="%d"><data>%s</data></image>' % (run.imagetype, binascii.hexlify(run.data).upper()))
+            else:
+                key = (id(style), url)
+                if not charStyles.has_key(key):
+                    charStyles[key] = XMLStyle(style, False, url)
+                XMLText(content, charStyles[key], run)
+        paragraphs.append(u'<paragraph%s>%s</paragraph>' % (XMLStyle(paraStyle, True), u''.join(content)))
+    # The basic style is written on the paragraphlayout element
+    basicStyle = u''
+    if document.basicStyle != None:
+        basicStyle = XMLStyle(document.basicStyle, False) + XMLStyle(document.basicStyle, True)
+    result = u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    result += u'<richtext version="1.0.0.0" xmlns="http://www.wxwidgets.org">\n'
+    result += u'<paragraphlayout%s>\n' % basicStyle
+    result += u'\n'.join(paragraphs)
+    result += u'\n</paragraphlayout>\n</richtext>\n'
+    return result.encode('utf8')
+
+
+def XMLStyle(style, paragraph, url=''):
+    """ Build the XML attribute string for the paragraph or the character attributes of an RTFDocument style """
+    attrs = {}
+    for (key, value) in style.items():
+        if (key in RTF_PARAGRAPH_ATTRIBUTES) != paragraph:
+            continue
+        if key in ['textcolor', 'bgcolor']:
+            value = u'#%02X%02X%02X' % value
+        elif key == 'tabs':
+            # Tabs are only written if there are any
+            if len(value) == 0:
+                continue
+            value = u','.join([unicode(x) for x in value])
+        # Font names from the RTF font table may be byte strings from the document's code page
+        elif isinstance(value, str):
+            value = value.decode('cp1252', 'replace')
+        attrs[key] = value
+    if url != '':
+        attrs['url'] = url
+    result = u''
+    for key in sorted(attrs.keys()):
+        result += u' %s=%s' % (key, xml.sax.saxutils.quoteattr(unicode(attrs[key])))
+    return result
+
+
+# The characters wxRichTextXMLHandler writes as symbol elements:  control characters other than tab and
+# carriage return, and the quotation mark
+XML_SYMBOL = re.compile(u'[\x00-\x08\x0a-\x0c\x0e-\x1f"]')
+
+
+def XMLText(content, style, txt):
+    """ Add the XML for text without newlines, in a style given as an XML attribute string, to the content list.
+        As in wxRichTextXMLHandler, control characters and quotation marks are written as separate symbol
+        elements, and text with leading or trailing spaces is quoted. """
+    # Text from the RTF parser may be a byte string from the document's (Windows) code page
+    if isinstance(txt, str):
+        txt = txt.decode('cp1252', 'replace')
+    # The text between symbols is written as it is
+    start = 0
+    for m in XML_SYMBOL.finditer(txt):
+        XMLFragment(content, style, txt[start : m.start()])
+        content.append(u'<symbol%s>%d</symbol>' % (style, ord(m.group())))
+        start = m.end()
+    XMLFragment(content, style, txt[start:])
+
+
+def XMLFragment(content, style, fragment):
+    """ Add a text element to the content list """
+    if fragment == u'':
+        return
+    fragment = xml.sax.saxutils.escape(fragment)
+    if fragment[0] == u' ' or fragment[-1] == u' ':
+        fragment = u'"%s"' % fragment
+    content.append(u'<text%s>%s</text>' % (style, fragment))
+
+
+def XMLToRTF(source):
+    """ Convert wxRichTextCtrl XML, such as a note body stored by RichTextXMLHandler, to a Rich Text Format
+        string.  source is either an XML string or a file-like object to read it from.  Only the XMLToRTFHandler
+        is used, so no wx.App, wxRichTextCtrl or display is needed. """
+    stream = cStringIO.StringIO()
+    XMLToRTFStream(source, stream)
+    return stream.getvalue()
+
+
+def XMLToRTFFile(source, filename):
+    """ Convert wxRichTextCtrl XML, as a string or a file-like object, to a Rich Text Format file """
+    # Open the file for writing
+    f = open(filename, 'w')
+    try:
+        XMLToRTFStream(source, f)
+    finally:
+        f.close()
+
+
+def XMLToRTFStream(source, stream):
+    """ Convert wxRichTextCtrl XML, as a string or a seekable file-like object, to Rich Text Format written to
+        stream (any object with a write() method, such as a file, pipe or socket file).  The XML is parsed twice:
+        once to collect the font and color tables for the RTF header, then again to write the document as it
+        is parsed.  The RTF output, including image data, is never held in memory as a whole. """
+    # First pass:  collect the font and color tables
+    tables = XMLTablesHandler()
+    parseXML(source, tables)
+    # Rewind a file-like source for the second pass
+    if not isinstance(source, basestring):
+        source.seek(0)
+    # Second pass:  write the RTF document to the stream
+    handler = XMLToRTFHandler(stream=stream, fontTable=tables.fontTable, colorTable=tables.colorTable)
+    # An empty string has no XML to parse, but is still an (empty) RTF document
+    if isinstance(source, basestring) and len(source) == 0:
+        handler.startDocument()
+        handler.endDocument()
+    else:
+        parseXML(source, handler)
+
+
+def parseXML(source, handler):
+    """ Parse XML from a string or a file-like object with an xml.sax handler.  An empty string is an
+        empty document.  A file-like object is left open. """
+    if isinstance(source, basestring):
+        if len(source) > 0:
+            xml.sax.parseString(source, handler)
+    else:
+        # xml.sax closes the streams it parses.  Leave that to the caller, who may want to read it again.
+        xml.sax.parse(UnclosedStream(source), handler)
+
+
+class UnclosedStream:
+    """ A read-only view of a file-like object that ignores close() """
+
+    def __init__(self, f):
+        self.read = f.read
+
+    def close(self):
+        pass
+
+
+def RTFToXML(buf):
+    """ Convert an RTF string to the wxRichTextCtrl's XML format.  Needs no wx.App or display. """
+    return DocumentToXML(RTFDocumentParser(buf=buf).document)
+
+
+def TextToXML(text):
+    """ Convert plain (unicode) text to the wxRichTextCtrl's XML format, one paragraph per line """
+    document = RTFDocument()
+    document.AddText(u'\n'.join(text.splitlines()), {})
+    document.Finish({})
+    return DocumentToXML(document)
+
 # If we're running in stand-alone test mode
 if __name__ == '__main__':
     # Create an xml.sax parser
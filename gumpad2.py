@@ -9,12 +9,24 @@ import wx.lib.wordwrap
 import os
 import sys
 import uuid
-import tempfile
 import optparse
 import StringIO
 import time
 import locale
 import hashlib
+import contextlib
+import re
+import binascii
+import cPickle
+import sqlite3
+import threading
+import Queue
+import struct
+import zlib
+import codecs
+import itertools
+import multiprocessing
+import posixpath
 
 import zshelve
 import PyRTFParser
@@ -45,6 +57,12 @@ program_title = "%s %s" % (program_name, program_version)
 
 program_dbpath = "%s.db" % (program_name.lower())
 
+program_codec = "zlib"
+program_compresslevel = 2
+program_backend = "shelf"
+program_autosave_interval = 30  # 自动保存的检查间隔（秒），0 表示不自动保存
+program_autosave_idle = 3       # 停止编辑多少秒后才自动保存
+
 program_main_icon = os.path.join(dirName, "main.ico")
 
 ############################################################################
@@ -72,98 +90,804 @@ def fall_into(x, a, b):
 
 ############################################################################
 #
-# VsTempFile
+# data format:
+#   version:    xx
+#   magic:      xx
+#   [uuid]:     {body: xx, blobs: [sha1sum *]}
+#   meta:[uuid]:
+#               {type: xx, title: xx, size: xx, ctime: xx, mtime: xx, xtea: sha1sum, expanded: xx},
+#               type = (root, dir, html)
+#   blob:[sha1sum]:
+#               xx
+#   root:       uuid
+#   subs:[uuid]:
+#               [uuid *]
+#
+# 结点的元数据（标题、类型、加密标记等）与正文分开存放，构建目录树时
+# 只需要读取元数据，不必解压正文。
+#
+# 未加密正文里的图片以二进制形式单独存放，按内容的 sha1 索引，正文里只
+# 保留引用 <data blob="sha1sum"/>。相同的图片只存一份，保存正文时，已经
+# 存在的图片不再重复写入。
+#
+# 目录树按结点分别保存子结点列表，移动、添加、删除结点时只需要改写
+# 相关父结点的列表，不必重写整个目录树。
+#
+# 所有修改都在事务里进行：事务内的写操作先缓存在内存里，提交时才写入
+# 数据库并只 sync 一次；出错时回滚，丢弃所有未提交的修改。单独调用的
+# SetTitle、Add 等方法各自是一个自动提交的事务。
+#
+# 界面线程和后台线程（VsWorker）共用同一个 VsData：事务从开始到提交或
+# 回滚都持有 m_lock，读数据库时也要先取得 m_lock，因此另一个线程看不到
+# 未提交的修改，也不会与正在进行的写操作交错。
 #
 
+VsData_Format_Version   = 5
+VsData_Format_Magic     = "gumpad_magic_jshcm"
+
+VsData_Type_Root    = 1
+VsData_Type_Dir     = 2
+VsData_Type_Html    = 3
 
-class VsTempFile:
+VsData_Deleted      = object()  # 事务中被删除的记录
 
-    def __init__(self):
-        self.fd, self.filename = tempfile.mkstemp()
+# RichTextXMLHandler 保存的图片数据，以及正文里对图片的引用
+VsData_Image_Data   = re.compile(r'(<image\b[^>]*>\s*<data)>([0-9A-Fa-f]+)</data>')
+VsData_Image_Ref    = re.compile(r'<data blob="([0-9a-f]{40})"/>')
 
-    def __del__(self):
-        self.Close()
+# 数据库读缓存的大小
+VsData_Cache_Entries    = 1024
+VsData_Cache_Bytes      = 8 * 1024 * 1024
 
-    def AppendString(self, str):
-        os.write(self.fd, str)
+# SQLite 数据文件的文件头
+VsData_Sqlite_Magic     = "SQLite format 3\0"
 
-    def Close(self):
-        os.close(self.fd)
-        os.unlink(self.filename)
 
 ############################################################################
 #
-# data format:
-#   version:    xx
-#   magic:      xx
-#   [uuid]:     {type: xx, title: xx, body: xx, xtea: sha1sum}, type = (root, dir, html)
-#   tree:       item = {id: xx, subs: [item *]}
+# VsSqliteStore
+#
+# 以 SQLite 数据库保存的数据文件，提供与 zshelve 相同的字典接口，
+# VsData 的记录对应到以下的表：
+#   info:   version、magic 以及 root 记录
+#   node:   每个结点一行，meta:[uuid] 记录对应 type 等列，subs:[uuid]
+#           记录对应子结点的 parent、pos 两列，pos 为结点在兄弟结点中的位置
+#   body:   [uuid] 记录
+#   blob:   blob:[sha1sum] 记录
+#
+# 保存子结点列表时只更新位置发生变化的结点。
 #
 
-VsData_Format_Version   = 1
-VsData_Format_Magic     = "gumpad_magic_jshcm"
+def VsSqliteIn(value):
+    """str 以 BLOB 形式保存，读出时仍为 str；unicode 以 TEXT 形式保存"""
+    if isinstance(value, str):
+        return sqlite3.Binary(value)
+    return value
 
-VsData_Type_Root    = 1
-VsData_Type_Dir     = 2
-VsData_Type_Html    = 3
 
+def VsSqliteOut(value):
+    if isinstance(value, buffer):
+        return str(value)
+    return value
 
-class VsData:
+
+class VsSqliteStore:
+
+    def __init__(self, filename):
+        # 由 VsData 的锁保证同一时刻只有一个线程访问
+        self.m_conn = sqlite3.connect(filename, check_same_thread=False)
+        self.m_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value BLOB);
+            CREATE TABLE IF NOT EXISTS node (id TEXT PRIMARY KEY, parent TEXT, pos INTEGER,
+                type INTEGER, title, size INTEGER, ctime REAL, mtime REAL, xtea TEXT, attrs BLOB);
+            CREATE INDEX IF NOT EXISTS node_parent ON node (parent, pos);
+            CREATE TABLE IF NOT EXISTS body (id TEXT PRIMARY KEY, body BLOB, blobs TEXT);
+            CREATE TABLE IF NOT EXISTS blob (sha1 TEXT PRIMARY KEY, data BLOB);
+            """)
+        self.m_conn.commit()
+
+    def __Execute__(self, sql, *args):
+        return self.m_conn.execute(sql, args)
+
+    def __One__(self, sql, *args):
+        row = self.m_conn.execute(sql, args).fetchone()
+        if row is None:
+            raise KeyError(args[0])
+        return row
+
+    def __GetInfo__(self, key):
+        return cPickle.loads(str(self.__One__("SELECT value FROM info WHERE key = ?", key)[0]))
+
+    def __SetInfo__(self, key, value):
+        self.__Execute__("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+                         key, sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)))
+
+    def __GetSubs__(self, id):
+        self.__One__("SELECT 1 FROM node WHERE id = ?", id)
+        return [str(i) for i, in self.__Execute__("SELECT id FROM node WHERE parent = ? "
+                                                  "AND type IS NOT NULL ORDER BY pos", id)]
+
+    def __SetSubs__(self, id, subs):
+        """只更新父结点或位置发生变化的子结点"""
+        self.__Execute__("INSERT OR IGNORE INTO node (id) VALUES (?)", id)
+        for i in range(len(subs)):
+            self.__Execute__("INSERT OR IGNORE INTO node (id) VALUES (?)", subs[i])
+            self.__Execute__("UPDATE node SET parent = ?, pos = ? WHERE id = ? "
+                             "AND (parent IS NOT ? OR pos IS NOT ?)", id, i, subs[i], id, i)
+
+    def __GetMeta__(self, id):
+        type, title, size, ctime, mtime, xtea, attrs = self.__One__(
+            "SELECT type, title, size, ctime, mtime, xtea, attrs FROM node "
+            "WHERE id = ? AND type IS NOT NULL", id)
+        meta = {}
+        if attrs is not None:
+            meta.update(cPickle.loads(str(attrs)))
+        meta.update({"type": type, "title": VsSqliteOut(title), "size": size,
+                     "ctime": ctime, "mtime": mtime})
+        if xtea is not None:
+            meta["xtea"] = str(xtea)
+        return meta
+
+    def __SetMeta__(self, id, meta):
+        attrs = dict(meta)
+        for i in ("type", "title", "size", "ctime", "mtime", "xtea"):
+            attrs.pop(i, None)
+        if attrs:
+            attrs = sqlite3.Binary(cPickle.dumps(attrs, cPickle.HIGHEST_PROTOCOL))
+        else:
+            attrs = None
+        # 只更新元数据，保留结点在目录树中的位置
+        self.__Execute__("INSERT OR IGNORE INTO node (id) VALUES (?)", id)
+        self.__Execute__("UPDATE node SET type = ?, title = ?, size = ?, ctime = ?, mtime = ?, "
+                         "xtea = ?, attrs = ? WHERE id = ?",
+                         meta["type"], VsSqliteIn(meta["title"]), meta["size"], meta["ctime"],
+                         meta["mtime"], meta.get("xtea"), attrs, id)
+
+    def __getitem__(self, key):
+        if key in ("version", "magic", "root"):
+            return self.__GetInfo__(key)
+        if key.startswith("subs:"):
+            return self.__GetSubs__(key[5:])
+        if key.startswith("meta:"):
+            return self.__GetMeta__(key[5:])
+        if key.startswith("blob:"):
+            return VsSqliteOut(self.__One__("SELECT data FROM blob WHERE sha1 = ?", key[5:])[0])
+        body, blobs = self.__One__("SELECT body, blobs FROM body WHERE id = ?", key)
+        return {"body": VsSqliteOut(body), "blobs": blobs.split()}
+
+    def __setitem__(self, key, value):
+        if key in ("version", "magic", "root"):
+            self.__SetInfo__(key, value)
+        elif key.startswith("subs:"):
+            self.__SetSubs__(key[5:], value)
+        elif key.startswith("meta:"):
+            self.__SetMeta__(key[5:], value)
+        elif key.startswith("blob:"):
+            self.__Execute__("INSERT OR REPLACE INTO blob (sha1, data) VALUES (?, ?)",
+                             key[5:], sqlite3.Binary(value))
+        else:
+            self.__Execute__("INSERT OR REPLACE INTO body (id, body, blobs) VALUES (?, ?, ?)",
+                             key, VsSqliteIn(value["body"]), " ".join(value.get("blobs", [])))
+
+    def __delitem__(self, key):
+        if key in ("version", "magic", "root"):
+            cursor = self.__Execute__("DELETE FROM info WHERE key = ?", key)
+        elif key.startswith("subs:"):
+            # 子结点已经移走或删除，只需要解除与原父结点的关系
+            self.__Execute__("UPDATE node SET parent = NULL, pos = NULL WHERE parent = ?", key[5:])
+            return
+        elif key.startswith("meta:"):
+            cursor = self.__Execute__("DELETE FROM node WHERE id = ?", key[5:])
+        elif key.startswith("blob:"):
+            cursor = self.__Execute__("DELETE FROM blob WHERE sha1 = ?", key[5:])
+        else:
+            cursor = self.__Execute__("DELETE FROM body WHERE id = ?", key)
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def has_key(self, key):
+        try:
+            if key in ("version", "magic", "root"):
+                self.__One__("SELECT 1 FROM info WHERE key = ?", key)
+            elif key.startswith("subs:"):
+                self.__One__("SELECT 1 FROM node WHERE id = ?", key[5:])
+            elif key.startswith("meta:"):
+                self.__One__("SELECT 1 FROM node WHERE id = ? AND type IS NOT NULL", key[5:])
+            elif key.startswith("blob:"):
+                self.__One__("SELECT 1 FROM blob WHERE sha1 = ?", key[5:])
+            else:
+                self.__One__("SELECT 1 FROM body WHERE id = ?", key)
+        except KeyError:
+            return False
+        return True
+
+    __contains__ = has_key
+
+    def keys(self):
+        keys = []
+        for key, in self.__Execute__("SELECT key FROM info"):
+            keys.append(str(key))
+        for id, in self.__Execute__("SELECT id FROM node"):
+            keys.append("subs:" + str(id))
+        for id, in self.__Execute__("SELECT id FROM node WHERE type IS NOT NULL"):
+            keys.append("meta:" + str(id))
+        for id, in self.__Execute__("SELECT id FROM body"):
+            keys.append(str(id))
+        for sha1sum, in self.__Execute__("SELECT sha1 FROM blob"):
+            keys.append("blob:" + str(sha1sum))
+        return keys
+
+    def sync(self):
+        self.m_conn.commit()
+
+    def upgrade(self):
+        # 记录不经过 pickle，没有需要转换的记录
+        return 0
+
+    def vacuum(self):
+        """重建数据库文件，回收已删除记录占用的空间"""
+        self.m_conn.commit()
+        self.m_conn.execute("VACUUM")
+
+    def close(self):
+        self.m_conn.commit()
+        self.m_conn.close()
+
+
+def VsReplaceFile(src, dst):
+    """用 src 替换 dst。POSIX 上 rename 是原子操作；Windows 上 rename 不能
+    覆盖已有文件，只能先删除 dst
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+############################################################################
+#
+# VsJournal
+#
+# zshelve 的数据文件没有事务，提交时逐条写入记录，中途崩溃会留下只写了
+# 一部分的修改。因此提交时先把整个事务的修改追加到日志文件
+# （数据文件名-journal）并 fsync，之后写入数据文件时不再 sync；日志积累
+# 到一定数量后才 sync 一次数据文件并清空日志（检查点）。
+#
+# 打开数据文件时，重新写入日志里所有完整的事务，不完整的事务（日志末尾
+# 写了一半的记录）直接丢弃，数据文件里不会有它的任何修改。
+#
+# 日志记录格式：长度 (4 字节) | crc32 (4 字节) | pickle 的 [(key, deleted, value) *]
+#
+
+VsJournal_Header            = struct.Struct("!II")
+VsJournal_Checkpoint_Count  = 64                    # 每提交多少个事务做一次检查点
+VsJournal_Checkpoint_Bytes  = 4 * 1024 * 1024       # 日志超过多大时做检查点
+
+
+class VsJournal:
 
     def __init__(self, filename):
         self.m_filename = filename
+        self.m_file = None
+        self.m_count = 0
+        self.m_size = 0
+
+    def GetFileName(self):
+        return self.m_filename
+
+    def Read(self):
+        """读出日志里所有完整的事务，返回 [[(key, deleted, value) *] *]"""
+        records = []
+        if not os.path.exists(self.m_filename):
+            return records
+        f = open(self.m_filename, "rb")
+        try:
+            while True:
+                header = f.read(VsJournal_Header.size)
+                if len(header) < VsJournal_Header.size:
+                    break
+                length, crc = VsJournal_Header.unpack(header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                records.append(cPickle.loads(data))
+        finally:
+            f.close()
+        return records
+
+    def Append(self, changes):
+        """把一个事务的修改 [(key, deleted, value) *] 写入日志，返回时已经写入磁盘"""
+        data = cPickle.dumps(changes, cPickle.HIGHEST_PROTOCOL)
+        if self.m_file is None:
+            self.m_file = open(self.m_filename, "ab")
+        self.m_file.write(VsJournal_Header.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self.m_file.write(data)
+        self.m_file.flush()
+        os.fsync(self.m_file.fileno())
+        self.m_count += 1
+        self.m_size += VsJournal_Header.size + len(data)
+
+    def IsFull(self):
+        return self.m_count >= VsJournal_Checkpoint_Count or self.m_size >= VsJournal_Checkpoint_Bytes
+
+    def Clear(self):
+        """数据文件已经 sync，删除日志"""
+        if self.m_file is not None:
+            self.m_file.close()
+            self.m_file = None
+        if os.path.exists(self.m_filename):
+            os.remove(self.m_filename)
+        self.m_count = 0
+        self.m_size = 0
+
+
+class VsData:
+
+    def __init__(self, filename, codec="zlib", compresslevel=2, backend="shelf"):
+        self.m_filename = filename
+        self.m_codec = codec
+        self.m_compresslevel = compresslevel
+        self.m_meta = {}    # id:meta
+        self.m_root = None  # 常驻内存的目录树
+        self.m_nodes = {}   # id:node
+        self.m_parents = {} # id:parent node，根结点为 None
+        self.m_pending = {} # 当前事务中未提交的写操作 key:value
+        self.m_depth = 0    # 事务嵌套层数
+        self.m_lock = threading.RLock()
+        self.m_journal = None
         bFileExist = os.access(filename, os.R_OK | os.W_OK)
-        self.db = zshelve.btopen(filename)
+        # 已有文件按文件头选择存储后端，新文件由 backend 指定
+        if bFileExist:
+            f = open(filename, "rb")
+            if f.read(len(VsData_Sqlite_Magic)) == VsData_Sqlite_Magic:
+                backend = "sqlite"
+            f.close()
+        if backend == "sqlite":
+            self.db = VsSqliteStore(filename)
+        else:
+            # 新文件使用日志结构存储，已有的 bsddb 文件仍用 btopen 打开
+            if not bFileExist or zshelve.islogfile(filename):
+                shelfopen = zshelve.logopen
+            else:
+                shelfopen = zshelve.btopen
+            self.db = shelfopen(filename, codec=codec, compresslevel=compresslevel,
+                                cachesize=VsData_Cache_Entries, cachebytes=VsData_Cache_Bytes)
+            # SQLite 自身保证提交的原子性，不需要另外的日志
+            self.m_journal = VsJournal(filename + "-journal")
+            if bFileExist:
+                self.__Recover__()
+            else:
+                self.m_journal.Clear()
         if not bFileExist:
             self.__CreateData__()
+        else:
+            self.__UpgradeData__()
+        self.__LoadTree__()
 
     def __CreateData__(self):
+        self.Begin()
         self.SetMagic(VsData_Format_Magic)
         self.SetVersion(VsData_Format_Version)
         id = self.GenerateId()
-        self.db[id] = {"type": VsData_Type_Root, "title": "root", "body": ""}
-        self.db["tree"] = {"id": id, "subs": []}
-        self.db.sync()
-
-    def __GetTree__(self, tree, id):
-        if id == tree["id"]:
-            return None, tree
-        for i in tree["subs"]:
-            parent, t = self.__GetTree__(i, id)
-            if t is not None:
-                if parent is None:
-                    parent = tree
-                return parent, t
-        return None, None
+        self.__NewNode__(id, VsData_Type_Root, "root", "")
+        self.__Put__("root", id)
+        self.__Put__(self.__SubsKey__(id), [])
+        self.Commit()
+
+    def __UpgradeData__(self):
+        """将旧版本的数据文件升级到当前格式"""
+        if not self.__Has__("magic") or self.GetMagic() != VsData_Format_Magic:
+            return
+        version = self.GetVersion()
+        if version >= VsData_Format_Version:
+            return
+
+        if version < 3:
+            # 版本 2 及以前用 pickle 协议 0、1 保存，转换成当前协议
+            self.Upgrade()
+
+        self.Begin()
+        try:
+            if version < 5 and self.__Has__("tree"):
+                # 版本 4：整个目录树保存在 tree 记录里，拆分为各结点的子结点列表
+                tree = self.__Get__("tree")
+                pending = [tree]
+                while pending:
+                    node = pending.pop()
+                    self.__Put__(self.__SubsKey__(node["id"]), [i["id"] for i in node["subs"]])
+                    pending.extend(node["subs"])
+                self.__Put__("root", tree["id"])
+                self.__Del__("tree")
+
+            if version < 2:
+                # 版本 1：{type, title, body, xtea} 存放在同一条记录里，拆分出元数据
+                now = time.time()
+                for id in self.__ListIds__():
+                    if not self.__Has__(id):
+                        continue
+                    old = self.__Get__(id)
+                    meta = {"type": old["type"], "title": old["title"],
+                            "size": len(old["body"]), "ctime": now, "mtime": now}
+                    if old.has_key("xtea"):
+                        meta["xtea"] = old["xtea"]
+                    self.__Put__(self.__MetaKey__(id), meta)
+                    self.__Put__(id, {"body": old["body"]})
+
+            if version < 4:
+                # 版本 3：图片数据保存在正文里，提取到独立的记录
+                for id in self.__ListIds__():
+                    if not self.__Has__(id) or self.__GetMeta__(id).has_key("xtea"):
+                        continue
+                    record = self.__Get__(id)
+                    if not record.has_key("blobs"):
+                        self.__PutBody__(id, record["body"])
+
+            self.SetVersion(VsData_Format_Version)
+        except:
+            self.Rollback()
+            raise
+        self.Commit()
+
+    def __Recover__(self):
+        """重新写入日志里已经提交、但可能还没有写入数据文件的事务"""
+        records = self.m_journal.Read()
+        for changes in records:
+            self.__Apply__(changes)
+        if records:
+            self.db.sync()
+        self.m_journal.Clear()
+
+    def __Apply__(self, changes):
+        """把 [(key, deleted, value) *] 写入数据文件，不 sync"""
+        for key, deleted, value in changes:
+            if deleted:
+                if self.db.has_key(key):
+                    del self.db[key]
+            else:
+                self.db[key] = value
+
+    def __Get__(self, key):
+        with self.m_lock:
+            value = self.m_pending.get(key)
+            if value is None:
+                return self.db[key]
+        if value is VsData_Deleted:
+            raise KeyError(key)
+        return value
+
+    def __Has__(self, key):
+        with self.m_lock:
+            value = self.m_pending.get(key)
+            if value is None:
+                return self.db.has_key(key)
+        return value is not VsData_Deleted
+
+    def __Put__(self, key, value):
+        assert self.m_depth > 0
+        self.m_pending[key] = value
+
+    def __Del__(self, key):
+        assert self.m_depth > 0
+        self.m_pending[key] = VsData_Deleted
+
+    def __ListIds__(self):
+        """从数据库里读出的目录树中，所有结点的 id"""
+        ids = []
+        pending = [self.__Get__("root")]
+        while pending:
+            id = pending.pop()
+            pending.extend(self.__Get__(self.__SubsKey__(id)))
+            ids.append(id)
+        return ids
+
+    def __LoadTree__(self):
+        """读入目录树，并建立 id 到结点、父结点的索引"""
+        self.m_root = {"id": self.__Get__("root"), "subs": []}
+        pending = [self.m_root]
+        while pending:
+            node = pending.pop()
+            for id in self.__Get__(self.__SubsKey__(node["id"])):
+                new = {"id": id, "subs": []}
+                node["subs"].append(new)
+                pending.append(new)
+        self.__IndexTree__()
+
+    def __IndexTree__(self):
+        self.m_nodes = {}
+        self.m_parents = {}
+        self.__IndexNode__(self.m_root, None)
+
+    def __IndexNode__(self, node, parent):
+        pending = [(node, parent)]
+        while pending:
+            node, parent = pending.pop()
+            self.m_nodes[node["id"]] = node
+            self.m_parents[node["id"]] = parent
+            for i in node["subs"]:
+                pending.append((i, node))
+
+    def __UnindexNode__(self, node):
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            del self.m_nodes[node["id"]]
+            del self.m_parents[node["id"]]
+            pending.extend(node["subs"])
+
+    def __SubsKey__(self, id):
+        return "subs:" + id
+
+    def __SaveSubs__(self, node):
+        """保存结点的子结点列表，同一事务里多次修改只写一次"""
+        self.__Put__(self.__SubsKey__(node["id"]), [i["id"] for i in node["subs"]])
+
+    def __MetaKey__(self, id):
+        return "meta:" + id
+
+    def __GetMeta__(self, id):
+        """读取结点的元数据，不涉及正文"""
+        if id is None:
+            id = self.m_root["id"]
+        with self.m_lock:
+            try:
+                return self.m_meta[id]
+            except KeyError:
+                meta = self.__Get__(self.__MetaKey__(id))
+                self.m_meta[id] = meta
+                return meta
+
+    def __SetMeta__(self, id, meta):
+        self.m_meta[id] = meta
+        self.__Put__(self.__MetaKey__(id), meta)
+
+    def __NewNode__(self, id, type, title, body):
+        now = time.time()
+        self.__SetMeta__(id, {"type": type, "title": title,
+                              "size": len(body), "ctime": now, "mtime": now})
+        self.__PutBody__(id, body)
+
+    def __BlobKey__(self, sha1sum):
+        return "blob:" + sha1sum
+
+    def __PutBody__(self, id, body):
+        """保存正文，未加密时把图片提取出来单独存放"""
+        blobs = []
+        if not self.__GetMeta__(id).has_key("xtea"):
+            def extract(m):
+                data = binascii.unhexlify(m.group(2))
+                sha1sum = hashlib.sha1(data).hexdigest()
+                key = self.__BlobKey__(sha1sum)
+                if not self.__Has__(key):
+                    self.__Put__(key, data)
+                blobs.append(sha1sum)
+                return '%s blob="%s"/>' % (m.group(1), sha1sum)
+            body = VsData_Image_Data.sub(extract, body)
+        self.__Put__(id, {"body": body, "blobs": blobs})
+
+    def __GetBodyRecord__(self, id):
+        """读取正文，并还原其中引用的图片"""
+        record = self.__Get__(id)
+        body = record["body"]
+        if record.get("blobs"):
+            def restore(m):
+                data = self.__Get__(self.__BlobKey__(m.group(1)))
+                return "<data>%s</data>" % binascii.hexlify(data).upper()
+            body = VsData_Image_Ref.sub(restore, body)
+        return body
+
+    def Begin(self):
+        """开始一个事务，可以嵌套，只有最外层的 Commit 才真正写入。
+        事务结束前，其它线程不能读写数据库
+        """
+        self.m_lock.acquire()
+        self.m_depth += 1
+
+    def Commit(self):
+        """提交事务：先写日志，再写入所有修改；没有日志时 sync 一次"""
+        assert self.m_depth > 0
+        try:
+            self.m_depth -= 1
+            if self.m_depth > 0:
+                return
+            pending = self.m_pending
+            self.m_pending = {}
+            if not pending:
+                return
+            changes = []
+            for key, value in pending.iteritems():
+                if value is VsData_Deleted:
+                    changes.append((key, True, None))
+                else:
+                    changes.append((key, False, value))
+            if self.m_journal is None:
+                self.__Apply__(changes)
+                self.db.sync()
+                return
+            self.m_journal.Append(changes)
+            self.__Apply__(changes)
+            if self.m_journal.IsFull():
+                self.Checkpoint()
+        finally:
+            self.m_lock.release()
+
+    def Checkpoint(self):
+        """sync 数据文件，清空日志"""
+        with self.m_lock:
+            assert self.m_depth == 0
+            if self.m_journal is None:
+                return
+            self.db.sync()
+            self.m_journal.Clear()
+
+    def Rollback(self):
+        """回滚事务：丢弃所有未提交的修改，并恢复内存中的目录树、元数据。
+        在嵌套事务里回滚时，会丢弃整个事务已有的修改
+        """
+        assert self.m_depth > 0
+        try:
+            self.m_depth -= 1
+            self.m_pending = {}
+            self.m_meta = {}
+            self.__LoadTree__()
+        finally:
+            self.m_lock.release()
+
+    @contextlib.contextmanager
+    def Transaction(self):
+        """with db.Transaction(): ...
+        正常结束时提交，发生异常时回滚
+        """
+        self.Begin()
+        try:
+            yield self
+        except:
+            self.Rollback()
+            raise
+        self.Commit()
+
+    def Upgrade(self):
+        """将所有记录转换为当前的 pickle 协议，返回转换的记录数"""
+        assert self.m_depth == 0
+        self.Checkpoint()
+        return self.db.upgrade()
+
+    def __ReachableKeys__(self):
+        """从目录树出发能访问到的所有记录"""
+        keys = ["magic", "version", "root"]
+        blobs = {}
+        for id in self.__ListIds__():
+            keys.extend([self.__MetaKey__(id), self.__SubsKey__(id)])
+            if self.__Has__(id):
+                keys.append(id)
+                for sha1sum in self.__Get__(id).get("blobs", []):
+                    blobs[self.__BlobKey__(sha1sum)] = True
+        keys.extend(blobs.keys())
+        return keys
+
+    def Compact(self, codec=None, compresslevel=None, job=None):
+        """压缩数据文件：丢弃目录树访问不到的记录，回收已删除、被改写的
+        记录占用的空间，返回 (压缩前大小, 压缩后大小)。
+        zshelve 的数据文件逐条复制到新文件，新记录用 codec、compresslevel
+        压缩，完成后替换原文件；SQLite 数据文件删除无用的记录后 VACUUM。
+        执行期间其它线程不能读写数据库
+        """
+        if codec is None:
+            codec = self.m_codec
+        if compresslevel is None:
+            compresslevel = self.m_compresslevel
+        with self.m_lock:
+            assert self.m_depth == 0
+            self.Checkpoint()
+            before = os.path.getsize(self.m_filename)
+            keys = self.__ReachableKeys__()
+            if isinstance(self.db, VsSqliteStore):
+                reachable = dict.fromkeys(keys)
+                with self.Transaction():
+                    for key in self.db.keys():
+                        if not reachable.has_key(key):
+                            self.__Del__(key)
+                self.db.vacuum()
+            else:
+                filename = self.m_filename + "-compact"
+                new = zshelve.logopen(filename, "n", codec=codec, compresslevel=compresslevel)
+                try:
+                    for i in range(len(keys)):
+                        if job is not None:
+                            job.Progress(i, len(keys))
+                        new[keys[i]] = self.db[keys[i]]
+                    new.close()
+                except:
+                    new.close()
+                    os.remove(filename)
+                    raise
+                self.db.close()
+                VsReplaceFile(filename, self.m_filename)
+                self.db = zshelve.logopen(self.m_filename, codec=self.m_codec, compresslevel=self.m_compresslevel,
+                                          cachesize=VsData_Cache_Entries, cachebytes=VsData_Cache_Bytes)
+            self.m_meta = {}
+            self.__LoadTree__()
+            return before, os.path.getsize(self.m_filename)
+
+    def CopyTo(self, dst):
+        """将所有记录复制到另一个数据文件 dst，dst 原有的记录被清除，
+        用于在不同的存储后端之间转换
+        """
+        assert self.m_depth == 0
+        keys = self.db.keys()
+        with dst.Transaction():
+            for key in dst.db.keys():
+                dst.__Del__(key)
+            for key in keys:
+                dst.__Put__(key, self.__Get__(key))
+        dst.m_meta = {}
+        dst.__LoadTree__()
+        return len(keys)
+
+    def Close(self):
+        """关闭数据文件，未提交的事务被丢弃"""
+        with self.m_lock:
+            if self.db is None:
+                return
+            self.m_pending = {}
+            self.m_depth = 0
+            self.db.close()
+            self.db = None
+            if self.m_journal is not None:
+                self.m_journal.Clear()
 
     def GetFileName(self):
         return self.m_filename
 
     def GetVersion(self):
-        return self.db["version"]
+        return self.__Get__("version")
 
     def SetVersion(self, version):
-        self.db["version"] = version
-        self.db.sync()
+        with self.Transaction():
+            self.__Put__("version", version)
 
     def GetMagic(self):
-        return self.db["magic"]
+        return self.__Get__("magic")
 
     def SetMagic(self, magic):
-        self.db["magic"] = magic
-        self.db.sync()
+        with self.Transaction():
+            self.__Put__("magic", magic)
 
     def GetTree(self, parent, id=None):
         """从 parent 往下查找指定 id 的结点，返回 父结点、结点，
         不存在时返回 None
         """
-        if id is None:
+        if id is None or id == parent["id"]:
             return None, parent
-        else:
-            return self.__GetTree__(parent, id)
+        t = self.m_nodes.get(id)
+        if t is None or not self.IsAncestor(parent["id"], id):
+            return None, None
+        return self.m_parents[id], t
+
+    def GetNode(self, id=None):
+        """返回指定 id 的结点，不存在时返回 None"""
+        if id is None:
+            return self.m_root
+        return self.m_nodes.get(id)
+
+    def GetParent(self, id):
+        """返回父结点的 id，根结点或不存在时返回 None"""
+        parent = self.m_parents.get(id)
+        if parent is None:
+            return None
+        return parent["id"]
+
+    def IsAncestor(self, ancestor_id, id):
+        """判断 ancestor_id 是否为 id 的祖先结点（或其本身）"""
+        node = self.m_nodes.get(id)
+        while node is not None:
+            if node["id"] == ancestor_id:
+                return True
+            node = self.m_parents[node["id"]]
+        return False
 
     def GetRoot(self):
-        return self.db["tree"]
+        return self.m_root
 
     def SetRoot(self, dir_tree):
         """更新目录树"""
@@ -186,25 +910,70 @@ class VsData:
                 self.set_root_last_node.append(new)
 
         assert self.set_root_tree_root is not None
-        self.db["tree"] = self.set_root_tree_root
-        self.db.sync()
+        with self.Transaction():
+            # 只保存子结点列表发生变化的结点
+            old = self.m_nodes
+            self.m_root = self.set_root_tree_root
+            self.__IndexTree__()
+            for id, node in self.m_nodes.iteritems():
+                subs = [i["id"] for i in node["subs"]]
+                if id not in old or subs != [i["id"] for i in old[id]["subs"]]:
+                    self.__SaveSubs__(node)
+
+    def Move(self, id, parent_id, index=None):
+        """将结点连同子结点移动到 parent_id 之下，作为第 index 个子结点，
+        index 为 None 时添加到最后。只改写新、旧父结点的子结点列表。
+        成功时返回 True，失败时返回 False
+        """
+        t = self.GetNode(id)
+        if t is None or id == self.m_root["id"]:
+            return False
+        new_parent = self.GetNode(parent_id)
+        if new_parent is None or self.IsAncestor(id, new_parent["id"]):
+            return False
+
+        with self.Transaction():
+            parent = self.m_parents[id]
+            for i in range(len(parent["subs"])):
+                if parent["subs"][i] is t:
+                    del parent["subs"][i]
+                    break
+            if index is None or index > len(new_parent["subs"]):
+                index = len(new_parent["subs"])
+            new_parent["subs"].insert(index, t)
+            self.m_parents[id] = new_parent
+            self.__SaveSubs__(parent)
+            if new_parent is not parent:
+                self.__SaveSubs__(new_parent)
+        return True
 
     def GenerateId(self):
         return str(uuid.uuid1())
 
     def Add(self, title, body, parent_id=None, type=None):
-        root = self.db["tree"]
-        dummy, t = self.GetTree(root, parent_id)
         if type is None:
             type = VsData_Type_Html
         elif type not in (VsData_Type_Dir, VsData_Type_Html):
             type = VsData_Type_Dir
-        new_id = self.GenerateId()
-        t["subs"].append({"id": new_id, "subs": []})
-        self.db["tree"] = root
-        self.db[new_id] = {"type": type, "title": title, "body": body}
-        self.db.sync()
-        return new_id
+        return self.AddMany([(title, body, type)], parent_id)[0]
+
+    def AddMany(self, items, parent_id=None):
+        """在 parent_id 结点下依次添加多个结点，items 为 [(title, body, type) *]，
+        父结点的子结点列表只写一次；返回新结点的 id 列表
+        """
+        ids = []
+        with self.Transaction():
+            t = self.GetNode(parent_id)
+            for title, body, type in items:
+                new_id = self.GenerateId()
+                new = {"id": new_id, "subs": []}
+                t["subs"].append(new)
+                self.__IndexNode__(new, t)
+                self.__SaveSubs__(new)
+                self.__NewNode__(new_id, type, title, body)
+                ids.append(new_id)
+            self.__SaveSubs__(t)
+        return ids
 
     def Delete(self, id):
         """删除指定Id的叶子结点，根结点除外
@@ -212,78 +981,111 @@ class VsData:
         """
         if id is None:
             return False
-        root = self.db["tree"]
-        if id == root["id"]:
+        if id == self.m_root["id"]:
             return False
-        parent, t = self.GetTree(root, id)
+        t = self.GetNode(id)
         if t is None:
             return False
         if len(t["subs"]) != 0:
             return False
 
-        # 删除关系记录
-        for i in range(len(parent["subs"])):
-            if id == parent["subs"][i]["id"]:
-                del parent["subs"][i]
-                break
-        self.db["tree"] = root
-
-        # 删除结点记录
-        if id in self.db:
-            del self.db[id]
-        self.db.sync()
+        with self.Transaction():
+            # 删除关系记录
+            parent = self.m_parents[id]
+            for i in range(len(parent["subs"])):
+                if parent["subs"][i] is t:
+                    del parent["subs"][i]
+                    break
+            self.__UnindexNode__(t)
+            self.__SaveSubs__(parent)
+
+            # 删除结点记录
+            if self.__Has__(id):
+                self.__Del__(id)
+            key = self.__SubsKey__(id)
+            if self.__Has__(key):
+                self.__Del__(key)
+            key = self.__MetaKey__(id)
+            if self.__Has__(key):
+                self.__Del__(key)
+            if self.m_meta.has_key(id):
+                del self.m_meta[id]
 
     def GetTitle(self, id=None):
-        if id is None:
-            id = self.db["tree"]["id"]
-        return self.db[id]["title"]
+        return self.__GetMeta__(id)["title"]
 
     def SetTitle(self, id, title):
         if id is None:
-            id = self.db["tree"]["id"]
-        t = self.db[id]
-        t["title"] = title
-        self.db[id] = t
-        self.db.sync()
+            id = self.m_root["id"]
+        with self.Transaction():
+            meta = dict(self.__GetMeta__(id))
+            meta["title"] = title
+            self.__SetMeta__(id, meta)
 
     def GetBody(self, id=None):
         if id is None:
-            id = self.db["tree"]["id"]
-        return self.db[id]["body"]
+            id = self.m_root["id"]
+        return self.__GetBodyRecord__(id)
 
     def SetBody(self, id, body):
         if id is None:
-            id = self.db["tree"]["id"]
-        t = self.db[id]
-        t["body"] = body
-        self.db[id] = t
-        self.db.sync()
+            id = self.m_root["id"]
+        with self.Transaction():
+            meta = dict(self.__GetMeta__(id))
+            meta["size"] = len(body)
+            meta["mtime"] = time.time()
+            self.__SetMeta__(id, meta)
+            self.__PutBody__(id, body)
 
     def GetType(self, id=None):
+        return self.__GetMeta__(id)["type"]
+
+    def GetSize(self, id=None):
+        """正文的长度，不需要读取正文"""
+        return self.__GetMeta__(id)["size"]
+
+    def GetTime(self, id=None):
+        """返回 (创建时间, 修改时间)"""
+        meta = self.__GetMeta__(id)
+        return meta["ctime"], meta["mtime"]
+
+    def IsExpanded(self, id=None):
+        """目录树中的结点是否展开，根结点默认展开"""
         if id is None:
-            id = self.db["tree"]["id"]
-        return self.db[id]["type"]
+            id = self.m_root["id"]
+        return self.__GetMeta__(id).get("expanded", id == self.m_root["id"])
+
+    def SetExpanded(self, id, expanded):
+        """记录结点的展开状态，状态不变时不写入"""
+        if id is None:
+            id = self.m_root["id"]
+        if self.IsExpanded(id) == expanded:
+            return
+        with self.Transaction():
+            meta = dict(self.__GetMeta__(id))
+            meta["expanded"] = expanded
+            self.__SetMeta__(id, meta)
 
     def SetXtea(self, id, key):
         assert not self.HasXtea(id)
-        t = self.db[id]
-        t["xtea"] = hashlib.sha1(key).hexdigest()
-        self.db[id] = t
-        self.db.sync()
+        with self.Transaction():
+            meta = dict(self.__GetMeta__(id))
+            meta["xtea"] = hashlib.sha1(key).hexdigest()
+            self.__SetMeta__(id, meta)
 
     def ClearXtea(self, id):
         assert self.HasXtea(id)
-        t = self.db[id]
-        del t["xtea"]
-        self.db[id] = t
-        self.db.sync()
+        with self.Transaction():
+            meta = dict(self.__GetMeta__(id))
+            del meta["xtea"]
+            self.__SetMeta__(id, meta)
 
     def HasXtea(self, id):
-        return self.db[id].has_key("xtea")
+        return self.__GetMeta__(id).has_key("xtea")
 
     def CheckXtea(self, id, key):
         assert self.HasXtea(id)
-        return self.db[id]["xtea"] == hashlib.sha1(key).hexdigest()
+        return self.__GetMeta__(id)["xtea"] == hashlib.sha1(key).hexdigest()
 
     def IsEditable(self, id=None):
         """判断指定Id对应的内容是否允许编辑"""
@@ -293,6 +1095,404 @@ class VsData:
         return VsData_Type_Html == t
 
 
+############################################################################
+#
+# VsWorker
+#
+# 后台线程，依次执行耗时的读写、加解密任务，界面线程不会因此停止响应。
+# 任务完成、进度变化都通过 wx.CallAfter 回到界面线程处理。
+#
+
+VsWorker_Chunk_Size = 64 * 1024    # 分块加解密，每块之间报告进度、检查是否取消
+
+
+class VsJobCancelled(Exception):
+    pass
+
+
+class VsJob:
+
+    def __init__(self, func, args, done, progress):
+        self.m_func = func
+        self.m_args = args
+        self.m_done = done
+        self.m_progress = progress
+        self.m_cancelled = False
+
+    def Cancel(self):
+        """请求取消任务，任务在下一次报告进度时结束"""
+        self.m_cancelled = True
+
+    def IsCancelled(self):
+        return self.m_cancelled
+
+    def CheckCancelled(self):
+        if self.m_cancelled:
+            raise VsJobCancelled()
+
+    def Progress(self, value, range):
+        """在后台线程里调用，报告进度，任务已被取消时抛出 VsJobCancelled"""
+        self.CheckCancelled()
+        if self.m_progress is not None:
+            wx.CallAfter(self.m_progress, self, value, range)
+
+    def Run(self):
+        """在后台线程里执行任务，然后在界面线程里调用 done(job, result, error)"""
+        result = None
+        error = None
+        try:
+            self.CheckCancelled()
+            result = self.m_func(self, *self.m_args)
+        except VsJobCancelled:
+            pass
+        except Exception, e:
+            error = e
+        if self.m_done is not None:
+            wx.CallAfter(self.m_done, self, result, error)
+
+
+class VsWorker(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.m_queue = Queue.Queue()
+        self.start()
+
+    def Submit(self, func, args=(), done=None, progress=None):
+        """提交任务，在后台线程里执行 func(job, *args)，返回 VsJob"""
+        job = VsJob(func, args, done, progress)
+        self.m_queue.put(job)
+        return job
+
+    def Stop(self):
+        """执行完已经提交的任务后结束线程"""
+        self.m_queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            job = self.m_queue.get()
+            if job is None:
+                break
+            job.Run()
+
+
+def VsCrypt(passwd, data, job=None):
+    """分块执行 xtea.crypt，结果与一次处理整个 data 相同。
+    xtea.crypt 是 OFB 模式，每块的密钥流接着上一块最后生成的 8 字节
+    （即上一块最后 8 字节的输入与输出的异或）继续生成
+    """
+    kk = hashlib.md5(passwd).digest()
+    iv = "\0" * 8
+    out = []
+    for i in range(0, len(data), VsWorker_Chunk_Size):
+        if job is not None:
+            job.Progress(i, len(data))
+        chunk = data[i:i + VsWorker_Chunk_Size]
+        cc = xtea.crypt(kk, chunk, iv)
+        out.append(cc)
+        iv = "".join([chr(ord(x) ^ ord(y)) for x, y in zip(chunk[-8:], cc[-8:])])
+    return "".join(out)
+
+
+############################################################################
+#
+# VsImport
+#
+# 把文件系统里的目录导入到目录树：子目录对应目录结点，.rtf、.txt 文件对应笔记。
+# 文件在进程池里转换为正文使用的 XML 格式，转换结果分批提交，每批一个事务。
+#
+
+VsImport_Extensions = (".rtf", ".txt")
+VsImport_Batch_Size = 200   # 每个事务提交的笔记数
+VsImport_Chunk_Size = 8     # 每次分给子进程的文件数
+
+
+def VsCreatePool(processes=None):
+    """创建转换文件用的进程池，processes 为 None 时使用 CPU 个数；
+    不支持多进程时返回 None，由调用者在当前线程里转换
+    """
+    try:
+        return multiprocessing.Pool(processes)
+    except (ImportError, OSError, NotImplementedError):
+        return None
+
+
+def VsDecodeText(data):
+    """把文本文件的内容解码为 unicode：有 BOM 时按 BOM，否则依次尝试 UTF-8、本地编码"""
+    if data.startswith(codecs.BOM_UTF8):
+        return data[len(codecs.BOM_UTF8):].decode("utf-8", "replace")
+    if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+        return data.decode("utf-16", "replace")
+    for encoding in ("utf-8", locale.getpreferredencoding()):
+        try:
+            return data.decode(encoding)
+        except (UnicodeError, LookupError):
+            pass
+    return data.decode("latin-1")
+
+
+def VsImportFile(filename):
+    """在子进程里执行：把一个 .rtf 或 .txt 文件转换为正文，
+    返回 (filename, body, error)，转换失败时 body 为 None
+    """
+    try:
+        f = open(filename, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if os.path.splitext(filename)[1].lower() == ".rtf":
+            body = PyRTFParser.RTFToXML(data)
+        else:
+            body = PyRTFParser.TextToXML(VsDecodeText(data))
+        return filename, body, None
+    except Exception, e:
+        return filename, None, str(e)
+
+
+def VsImportTree(db, path, parent_id=None, job=None, processes=None):
+    """把目录 path 导入为 parent_id 下的一个目录结点，返回
+    (新目录结点的 id, 导入的笔记数, [(转换失败的文件, 原因) *])。
+    文件在 processes 个子进程里转换（None 表示 CPU 个数），无法创建进程池时
+    在当前线程里转换；被取消时，已经提交的笔记保留
+    """
+    if isinstance(path, str):
+        path = path.decode(sys.getfilesystemencoding())
+    path = os.path.abspath(path)
+
+    # 遍历目录，父目录总是排在子目录之前
+    dirs = []       # [(目录, 上级目录) *]
+    files = []      # [(文件, 所在目录) *]
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in dirnames:
+            dirs.append((os.path.join(dirpath, name), dirpath))
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in VsImport_Extensions:
+                files.append((os.path.join(dirpath, name), dirpath))
+
+    # 先建立所有的目录结点
+    dir_ids = {}
+    with db.Transaction():
+        dir_ids[path] = db.Add(os.path.basename(path) or path, "", parent_id, VsData_Type_Dir)
+        for dirpath, parent in dirs:
+            dir_ids[dirpath] = db.Add(os.path.basename(dirpath), "", dir_ids[parent], VsData_Type_Dir)
+
+    def Commit(batch):
+        # 同一目录下的笔记一起添加，目录的子结点列表只写一次
+        with db.Transaction():
+            for dir_id, group in itertools.groupby(batch, lambda x: x[0]):
+                db.AddMany([(x[1], x[2], VsData_Type_Html) for x in group], dir_id)
+        return len(batch)
+
+    pool = VsCreatePool(processes)
+    if pool is not None:
+        results = pool.imap(VsImportFile, [i[0] for i in files], VsImport_Chunk_Size)
+    else:
+        results = itertools.imap(VsImportFile, [i[0] for i in files])
+
+    count = 0
+    failures = []
+    batch = []
+    try:
+        for i in range(len(files)):
+            if job is not None:
+                job.Progress(i, len(files))
+            filename, body, error = results.next()
+            if body is None:
+                failures.append((filename, error))
+                continue
+            title = os.path.splitext(os.path.basename(filename))[0]
+            batch.append((dir_ids[files[i][1]], title, body))
+            if len(batch) >= VsImport_Batch_Size:
+                count += Commit(batch)
+                batch = []
+        count += Commit(batch)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return dir_ids[path], count, failures
+
+
+############################################################################
+#
+# VsExport
+#
+# 把目录树导出到文件系统：目录结点对应子目录，笔记对应 .rtf 文件，有子结点的笔记
+# 另外对应一个同名的子目录。正文直接从数据文件读出，在进程池里转换为 RTF。
+# 导出目录里的清单记录每个文件对应正文的 sha1，再次导出时跳过正文没有变化的笔记。
+#
+
+VsExport_Manifest       = ".gumpad2-export"
+VsExport_Batch_Size     = 64    # 每批读出、转换的笔记数，限制同时在内存里的正文
+VsExport_Invalid_Chars  = re.compile(ur'[\\/:*?"<>|\x00-\x1f]')
+
+
+def VsExportName(title, used):
+    """把标题转换为可以用作文件名的名字，与同级已经用过的名字 used 不重复"""
+    name = VsExport_Invalid_Chars.sub(u"_", title).strip().rstrip(u".")
+    if not name:
+        name = u"untitled"
+    base = name
+    n = 2
+    while used.has_key(name.lower()):
+        name = u"%s (%d)" % (base, n)
+        n += 1
+    used[name.lower()] = True
+    return name
+
+
+def VsExportFile(item):
+    """在子进程里执行：把正文转换为 RTF 写入文件，item 为 (filename, body)，
+    返回 (filename, error)
+    """
+    filename, body = item
+    try:
+        PyRTFParser.XMLToRTFFile(body, filename)
+        return filename, None
+    except Exception, e:
+        return filename, str(e)
+
+
+def VsReadManifest(filename):
+    """读入导出清单，返回 {相对文件名: 正文的 sha1}"""
+    manifest = {}
+    if not os.path.exists(filename):
+        return manifest
+    f = open(filename, "rb")
+    try:
+        for line in f:
+            sha1sum, sep, name = line.rstrip("\n").partition("\t")
+            if sep:
+                manifest[name.decode("utf-8")] = sha1sum
+    finally:
+        f.close()
+    return manifest
+
+
+def VsWriteManifest(filename, manifest):
+    """写入导出清单，先写临时文件再替换，中途退出不会留下不完整的清单"""
+    f = open(filename + "-new", "wb")
+    try:
+        for name in sorted(manifest.keys()):
+            f.write("%s\t%s\n" % (manifest[name], name.encode("utf-8")))
+    finally:
+        f.close()
+    VsReplaceFile(filename + "-new", filename)
+
+
+def VsExportTree(db, path, id=None, incremental=True, job=None, processes=None):
+    """把结点 id 导出到目录 path 下，根结点（默认）的子结点直接导出到 path。
+    incremental 为 True 时跳过正文与上次导出时相同的笔记；完整导出后，
+    上次导出的、已经不对应任何笔记的文件被删除。加密的笔记不导出。
+    返回 (写入的文件数, 跳过的文件数, [(失败的文件, 原因) *])
+    """
+    if isinstance(path, str):
+        path = path.decode(sys.getfilesystemencoding())
+    path = os.path.abspath(path)
+
+    # 确定每个结点的文件名，清单里的文件名都是相对 path、以 / 分隔的
+    dirs = []       # [目录 *]
+    notes = []      # [(文件名, 结点 id) *]
+    failures = []
+
+    def Visit(node, parent, used):
+        name = VsExportName(db.GetTitle(node["id"]), used)
+        name = posixpath.join(parent, name)
+        if db.GetType(node["id"]) == VsData_Type_Html:
+            if db.HasXtea(node["id"]):
+                failures.append((name + ".rtf", "encrypted, not exported"))
+            else:
+                notes.append((name + ".rtf", node["id"]))
+        if db.GetType(node["id"]) != VsData_Type_Html or node["subs"]:
+            dirs.append(name)
+            pending.append((node, name))
+        return name
+
+    root = db.GetNode(id)
+    if root is db.GetRoot():
+        scope = u""
+        pending = [(root, u"")]
+    else:
+        pending = []
+        scope = Visit(root, u"", {})
+    while pending:
+        node, name = pending.pop()
+        used = {}
+        for sub in node["subs"]:
+            Visit(sub, name, used)
+
+    def InScope(name):
+        return scope == u"" or name == scope + u".rtf" or name.startswith(scope + u"/")
+
+    def FileName(name):
+        return os.path.join(path, *name.split(u"/"))
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in dirs:
+        if not os.path.isdir(FileName(name)):
+            os.makedirs(FileName(name))
+
+    manifest_path = os.path.join(path, VsExport_Manifest)
+    old = VsReadManifest(manifest_path)
+    manifest = dict(old)
+    written = 0
+    skipped = 0
+    pool = VsCreatePool(processes)
+    try:
+        for i in range(0, len(notes), VsExport_Batch_Size):
+            if job is not None:
+                job.Progress(i, len(notes))
+            # 读出这一批的正文，跳过没有变化的
+            batch = []
+            sha1sums = {}   # 文件名:(相对文件名, sha1)
+            for name, node_id in notes[i:i + VsExport_Batch_Size]:
+                body = db.GetBody(node_id)
+                sha1sum = hashlib.sha1(body).hexdigest()
+                filename = FileName(name)
+                if incremental and old.get(name) == sha1sum and os.path.exists(filename):
+                    skipped += 1
+                    continue
+                batch.append((filename, body))
+                sha1sums[filename] = (name, sha1sum)
+            if pool is not None:
+                results = pool.map(VsExportFile, batch, 1)
+            else:
+                results = map(VsExportFile, batch)
+            for filename, error in results:
+                name, sha1sum = sha1sums[filename]
+                if error is not None:
+                    manifest.pop(name, None)
+                    failures.append((name, error))
+                else:
+                    manifest[name] = sha1sum
+                    written += 1
+
+        # 删除上次导出、已经没有对应笔记的文件，以及因此变空的目录
+        current = dict.fromkeys([i[0] for i in notes])
+        for name in old.keys():
+            if not InScope(name) or current.has_key(name):
+                continue
+            del manifest[name]
+            filename = FileName(name)
+            if os.path.exists(filename):
+                os.remove(filename)
+            dirname = os.path.dirname(filename)
+            while dirname != path and os.path.isdir(dirname) and not os.listdir(dirname):
+                os.rmdir(dirname)
+                dirname = os.path.dirname(dirname)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        VsWriteManifest(manifest_path, manifest)
+    return written, skipped, failures
+
+
 ############################################################################
 #
 # VsConfig
@@ -327,6 +1527,9 @@ ID_Menu_RenameEntry     = VsGenerateMenuId()
 ID_Menu_DeleteEntry     = VsGenerateMenuId()
 ID_Menu_Save            = VsGenerateMenuId()
 ID_Menu_SaveAs          = VsGenerateMenuId()
+ID_Menu_Compact         = VsGenerateMenuId()
+ID_Menu_Import          = VsGenerateMenuId()
+ID_Menu_Export          = VsGenerateMenuId()
 ID_Menu_Exit            = VsGenerateMenuId()
 ID_Menu_Encrypt         = VsGenerateMenuId()
 
@@ -358,6 +1561,9 @@ ID_Ctx_InsertAsChild    = VsGenerateMenuId()
 # VsStatusBar
 #
 
+VsStatusBar_Progress_Width  = 160
+
+
 class VsStatusBar(wx.StatusBar):
 
     def __init__(self, parent):
@@ -372,10 +1578,17 @@ class VsStatusBar(wx.StatusBar):
         # 初始时显示时间
         self.OnTimer()
 
+        # 后台任务的进度条及取消按钮，没有任务时隐藏
+        self.gauge = wx.Gauge(self, -1, 100, style=wx.GA_HORIZONTAL | wx.GA_SMOOTH)
+        self.cancel = wx.Button(self, -1, u"取消", style=wx.BU_EXACTFIT)
+        self.cancel.Bind(wx.EVT_BUTTON, self.OnCancel)
+        self.Bind(wx.EVT_SIZE, self.OnSize)
+
         # 调整控件大小
         width, height = self.GetTextExtent(self.GetStatusText(2))
         width += 48
-        self.SetStatusWidths([0, -1, width])
+        self.time_width = width
+        self.StopProgress()
 
         # 控件时间显示
         self.timer = wx.PyTimer(self.OnTimer)
@@ -387,6 +1600,35 @@ class VsStatusBar(wx.StatusBar):
         str = time.strftime("[%Y-%m-%d %H:%M %A]", t)
         self.SetStatusText(str, 2)
 
+    def OnSize(self, event):
+        rect = self.GetFieldRect(0)
+        width, height = self.cancel.GetBestSize()
+        self.gauge.SetRect(wx.Rect(rect.x + 2, rect.y + 2, rect.width - width - 6, rect.height - 4))
+        self.cancel.SetRect(wx.Rect(rect.x + rect.width - width - 2, rect.y, width, rect.height))
+        event.Skip()
+
+    def OnCancel(self, event):
+        self.GetParent().CancelJobs()
+
+    def StartProgress(self):
+        """有后台任务时显示进度条"""
+        if self.gauge.IsShown():
+            return
+        self.SetStatusWidths([VsStatusBar_Progress_Width, -1, self.time_width])
+        self.gauge.SetValue(0)
+        self.gauge.Show()
+        self.cancel.Show()
+        self.SendSizeEvent()
+
+    def SetProgress(self, value, range):
+        self.gauge.SetRange(max(range, 1))
+        self.gauge.SetValue(min(value, range))
+
+    def StopProgress(self):
+        self.gauge.Hide()
+        self.cancel.Hide()
+        self.SetStatusWidths([0, -1, self.time_width])
+
 
 ############################################################################
 #
@@ -421,6 +1663,17 @@ class VsTreeCtrl(wx.TreeCtrl):
         self.Traverse(test_func, item2)
         return self.result
 
+    def FindItem(self, data):
+        ''' Find the loaded item holding data, using the Traverse function '''
+        self.result = None
+
+        def test_func(node, depth):
+            if self.result is None and self.GetItemPyData(node) == data:
+                self.result = node
+
+        self.Traverse(test_func, self.GetRootItem())
+        return self.result
+
 
 ############################################################################
 #
@@ -435,10 +1688,12 @@ class VsFrame(wx.Frame):
         wx.Frame.__init__(self, parent, id, title, pos, size, style)
         self.Bind(wx.EVT_CLOSE, self.OnCloseWindow)
 
-        self.db = VsData(program_dbpath)
+        self.db = VsData(program_dbpath, program_codec, program_compresslevel, program_backend)
         self.tree = None
-        self.editor_list = []   # [id, ctrl, modified]
+        self.editor_list = []   # [id, ctrl, modified, 最后修改时间, 已保存内容的 sha1]
         self.passwd_map = {}    # id:passwd
+        self.worker = VsWorker()
+        self.job_map = {}       # id:[job *]，正在后台处理的结点
 
         self._mgr = aui.AuiManager()
 
@@ -468,6 +1723,11 @@ class VsFrame(wx.Frame):
         self.Bind(wx.EVT_FIND_NEXT, self.OnFind)
         self.Bind(wx.EVT_FIND_CLOSE, self.OnFindClose)
 
+        # 自动保存
+        self.autosave_timer = wx.PyTimer(self.OnAutoSave)
+        if program_autosave_interval > 0:
+            self.autosave_timer.Start(1000 * program_autosave_interval)
+
     def CreateMenuBar(self):
         """创建菜单"""
         mb = wx.MenuBar()
@@ -484,6 +1744,10 @@ class VsFrame(wx.Frame):
         DoBindMenuHandler(file_menu.Append(ID_Menu_Save, u"保存(&S)\tCtrl-S"), self.OnSave, self.OnMenuUpdateUI)
         DoBindMenuHandler(file_menu.Append(ID_Menu_SaveAs, u"另存为(&A)"), self.OnSaveAs, self.OnMenuUpdateUI)
         file_menu.AppendSeparator()
+        self.Bind(wx.EVT_MENU, self.OnImport, file_menu.Append(ID_Menu_Import, u"导入目录(&I)..."))
+        self.Bind(wx.EVT_MENU, self.OnExport, file_menu.Append(ID_Menu_Export, u"导出目录(&E)..."))
+        self.Bind(wx.EVT_MENU, self.OnCompact, file_menu.Append(ID_Menu_Compact, u"压缩数据文件(&C)"))
+        file_menu.AppendSeparator()
         self.Bind(wx.EVT_MENU, self.OnExit, file_menu.Append(ID_Menu_Exit, u"退出(&X)"))
 
         ope_menu = wx.Menu()
@@ -650,22 +1914,102 @@ class VsFrame(wx.Frame):
             str = "* " + str
         parent.SetPageText(index, str)
 
-    def SaveDirTree(self, tree):
-        self.save_dir_tree = []
-        tree.Traverse(lambda node, path: \
-            self.save_dir_tree.append((tree.GetItemPyData(node), path)),
-            tree.GetRootItem())
-        self.db.SetRoot(self.save_dir_tree)
-
-    def DoSave(self, id, body, encrypt=False):
-        # 原始内容 -->（加密）--> 保存
-        # 加密内容 -->（解密）--> 保存
-        if encrypt or self.db.HasXtea(id):
-            assert self.passwd_map.has_key(id)
-            kk = hashlib.md5(self.passwd_map[id]).digest()
-            cc = xtea.crypt(kk, body)
-            body = cc
-        self.db.SetBody(id, body)
+    def RunJob(self, ids, func, args=(), done=None):
+        """在后台线程里执行 func(job, *args)，完成后在界面线程里调用
+        done(job, result, error)；任务被取消时 result、error 均为 None。
+        ids 为任务涉及的结点，任务完成前这些结点不能删除、加密
+        """
+        def OnProgress(job, value, range):
+            if self:
+                self.GetStatusBar().SetProgress(value, range)
+
+        def OnDone(job, result, error):
+            # 窗口已经关闭
+            if not self:
+                return
+            for id in ids:
+                self.job_map[id].remove(job)
+                if len(self.job_map[id]) == 0:
+                    del self.job_map[id]
+            if len(self.job_map) == 0:
+                self.GetStatusBar().StopProgress()
+            if done is not None:
+                done(job, result, error)
+
+        job = self.worker.Submit(func, args, OnDone, OnProgress)
+        for id in ids:
+            self.job_map.setdefault(id, []).append(job)
+        self.GetStatusBar().StartProgress()
+        return job
+
+    def CancelJobs(self):
+        for jobs in self.job_map.values():
+            for job in jobs:
+                job.Cancel()
+
+    def SerializeView(self, index):
+        """将编辑页的内容序列化为 XML，返回 (内容, sha1)"""
+        s = StringIO.StringIO()
+        handler = wx.richtext.RichTextXMLHandler()
+        handler.SaveStream(self.editor_list[index][1].GetBuffer(), s)
+        body = s.getvalue()
+        return body, hashlib.sha1(body).hexdigest()
+
+    def DoSave(self, items):
+        """在后台加密、保存正文，items 为 [(id, body, sha1) *]，
+        在同一个事务里提交；失败或被取消时恢复修改标记
+        """
+        def Save(job):
+            # 原始内容 -->（加密）--> 保存
+            # 是否加密在后台线程里判断，之前提交的加密、解密任务已经完成
+            bodies = []
+            for id, body, sha1sum in items:
+                if self.db.GetNode(id) is None:
+                    continue
+                if self.db.HasXtea(id):
+                    body = VsCrypt(self.passwd_map[id], body, job)
+                bodies.append((id, body))
+            job.CheckCancelled()
+            with self.db.Transaction():
+                for id, body in bodies:
+                    self.db.SetBody(id, body)
+            return True
+
+        def OnSaved(job, result, error):
+            for id, body, sha1sum in items:
+                for i in range(len(self.editor_list)):
+                    if id != self.editor_list[i][0]:
+                        continue
+                    if result:
+                        self.editor_list[i][4] = sha1sum
+                    else:
+                        self.SetModified(i)
+                        self.UpdateViewTitle(i)
+                    break
+            if error is not None:
+                wx.MessageBox(u"保存失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+
+        self.RunJob([i[0] for i in items], Save, (), OnSaved)
+
+    def OnAutoSave(self):
+        """自动保存：停止编辑一段时间后，把内容确实有变化的编辑页在同一个
+        事务里保存。正在输入的编辑页等到下一次再保存，不会打断输入
+        """
+        now = time.time()
+        items = []
+        for i in range(len(self.editor_list)):
+            id, ctrl, modified, mtime, saved = self.editor_list[i]
+            if not modified or now - mtime < program_autosave_idle:
+                continue
+            if self.job_map.has_key(id):
+                continue
+            body, sha1sum = self.SerializeView(i)
+            self.SetModified(i, False)
+            self.UpdateViewTitle(i)
+            if sha1sum != saved:
+                items.append((id, body, sha1sum))
+        if items:
+            self.DoSave(items)
 
     def OnSave(self, event):
         parent, index, ctrl = self.GetCurrentView()
@@ -682,11 +2026,10 @@ class VsFrame(wx.Frame):
         id = self.editor_list[index][0]
         self.UpdateViewTitle()
 
-        # 保存内容
-        s = StringIO.StringIO()
-        handler = wx.richtext.RichTextXMLHandler()
-        handler.SaveStream(ctrl.GetBuffer(), s)
-        self.DoSave(id, s.getvalue())
+        # 保存内容，与上次保存的相同时不再写入
+        body, sha1sum = self.SerializeView(index)
+        if sha1sum != self.editor_list[index][4]:
+            self.DoSave([(id, body, sha1sum)])
 
     def OnSaveAs(self, event):
         parent, index, ctrl = self.GetCurrentView()
@@ -808,6 +2151,9 @@ class VsFrame(wx.Frame):
         assert index is not None
         assert event.GetEventObject() is ctrl
 
+        # 记录最后修改时间，自动保存据此判断是否已经停止编辑
+        self.editor_list[index][3] = time.time()
+
         if not self.IsModified(index):
             self.SetModified(index, True)
             self.UpdateViewTitle()
@@ -827,6 +2173,10 @@ class VsFrame(wx.Frame):
                 parent.SetSelection(i)
                 return
 
+        # 正在后台处理（读取、加密等），等待完成
+        if self.job_map.has_key(id):
+            return
+
         # 要求输入密码
         encrypted = self.db.HasXtea(id)
         if encrypted:
@@ -837,6 +2187,28 @@ class VsFrame(wx.Frame):
                 return
             self.passwd_map[id] = passwd
 
+        # 在后台读取、解密正文，完成后再创建编辑页
+        def Load(job):
+            body = self.db.GetBody(id)
+            if encrypted:
+                body = VsCrypt(passwd, body, job)
+            return body
+
+        def OnLoaded(job, body, error):
+            if body is not None:
+                self.CreateEditor(id, body)
+                return
+            if encrypted:
+                del self.passwd_map[id]
+            if error is not None:
+                wx.MessageBox(u"读取失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+
+        self.RunJob([id], Load, (), OnLoaded)
+
+    def CreateEditor(self, id, body):
+        """创建编辑页，显示正文"""
+        parent = self.GetNotebook()
+
         # 创建新的编辑页
         ctrl = wx.richtext.RichTextCtrl(parent, style=wx.VSCROLL | wx.HSCROLL | wx.NO_BORDER)
         ctrl.Bind(wx.richtext.EVT_RICHTEXT_CONTENT_INSERTED, self.OnRichtextContentChanged)
@@ -849,28 +2221,20 @@ class VsFrame(wx.Frame):
         ctrl.SetFont(GetDefaultFont())
 
         # 解析正文内容
-        body = self.db.GetBody(id)
-        if encrypted:
-            kk = hashlib.md5(passwd).digest()
-            cc = xtea.crypt(kk, body)
-            body = cc
-
         if len(body) != 0:
-            tmpfile = VsTempFile()
-            tmpfile.AppendString(body)
-
             ctrl.Freeze()
             ctrl.BeginSuppressUndo()
             handler = wx.richtext.RichTextXMLHandler()
-            # Load the XML file via the XML Handler.
+            # Load the XML from memory via the XML Handler, the same way
+            # OnSave writes it, so the (decrypted) body never touches the disk.
             # Note that for XML, the BUFFER is passed.
-            handler.LoadFile(ctrl.GetBuffer(), tmpfile.filename)
+            handler.LoadStream(ctrl.GetBuffer(), StringIO.StringIO(body))
             # Signal the end of changing the control
             ctrl.EndSuppressUndo()
             ctrl.Thaw()
 
         # 更新到内存记录里去
-        self.editor_list.append([id, ctrl, False])
+        self.editor_list.append([id, ctrl, False, 0, hashlib.sha1(body).hexdigest()])
         parent.AddPage(ctrl, self.db.GetTitle(id), select=True)
 
     def OnTreeEndLabelEdit_After(self, item, old_text):
@@ -915,13 +2279,26 @@ class VsFrame(wx.Frame):
         tree = event.GetEventObject()
         source_id = tree.GetItemPyData(self.drag_source)
 
-        # 不允许目标项是源项的子项
-        if tree.ItemIsChildOf(drop_target, self.drag_source):
+        # 不允许目标项是源项的子项，目录树是按需加载的，由数据库判断
+        if self.db.IsAncestor(source_id, tree.GetItemPyData(drop_target)):
             tree.Unselect()
             return
 
         # One of the following methods of inserting will be called...
         def MoveNodes(parent, target):
+            # 移动前先加载目标项的子项，避免移动后重复添加源项
+            self.Tree_LoadChildren(parent)
+
+            # 移动数据库中的结点，只改写新、旧父结点的子结点列表
+            parent_id = tree.GetItemPyData(parent)
+            index = 0
+            if target is not None:
+                target_id = tree.GetItemPyData(target)
+                subs = [i["id"] for i in self.db.GetNode(parent_id)["subs"] if i["id"] != source_id]
+                index = subs.index(target_id) + 1
+            if not self.db.Move(source_id, parent_id, index):
+                return
+
             # 删除源项及子项
             tree.Delete(self.drag_source)
 
@@ -934,17 +2311,10 @@ class VsFrame(wx.Frame):
                 new_item = tree.InsertItemBefore(parent, 0, title, imgidx)
             tree.SetItemPyData(new_item, source_id)
 
-            # 添加子项
-            dummy, t = self.db.GetTree(self.db.GetRoot(), source_id)
-            self.Tree_AddNode(t, new_item)
-
-            # 设置树结点属性
-            tree.ExpandAllChildren(new_item)
+            # 添加子项，恢复展开状态
+            self.Tree_AddNode(self.db.GetNode(source_id), new_item)
             tree.SelectItem(new_item)
 
-            # 保存目录树
-            self.SaveDirTree(tree)
-
         def InsertAsSibling(event):
             MoveNodes(tree.GetItemParent(drop_target), drop_target)
 
@@ -1205,6 +2575,7 @@ class VsFrame(wx.Frame):
             image_index = 0
         else:
             image_index = 1
+        self.Tree_LoadChildren(parent_item)
         child_id = self.db.Add(name, "", parent_id, type)
         child_item = tree.AppendItem(parent_item, name, image_index)
         tree.SetItemPyData(child_item, child_id)
@@ -1228,6 +2599,10 @@ class VsFrame(wx.Frame):
         item = tree.GetSelection()
         id = tree.GetItemPyData(item)
 
+        # 正在后台处理的结点不能删除
+        if self.job_map.has_key(id):
+            return
+
         # 确认删除
         ret = wx.MessageBox(u'确实要删除吗？', u'确认删除', wx.YES_NO | wx.ICON_QUESTION)
         if wx.YES != ret:
@@ -1255,6 +2630,11 @@ class VsFrame(wx.Frame):
         cursel = tree.GetSelection()
         id = tree.GetItemPyData(cursel)
         assert VsData_Type_Html == self.db.GetType(id)
+
+        # 正在后台处理的结点，等待完成
+        if self.job_map.has_key(id):
+            return
+
         if not self.db.HasXtea(id): # 加密
             # 用户输入密码
             p1 = wx.GetPasswordFromUser(message=u"请输入新密码：", caption=u"加密", default_value="", parent=None)
@@ -1270,19 +2650,45 @@ class VsFrame(wx.Frame):
             assert not self.passwd_map.has_key(id)
             self.passwd_map[id] = p1
 
-            # 提交密码散列值、数据
-            self.db.SetXtea(id, p1)
-            self.DoSave(id, self.db.GetBody(id), encrypt=True)
+            # 在后台加密，在同一个事务里提交密码散列值、数据
+            def Encrypt(job):
+                body = VsCrypt(p1, self.db.GetBody(id), job)
+                with self.db.Transaction():
+                    self.db.SetXtea(id, p1)
+                    self.db.SetBody(id, body)
+                return True
+
+            def OnEncrypted(job, result, error):
+                if result:
+                    return
+                del self.passwd_map[id]
+                if error is not None:
+                    wx.MessageBox(u"加密失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+
+            self.RunJob([id], Encrypt, (), OnEncrypted)
         else: # 解密
             # 需要输入旧密码
             p1 = wx.GetPasswordFromUser(message=u"请输入密码：", caption=u"解密", default_value="", parent=None)
             if not self.db.CheckXtea(id, p1):
                 wx.MessageBox(u"密码不正确！", program_name, wx.OK | wx.ICON_ERROR)
                 return
-            self.passwd_map[id] = p1
-            self.DoSave(id, self.db.GetBody(id), encrypt=True)
-            self.db.ClearXtea(id)
-            del self.passwd_map[id]
+
+            # 在后台解密，在同一个事务里清除密码散列值、提交数据
+            def Decrypt(job):
+                body = VsCrypt(p1, self.db.GetBody(id), job)
+                with self.db.Transaction():
+                    self.db.ClearXtea(id)
+                    self.db.SetBody(id, body)
+                return True
+
+            def OnDecrypted(job, result, error):
+                if result:
+                    if self.passwd_map.has_key(id):
+                        del self.passwd_map[id]
+                elif error is not None:
+                    wx.MessageBox(u"解密失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+
+            self.RunJob([id], Decrypt, (), OnDecrypted)
 
     def UserQuitConfirm(self):
         ret = wx.MessageBox(u"内容已经修改但没有保存，确认要继续吗？", u'确认关闭', wx.YES_NO | wx.ICON_QUESTION)
@@ -1301,6 +2707,82 @@ class VsFrame(wx.Frame):
         # 确认关闭，清除相应数据结构
         del self.editor_list[index]
 
+    def OnImport(self, event):
+        """在后台把一个目录下的 .rtf、.txt 文件导入到选中的结点下"""
+        tree = self.GetDirTree()
+        parent_id = tree.GetItemPyData(tree.GetSelection())
+
+        dlg = wx.DirDialog(self, u"选择要导入的目录", style=wx.DD_DEFAULT_STYLE | wx.DD_DIR_MUST_EXIST)
+        if dlg.ShowModal() != wx.ID_OK:
+            dlg.Destroy()
+            return
+        path = dlg.GetPath()
+        dlg.Destroy()
+
+        def Import(job):
+            return VsImportTree(self.db, path, parent_id, job)
+
+        def OnImported(job, result, error):
+            # 被取消或出错时，已经提交的部分也要显示出来
+            item = tree.FindItem(parent_id)
+            if item is not None:
+                self.Tree_LoadChildren(item)
+                tree.Expand(item)
+            if error is not None:
+                wx.MessageBox(u"导入失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+            elif result is not None:
+                new_id, count, failures = result
+                message = u"导入了 %d 篇笔记。" % count
+                if failures:
+                    message += u"\n以下 %d 个文件转换失败：\n" % len(failures)
+                    message += u"\n".join([i[0] for i in failures[:10]])
+                wx.MessageBox(message, program_name, wx.OK | wx.ICON_INFORMATION)
+
+        self.RunJob([parent_id], Import, (), OnImported)
+
+    def OnExport(self, event):
+        """在后台把选中的结点及其子结点导出为目录、.rtf 文件，只写入有变化的笔记"""
+        tree = self.GetDirTree()
+        id = tree.GetItemPyData(tree.GetSelection())
+
+        dlg = wx.DirDialog(self, u"选择导出到的目录", style=wx.DD_DEFAULT_STYLE)
+        if dlg.ShowModal() != wx.ID_OK:
+            dlg.Destroy()
+            return
+        path = dlg.GetPath()
+        dlg.Destroy()
+
+        def Export(job):
+            return VsExportTree(self.db, path, id, True, job)
+
+        def OnExported(job, result, error):
+            if error is not None:
+                wx.MessageBox(u"导出失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+            elif result is not None:
+                written, skipped, failures = result
+                message = u"导出了 %d 篇笔记，%d 篇没有变化。" % (written, skipped)
+                if failures:
+                    message += u"\n以下 %d 篇笔记没有导出：\n" % len(failures)
+                    message += u"\n".join([i[0] for i in failures[:10]])
+                wx.MessageBox(message, program_name, wx.OK | wx.ICON_INFORMATION)
+
+        self.RunJob([id], Export, (), OnExported)
+
+    def OnCompact(self, event):
+        """在后台压缩数据文件，完成后报告回收的空间"""
+        def Compact(job):
+            return self.db.Compact(program_codec, program_compresslevel, job)
+
+        def OnCompacted(job, result, error):
+            if error is not None:
+                wx.MessageBox(u"压缩失败：%s" % error, program_name, wx.OK | wx.ICON_ERROR)
+            elif result is not None:
+                before, after = result
+                wx.MessageBox(u"压缩完成，回收了 %d 字节（%d -> %d）。" % (before - after, before, after),
+                              program_name, wx.OK | wx.ICON_INFORMATION)
+
+        self.RunJob([], Compact, (), OnCompacted)
+
     def OnExit(self, event):
         self.Close(False)
 
@@ -1319,7 +2801,12 @@ class VsFrame(wx.Frame):
                 event.Veto()
                 return
 
-        # 退出
+        # 等待后台任务完成，退出
+        self.autosave_timer.Stop()
+        busy = wx.BusyCursor()
+        self.worker.Stop()
+        del busy
+        self.db.Close()
         self.Destroy()
 
     def OnAbout(self, event):
@@ -1337,7 +2824,23 @@ class VsFrame(wx.Frame):
         wx.AboutBox(info)
 
     def Tree_AddNode(self, db_node, node):
-        for i in range(len(db_node["subs"])):
+        """按需加载：有子结点的项只加上展开按钮，展开时才添加子项；
+        上次展开的结点在这里直接展开
+        """
+        if len(db_node["subs"]) == 0:
+            return
+        if not self.db.IsExpanded(db_node["id"]):
+            self.tree.SetItemHasChildren(node, True)
+            return
+        self.Tree_LoadChildren(node)
+        self.tree.Expand(node)
+
+    def Tree_LoadChildren(self, node):
+        """添加尚未加载的子项：已加载的子项与数据库里的子结点列表开头的部分一致，
+        新添加的结点（如导入的目录）都在列表末尾
+        """
+        db_node = self.db.GetNode(self.tree.GetItemPyData(node))
+        for i in range(self.tree.GetChildrenCount(node, False), len(db_node["subs"])):
             child_id = db_node["subs"][i]["id"]
             imgidx = self.GetDirTreeImageIndexByType(self.db.GetType(child_id))
             n = self.tree.AppendItem(node, self.db.GetTitle(child_id), imgidx)
@@ -1345,10 +2848,19 @@ class VsFrame(wx.Frame):
 
             self.Tree_AddNode(db_node["subs"][i], n)
 
+    def OnTreeItemExpanding(self, event):
+        self.Tree_LoadChildren(event.GetItem())
+
+    def OnTreeItemExpanded(self, event):
+        self.db.SetExpanded(self.tree.GetItemPyData(event.GetItem()), True)
+
+    def OnTreeItemCollapsed(self, event):
+        self.db.SetExpanded(self.tree.GetItemPyData(event.GetItem()), False)
+
     def CreateTreeCtrl(self):
 
         self.tree = VsTreeCtrl(self, -1, wx.Point(0, 0), wx.Size(200, 250),
-                           wx.TR_DEFAULT_STYLE | wx.NO_BORDER | wx.TR_EDIT_LABELS | wx.TR_NO_BUTTONS)
+                           wx.TR_DEFAULT_STYLE | wx.NO_BORDER | wx.TR_EDIT_LABELS)
 
         imglist = wx.ImageList(16, 16, True, 2)
         imglist.Add(wx.ArtProvider.GetBitmap(wx.ART_FOLDER, wx.ART_OTHER, wx.Size(16, 16)))
@@ -1361,12 +2873,14 @@ class VsFrame(wx.Frame):
         self.tree.SetItemPyData(root, db_root["id"])
 
         self.Tree_AddNode(db_root, root)
-        self.tree.ExpandAllChildren(root)
         self.tree.SelectItem(root)
 
         self.tree.Bind(wx.EVT_RIGHT_DOWN, self.OnRightDown)
         self.tree.Bind(wx.EVT_RIGHT_UP, self.OnRightUp)
         self.tree.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self.OnTreeItemActivated)
+        self.tree.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnTreeItemExpanding)
+        self.tree.Bind(wx.EVT_TREE_ITEM_EXPANDED, self.OnTreeItemExpanded)
+        self.tree.Bind(wx.EVT_TREE_ITEM_COLLAPSED, self.OnTreeItemCollapsed)
         self.tree.Bind(wx.EVT_TREE_END_LABEL_EDIT, self.OnTreeEndLabelEdit)
         self.tree.Bind(wx.EVT_TREE_BEGIN_DRAG, self.OnTreeBeginDrag)
         self.tree.Bind(wx.EVT_TREE_END_DRAG, self.OnTreeEndDrag)
@@ -1404,16 +2918,33 @@ class MyApp(wx.App):
 
 def main():
     global program_dbpath
+    global program_codec
+    global program_compresslevel
+    global program_backend
+    global program_autosave_interval
+    global program_autosave_idle
+
+    # 打包成可执行文件时，导入用的子进程从这里开始
+    multiprocessing.freeze_support()
 
     # 本地化设置
     locale.setlocale(locale.LC_ALL, '')
 
     # 命令行参数解析
-    usage = program_name + " [-f <file>] [-h] [-v]"
+    usage = program_name + " [-f <file>] [-z <codec>[:<level>]] [-b <backend>] [-c <file>] [-a <seconds>] [-i <seconds>] [-m <dir>] [-e <dir>] [-k] [-u] [-h] [-v]"
     program_dbpath = os.path.join(os.path.expanduser("~"), program_dbpath)
     parser = optparse.OptionParser(usage)
     parser.add_option("-v", "--version", action="store_true", dest="version", default=False, help="print the version number of the executable and exit")
     parser.add_option("-f", "--file", action="store", type="string", dest="file", default=program_dbpath, help="specify the data file")
+    parser.add_option("-z", "--compress", action="store", type="string", dest="compress", default="%s:%d" % (program_codec, program_compresslevel), help="compress new records with codec (%s) at level" % ", ".join(zshelve.codecs()))
+    parser.add_option("-b", "--backend", action="store", type="choice", dest="backend", choices=["shelf", "sqlite"], default=program_backend, help="store new data files with backend (shelf, sqlite)")
+    parser.add_option("-c", "--convert", action="store", type="string", dest="convert", default=None, help="copy the data file to a new file stored with the backend given by -b, and exit")
+    parser.add_option("-a", "--autosave", action="store", type="int", dest="autosave", default=program_autosave_interval, help="check for notes to autosave every SECONDS, 0 to disable (default %d)" % program_autosave_interval, metavar="SECONDS")
+    parser.add_option("-i", "--idle", action="store", type="int", dest="idle", default=program_autosave_idle, help="autosave a note only after SECONDS without editing (default %d)" % program_autosave_idle, metavar="SECONDS")
+    parser.add_option("-m", "--import", action="store", type="string", dest="importdir", default=None, help="import the .rtf and .txt files under DIR into the data file as a new directory, and exit", metavar="DIR")
+    parser.add_option("-e", "--export", action="store", type="string", dest="exportdir", default=None, help="export the tree to DIR as folders and .rtf files, rewriting only notes changed since the last export, and exit", metavar="DIR")
+    parser.add_option("-k", "--compact", action="store_true", dest="compact", default=False, help="compact the data file, recompressing records with -z, and exit")
+    parser.add_option("-u", "--upgrade", action="store_true", dest="upgrade", default=False, help="upgrade the data file to the current storage format and exit")
 
     options, args = parser.parse_args(sys.argv[1:])
 
@@ -1425,6 +2956,18 @@ def main():
         parser.print_help()
         return
 
+    # 解析压缩算法及压缩级别
+    codec, sep, level = options.compress.partition(":")
+    if codec not in zshelve.codecs() or (sep and not level.isdigit()):
+        print "Error: " + options.compress + " is not a valid compression setting"
+        return
+    program_codec = codec
+    if level:
+        program_compresslevel = int(level)
+    program_backend = options.backend
+    program_autosave_interval = max(options.autosave, 0)
+    program_autosave_idle = max(options.idle, 0)
+
     # 解析用户指定文件是否有效
     program_dbpath = os.path.expanduser(options.file)
     if not os.path.isabs(program_dbpath):
@@ -1450,15 +2993,68 @@ def main():
 
         # 如果不是有效的数据库，则退出
         try:
-            db = VsData(program_dbpath)
+            db = VsData(program_dbpath, program_codec, program_compresslevel, program_backend)
             assert db.GetMagic() == VsData_Format_Magic
             if db.GetVersion() > VsData_Format_Version:
                 print "Error: " + options.file + " has version (%d), higher than the executable (%d)" % (db.GetVersion(), VsData_Format_Version)
+                db.Close()
                 return
         except:
             print "Error: " + options.file + " exists but corrupted"
             return
 
+        # 升级数据文件
+        if options.upgrade:
+            print "%s: %d record(s) upgraded" % (options.file, db.Upgrade())
+            db.Close()
+            return
+
+        # 压缩数据文件
+        if options.compact:
+            before, after = db.Compact(program_codec, program_compresslevel)
+            print "%s: %d bytes reclaimed (%d -> %d)" % (options.file, before - after, before, after)
+            db.Close()
+            return
+
+        # 导出目录树
+        if options.exportdir:
+            written, skipped, failures = VsExportTree(db, options.exportdir)
+            for filename, error in failures:
+                print "%s: %s" % (filename.encode(locale.getpreferredencoding(), "replace"), error)
+            print "%s: %d note(s) exported to %s, %d unchanged" % (options.file, written, options.exportdir, skipped)
+            db.Close()
+            return
+
+        # 转换为另一种存储后端
+        if options.convert:
+            dstpath = os.path.expanduser(options.convert)
+            if os.path.exists(dstpath):
+                print "Error: " + options.convert + " already exists"
+                db.Close()
+                return
+            dst = VsData(dstpath, program_codec, program_compresslevel, program_backend)
+            print "%s: %d record(s) copied to %s" % (options.file, db.CopyTo(dst), options.convert)
+            dst.Close()
+            db.Close()
+            return
+        db.Close()
+    elif options.convert or options.exportdir:
+        print "Error: " + options.file + " does not exist"
+        return
+
+    # 导入目录
+    if options.importdir:
+        if not os.path.isdir(options.importdir):
+            print "Error: " + options.importdir + " is not a directory"
+            return
+        db = VsData(program_dbpath, program_codec, program_compresslevel, program_backend)
+        new_id, count, failures = VsImportTree(db, options.importdir)
+        for filename, error in failures:
+            print "%s: %s" % (filename.encode(locale.getpreferredencoding(), "replace"), error)
+        print "%s: %d note(s) imported from %s" % (options.file, count, options.importdir)
+        db.Close()
+        return
+
     # 启动程序界面
     app = MyApp()
     app.MainLoop()
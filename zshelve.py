@@ -59,9 +59,9 @@ the persistent dictionary on disk, if feasible).
 # Try using cPickle and cStringIO if available.
 
 try:
-    from cPickle import Pickler, Unpickler
+    from cPickle import Pickler, Unpickler, HIGHEST_PROTOCOL
 except ImportError:
-    from pickle import Pickler, Unpickler
+    from pickle import Pickler, Unpickler, HIGHEST_PROTOCOL
 
 try:
     from cStringIO import StringIO
@@ -71,9 +71,120 @@ except ImportError:
 import UserDict
 import warnings
 import zlib        ## use zlib to compress dbfile
+import bz2
+import os
+import errno
+import struct
+import bisect
+import __builtin__
 
-__version__ = "0.0.1"
-__all__ = ["Shelf","BsdDbShelf","DbfilenameShelf","open"]
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+__version__ = "0.0.4"
+__all__ = ["Shelf","BsdDbShelf","DbfilenameShelf","open","codecs",
+           "LogDB","LogShelf","logopen","islogfile"]
+
+## Every value starts with a one-byte header recording the pickle protocol
+## it was dumped with: chr(_PROTOCOL_TAG | protocol), followed by a one-byte
+## codec tag (see _CODECS) and the encoded pickle.  Values written by
+## zshelve 0.0.1 have no header at all, and values written by 0.0.2 have no
+## codec tag; both start with a zlib stream, whose first byte always has 8
+## (deflate) in its low nibble, so none of the formats can be confused.
+_PROTOCOL_TAG = 0x80
+
+def _protocol_of(data):
+    """Return the pickle protocol of a stored value, None if unknown."""
+    c = ord(data[0])
+    if c & 0xf0 == _PROTOCOL_TAG:
+        return c & 0x0f
+    return None
+
+## codec name: (tag, compress(data, level), decompress(data))
+_CODECS = {
+    "raw":  ('\x00', lambda data, level: data, lambda data: data),
+    "zlib": ('\x01', zlib.compress, zlib.decompress),
+    "bz2":  ('\x02', lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+}
+if lzma is not None:
+    _CODECS["lzma"] = ('\x03', lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+
+_DECOMPRESSORS = dict([(tag, decompress) for tag, compress, decompress in _CODECS.values()])
+
+def codecs():
+    """Return the names of the available compression codecs."""
+    return sorted(_CODECS.keys())
+
+## LogDB file format, see LogDB
+_LOG_MAGIC = "ZSHELVE-LOG\n\x00\x01"
+_LOG_HEADER = struct.Struct("!III")
+_LOG_DELETED = 0xffffffff
+
+class _LRUCache:
+    """Least recently used cache of decoded values.
+
+    Bounded both by the number of entries and by the total size, in
+    bytes, of the pickles the values were decoded from; a limit of 0
+    disables that bound.  Entries live in a circular doubly linked list
+    of [prev, next, key, value, size] links, least recently used first.
+    """
+
+    def __init__(self, maxentries, maxbytes):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.map = {}
+        self.bytes = 0
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, key):
+        try:
+            link = self.map[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self._unlink(link)
+        self._link(link)
+        return link[3]
+
+    def put(self, key, value, size):
+        self.discard(key)
+        if self.maxbytes and size > self.maxbytes:
+            return
+        link = [None, None, key, value, size]
+        self._link(link)
+        self.map[key] = link
+        self.bytes += size
+        while (self.maxentries and len(self.map) > self.maxentries) or \
+              (self.maxbytes and self.bytes > self.maxbytes):
+            self.discard(self.root[1][2])
+
+    def discard(self, key):
+        link = self.map.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.bytes -= link[4]
+
+    def _link(self, link):
+        root = self.root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
 
 class Shelf(UserDict.DictMixin):
     """Base class for shelf implementations.
@@ -82,14 +193,23 @@ class Shelf(UserDict.DictMixin):
     See the module's __doc__ string for an overview of the interface.
     """
 
-    def __init__(self, dict, protocol=None, writeback=False, compresslevel=2):
+    def __init__(self, dict, protocol=None, writeback=False, compresslevel=2,
+                 codec="zlib", threshold=64, cachesize=0, cachebytes=0):
         self.dict = dict
-        if protocol is None:
-            protocol = 0
+        if protocol is None or protocol < 0:
+            protocol = HIGHEST_PROTOCOL
         self._protocol = protocol
         self.writeback = writeback
         self.cache = {}
+        ## read cache, only used when a limit is given
+        self.lru = None
+        if cachesize or cachebytes:
+            self.lru = _LRUCache(cachesize, cachebytes)
+        if codec not in _CODECS:
+            raise ValueError("unknown codec %r" % (codec,))
+        self.codec = codec
         self.compresslevel = compresslevel
+        self.threshold = threshold
 
     def keys(self):
         return self.dict.keys()
@@ -108,12 +228,49 @@ class Shelf(UserDict.DictMixin):
             return self[key]
         return default
 
+    def _encode(self, value):
+        f = StringIO()
+        p = Pickler(f, self._protocol)
+        p.dump(value)
+        data = f.getvalue()
+        ## small values aren't worth compressing
+        tag = '\x00'
+        if len(data) >= self.threshold:
+            codec_tag, compress, decompress = _CODECS[self.codec]
+            packed = compress(data, self.compresslevel)
+            if len(packed) < len(data):
+                tag, data = codec_tag, packed
+        return chr(_PROTOCOL_TAG | self._protocol) + tag + data
+
+    def _unpack(self, data):
+        """Return the pickle held in a stored value."""
+        if _protocol_of(data) is not None:
+            data = data[1:]
+        try:
+            decompress = _DECOMPRESSORS[data[0]]
+            data = data[1:]
+        except KeyError:
+            if ord(data[0]) & 0x0f != 8:
+                raise ValueError("unknown codec tag %r" % (data[0],))
+            decompress = zlib.decompress
+        return decompress(data)
+
+    def _decode(self, data):
+        return Unpickler(StringIO(self._unpack(data))).load()
+
     def __getitem__(self, key):
         try:
             value = self.cache[key]
         except KeyError:
-            f = StringIO(zlib.decompress(self.dict[key]))
-            value = Unpickler(f).load()
+            if self.lru is None:
+                value = self._decode(self.dict[key])
+            else:
+                try:
+                    value = self.lru.get(key)
+                except KeyError:
+                    data = self._unpack(self.dict[key])
+                    value = Unpickler(StringIO(data)).load()
+                    self.lru.put(key, value, len(data))
             if self.writeback:
                 self.cache[key] = value
         return value
@@ -121,18 +278,25 @@ class Shelf(UserDict.DictMixin):
     def __setitem__(self, key, value):
         if self.writeback:
             self.cache[key] = value
-        f = StringIO()
-        p = Pickler(f, self._protocol)
-        p.dump(value)
-        self.dict[key] = zlib.compress(f.getvalue(), self.compresslevel)
+        if self.lru is not None:
+            self.lru.discard(key)
+        self.dict[key] = self._encode(value)
 
     def __delitem__(self, key):
+        if self.lru is not None:
+            self.lru.discard(key)
         del self.dict[key]
         try:
             del self.cache[key]
         except KeyError:
             pass
 
+    def cache_info(self):
+        """Return (hits, misses, entries, bytes) of the read cache."""
+        if self.lru is None:
+            return (0, 0, 0, 0)
+        return (self.lru.hits, self.lru.misses, len(self.lru), self.lru.bytes)
+
     def close(self):
         self.sync()
         try:
@@ -140,6 +304,8 @@ class Shelf(UserDict.DictMixin):
         except AttributeError:
             pass
         self.dict = 0
+        if self.lru is not None:
+            self.lru.clear()
 
     def __del__(self):
         if not hasattr(self, 'writeback'):
@@ -147,6 +313,25 @@ class Shelf(UserDict.DictMixin):
             return
         self.close()
 
+    def protocol(self, key):
+        """Return the pickle protocol the value at key was stored with,
+        or None for values written before the protocol was recorded."""
+        return _protocol_of(self.dict[key])
+
+    def upgrade(self):
+        """Rewrite, in place, every value not stored with this shelf's
+        pickle protocol.  Old values stay readable whether or not this
+        is called.  Return the number of values rewritten."""
+        count = 0
+        for key in self.dict.keys():
+            data = self.dict[key]
+            if _protocol_of(data) != self._protocol:
+                self.dict[key] = self._encode(self._decode(data))
+                count += 1
+        if count and hasattr(self.dict, 'sync'):
+            self.dict.sync()
+        return count
+
     def sync(self):
         if self.writeback and self.cache:
             self.writeback = False
@@ -171,33 +356,30 @@ class BsdDbShelf(Shelf):
     See the module's __doc__ string for an overview of the interface.
     """
 
-    def __init__(self, dict, protocol=None, writeback=False, compresslevel=2):
-        Shelf.__init__(self, dict, protocol, writeback, compresslevel)
+    def __init__(self, dict, protocol=None, writeback=False, compresslevel=2,
+                 codec="zlib", threshold=64, cachesize=0, cachebytes=0):
+        Shelf.__init__(self, dict, protocol, writeback, compresslevel, codec, threshold,
+                       cachesize, cachebytes)
 
     def set_location(self, key):
         (key, value) = self.dict.set_location(key)
-        f = StringIO(zlib.decompress(value))
-        return (key, Unpickler(f).load())
+        return (key, self._decode(value))
 
     def next(self):
         (key, value) = self.dict.next()
-        f = StringIO(zlib.decompress(value))
-        return (key, Unpickler(f).load())
+        return (key, self._decode(value))
 
     def previous(self):
         (key, value) = self.dict.previous()
-        f = StringIO(zlib.decompress(value))
-        return (key, Unpickler(f).load())
+        return (key, self._decode(value))
 
     def first(self):
         (key, value) = self.dict.first()
-        f = StringIO(zlib.decompress(value))
-        return (key, Unpickler(f).load())
+        return (key, self._decode(value))
 
     def last(self):
         (key, value) = self.dict.last()
-        f = StringIO(zlib.decompress(value))
-        return (key, Unpickler(f).load())
+        return (key, self._decode(value))
 
 
 class DbfilenameShelf(Shelf):
@@ -214,12 +396,15 @@ class DbfilenameShelf(Shelf):
     See the module's __doc__ string for an overview of the interface.
     """
 
-    def __init__(self, filename, flag='c', protocol=None, writeback=False, compresslevel=2):
+    def __init__(self, filename, flag='c', protocol=None, writeback=False, compresslevel=2,
+                 codec="zlib", threshold=64, cachesize=0, cachebytes=0):
         import anydbm
-        Shelf.__init__(self, anydbm.open(filename, flag), protocol, writeback, compresslevel)
+        Shelf.__init__(self, anydbm.open(filename, flag), protocol, writeback, compresslevel, codec, threshold,
+                       cachesize, cachebytes)
 
 
-def open(filename, flag='c', protocol=None, writeback=False, compresslevel=2):
+def open(filename, flag='c', protocol=None, writeback=False, compresslevel=2,
+         codec="zlib", threshold=64, cachesize=0, cachebytes=0):
     """Open a persistent dictionary for reading and writing.
 
     The filename parameter is the base filename for the underlying
@@ -227,12 +412,19 @@ def open(filename, flag='c', protocol=None, writeback=False, compresslevel=2):
     filename and more than one file may be created.  The optional flag
     parameter has the same interpretation as the flag parameter of
     anydbm.open(). The optional protocol parameter specifies the
-    version of the pickle protocol (0, 1, or 2).
+    version of the pickle protocol (0, 1, or 2), the highest available
+    one is used by default.  Values of at least threshold bytes are
+    compressed with codec ("zlib", "bz2" or, if available, "lzma") at
+    compresslevel, smaller ones are stored as is.  If cachesize (entries)
+    or cachebytes (size of the decoded pickles) is given, recently read
+    values are kept in an LRU cache; like with writeback, the cached
+    object itself is returned, so it must not be mutated in place.
 
     See the module's __doc__ string for an overview of the interface.
     """
 
-    return DbfilenameShelf(filename, flag, protocol, writeback, compresslevel)
+    return DbfilenameShelf(filename, flag, protocol, writeback, compresslevel, codec, threshold,
+                           cachesize, cachebytes)
 
 
 class BsdDbfilenameShelf(BsdDbShelf):
@@ -242,12 +434,15 @@ class BsdDbfilenameShelf(BsdDbShelf):
     See the module's __doc__ string for an overview of the interface.
     """
 
-    def __init__(self, filename, flag='c', protocol=None, writeback=False, compresslevel=2):
+    def __init__(self, filename, flag='c', protocol=None, writeback=False, compresslevel=2,
+                 codec="zlib", threshold=64, cachesize=0, cachebytes=0):
         import bsddb
-        Shelf.__init__(self, bsddb.btopen(filename, flag), protocol, writeback, compresslevel)
+        Shelf.__init__(self, bsddb.btopen(filename, flag), protocol, writeback, compresslevel, codec, threshold,
+                       cachesize, cachebytes)
 
 
-def btopen(filename, flag='c', protocol=1, writeback=False, compresslevel=2):
+def btopen(filename, flag='c', protocol=None, writeback=False, compresslevel=2,
+           codec="zlib", threshold=64, cachesize=0, cachebytes=0):
     """Open a persistent dictionary for reading and writing.
 
     The filename parameter is the base filename for the underlying
@@ -255,10 +450,241 @@ def btopen(filename, flag='c', protocol=1, writeback=False, compresslevel=2):
     filename and more than one file may be created.  The optional flag
     parameter has the same interpretation as the flag parameter of
     bsddb.btopen(). The optional protocol parameter specifies the
-    version of the pickle protocol (0, 1, or 2).
+    version of the pickle protocol (0, 1, or 2), the highest available
+    one is used by default.  Values of at least threshold bytes are
+    compressed with codec ("zlib", "bz2" or, if available, "lzma") at
+    compresslevel, smaller ones are stored as is.  If cachesize (entries)
+    or cachebytes (size of the decoded pickles) is given, recently read
+    values are kept in an LRU cache; like with writeback, the cached
+    object itself is returned, so it must not be mutated in place.
+
+    See the module's __doc__ string for an overview of the interface.
+    """
+
+    return BsdDbfilenameShelf(filename, flag, protocol, writeback, compresslevel, codec, threshold,
+                              cachesize, cachebytes)
+
+
+
+class LogDB:
+    """Append-only log file with an in-memory hash index.
+
+    A pure-Python replacement for the bsddb btree, with the same
+    dictionary and cursor interface.  Every write appends a record at
+    the end of the file, so writes are strictly sequential; overwritten
+    and deleted records stay in the file as garbage until it is
+    rewritten.  The index (key -> offset and length of the latest value)
+    is built by scanning the log at open.  A torn record at the tail,
+    left by a crash in the middle of a write, is detected by its length
+    or checksum and truncated away.
+
+    File layout:  _LOG_MAGIC, then records of
+        crc32 (4 bytes) | key length (4) | value length (4) | key | value
+    where crc32 covers everything after itself, and a value length of
+    _LOG_DELETED marks a deletion.  All integers are big-endian.
+    """
+
+    def __init__(self, filename, flag='c'):
+        if flag not in ('r', 'w', 'c', 'n'):
+            raise ValueError("flag must be one of 'r', 'w', 'c' or 'n'")
+        exists = os.path.exists(filename)
+        if flag == 'n' or (flag == 'c' and not exists):
+            f = __builtin__.open(filename, 'wb')
+            f.write(_LOG_MAGIC)
+            f.close()
+        elif not exists:
+            raise IOError(errno.ENOENT, "No such file", filename)
+        self.filename = filename
+        self.readonly = (flag == 'r')
+        if self.readonly:
+            self.f = __builtin__.open(filename, 'rb')
+        else:
+            self.f = __builtin__.open(filename, 'r+b')
+        self.index = {}         ## key: (offset of value, length of value)
+        self.garbage = 0        ## bytes taken by dead records
+        self._sorted = None     ## sorted keys, for the cursor methods
+        self._cursor = None     ## key the cursor is on
+        self._load()
+
+    def _load(self):
+        f = self.f
+        if f.read(len(_LOG_MAGIC)) != _LOG_MAGIC:
+            raise ValueError("%s is not a zshelve log file" % self.filename)
+        offset = len(_LOG_MAGIC)
+        size = os.fstat(f.fileno()).st_size
+        while offset < size:
+            header = f.read(_LOG_HEADER.size)
+            if len(header) < _LOG_HEADER.size:
+                break
+            crc, klen, vlen = _LOG_HEADER.unpack(header)
+            dlen = vlen
+            if vlen == _LOG_DELETED:
+                dlen = 0
+            end = offset + _LOG_HEADER.size + klen + dlen
+            if end > size:
+                break
+            data = f.read(klen + dlen)
+            if zlib.crc32(header[4:] + data) & 0xffffffff != crc:
+                break
+            key = data[:klen]
+            old = self.index.pop(key, None)
+            if old is not None:
+                self.garbage += _LOG_HEADER.size + len(key) + old[1]
+            if vlen == _LOG_DELETED:
+                self.garbage += end - offset
+            else:
+                self.index[key] = (offset + _LOG_HEADER.size + klen, vlen)
+            offset = end
+        if offset < size:
+            ## torn or corrupted tail: drop it
+            if self.readonly:
+                warnings.warn("%s: ignoring %d bytes of torn log tail" % (self.filename, size - offset))
+            else:
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        self.end = offset
+
+    def _append(self, key, value):
+        if self.readonly:
+            raise IOError(errno.EACCES, "log opened read-only", self.filename)
+        if not isinstance(key, str):
+            raise TypeError("keys must be strings")
+        if value is None:
+            vlen, value = _LOG_DELETED, ''
+        else:
+            vlen = len(value)
+        header = _LOG_HEADER.pack(0, len(key), vlen)
+        crc = zlib.crc32(header[4:] + key + value) & 0xffffffff
+        f = self.f
+        f.seek(self.end)
+        f.write(_LOG_HEADER.pack(crc, len(key), vlen))
+        f.write(key)
+        f.write(value)
+        offset = self.end + _LOG_HEADER.size + len(key)
+        self.end = offset + len(value)
+        return offset
+
+    def keys(self):
+        return self.index.keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def has_key(self, key):
+        return key in self.index
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, str):
+            raise TypeError("values must be strings")
+        offset = self._append(key, value)
+        old = self.index.get(key)
+        if old is not None:
+            self.garbage += _LOG_HEADER.size + len(key) + old[1]
+        else:
+            self._sorted = None
+        self.index[key] = (offset, len(value))
+
+    def __delitem__(self, key):
+        old = self.index[key]
+        self._append(key, None)
+        del self.index[key]
+        self._sorted = None
+        self.garbage += 2 * (_LOG_HEADER.size + len(key)) + old[1]
+
+    def sync(self):
+        if not self.readonly:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+    def size(self):
+        """Return (file size, bytes taken by dead records)."""
+        return self.end, self.garbage
+
+    ## cursor methods, in key order like a btree
+
+    def _keys(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.index)
+        return self._sorted
+
+    def _at(self, i):
+        keys = self._keys()
+        if i < 0 or i >= len(keys):
+            raise KeyError("no more records")
+        self._cursor = keys[i]
+        return (self._cursor, self[self._cursor])
+
+    def set_location(self, key):
+        """Move to the first key >= key."""
+        return self._at(bisect.bisect_left(self._keys(), key))
+
+    def first(self):
+        return self._at(0)
+
+    def last(self):
+        return self._at(len(self._keys()) - 1)
+
+    def next(self):
+        if self._cursor is None:
+            return self.first()
+        return self._at(bisect.bisect_right(self._keys(), self._cursor))
+
+    def previous(self):
+        if self._cursor is None:
+            return self.last()
+        return self._at(bisect.bisect_left(self._keys(), self._cursor) - 1)
+
 
+class LogShelf(BsdDbShelf):
+    """Shelf implementation on top of a LogDB append-only log file.
+
+    This is initialized with the filename for the log file.
     See the module's __doc__ string for an overview of the interface.
     """
 
-    return BsdDbfilenameShelf(filename, flag, protocol, writeback, compresslevel)
+    def __init__(self, filename, flag='c', protocol=None, writeback=False, compresslevel=2,
+                 codec="zlib", threshold=64, cachesize=0, cachebytes=0):
+        Shelf.__init__(self, LogDB(filename, flag), protocol, writeback, compresslevel, codec, threshold,
+                       cachesize, cachebytes)
+
+
+def logopen(filename, flag='c', protocol=None, writeback=False, compresslevel=2,
+            codec="zlib", threshold=64, cachesize=0, cachebytes=0):
+    """Open a persistent dictionary stored in an append-only log file.
+
+    Takes the same parameters as btopen(), and needs no bsddb module.
+    The flag parameter is 'r' (read only), 'w' (read/write an existing
+    file), 'c' (create if missing, the default) or 'n' (always create
+    a new, empty file).
+
+    See the module's __doc__ string for an overview of the interface.
+    """
+
+    return LogShelf(filename, flag, protocol, writeback, compresslevel, codec, threshold,
+                    cachesize, cachebytes)
+
 
+def islogfile(filename):
+    """Return True if filename is a log file written by logopen()."""
+    try:
+        f = __builtin__.open(filename, 'rb')
+    except IOError:
+        return False
+    try:
+        return f.read(len(_LOG_MAGIC)) == _LOG_MAGIC
+    finally:
+        f.close()